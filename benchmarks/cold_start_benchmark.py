@@ -0,0 +1,114 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Cold start benchmark: for each plugin Lambda handler, starts a fresh Python process and measures
+the time to import the handler module, the first (cold) invocation - which creates clients and
+connections - and a second (warm) invocation, against the local stub backend. With --warmup, a
+warm-up ping is sent first, and its cost is reported and included in the cold start total.
+Fails when a tracked metric regresses against a saved baseline.
+
+Usage:
+  python benchmarks/cold_start_benchmark.py [--handlers bedrock-llm,ai21-llm] [--runs 5] [--warmup]
+      [--baseline cold_start.json] [--save-baseline cold_start.json]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from handler_benchmark import find_regressions
+from handlers import handler_specs
+from stub_backend import LatencyModel, StubBackend, stub_environment
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+TRACKED_METRICS = ["import_ms", "warmup_ms", "first_invoke_ms", "cold_total_ms"]
+
+# runs in a fresh interpreter, so that nothing is imported or cached yet
+CHILD_SCRIPT = """
+import contextlib, json, os, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {benchmarks_dir!r})
+from handlers import handler_specs, load_handler
+import events
+spec = handler_specs({url!r})[{name!r}]
+devnull = open(os.devnull, "w")
+with contextlib.redirect_stdout(devnull):
+    harness_done = time.perf_counter()
+    module = load_handler(spec["dir"], spec["module"], spec["env"])
+    imported = time.perf_counter()
+    if {warmup!r}:
+        module.lambda_handler(events.warmup_event(), events.LambdaContext())
+    warmed = time.perf_counter()
+    module.lambda_handler(spec["event"](), events.LambdaContext())
+    first = time.perf_counter()
+    module.lambda_handler(spec["event"](), events.LambdaContext())
+    second = time.perf_counter()
+print(json.dumps({{
+    "import_ms": (imported - harness_done) * 1000,
+    "warmup_ms": (warmed - imported) * 1000,
+    "first_invoke_ms": (first - warmed) * 1000,
+    "warm_invoke_ms": (second - first) * 1000
+}}))
+"""
+
+
+def run_cold_start(name, url, env, warmup=False):
+    script = CHILD_SCRIPT.format(benchmarks_dir=BENCHMARKS_DIR, url=url, name=name, warmup=warmup)
+    output = subprocess.run([sys.executable, "-c", script], env=env, capture_output=True, text=True)
+    if output.returncode != 0:
+        raise RuntimeError(f"Cold start run failed for {name}:\n{output.stderr}")
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--handlers", help="comma separated handler names (default: all)")
+    parser.add_argument("--runs", type=int, default=5, help="fresh processes per handler")
+    parser.add_argument("--warmup", action="store_true", help="send a warm-up ping before the first invocation")
+    parser.add_argument("--latency-ms", type=float, default=0, help="injected backend latency")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--baseline", help="fail if a tracked metric regresses against this results file")
+    parser.add_argument("--save-baseline", help="write results to this file as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression")
+    parser.add_argument("--min-delta", type=float, default=5, help="ignore regressions smaller than this (ms)")
+    args = parser.parse_args(argv)
+
+    s3_objects = {"importbucket/attachment.txt": b"attachment " * 2048}
+    results = {}
+    with StubBackend(LatencyModel(args.latency_ms), s3_objects=s3_objects) as backend:
+        env = dict(os.environ, **stub_environment(backend.url))
+        names = args.handlers.split(",") if args.handlers else list(handler_specs(backend.url))
+        for name in names:
+            runs = [run_cold_start(name, backend.url, env, args.warmup) for _ in range(args.runs)]
+            result = {metric: round(statistics.median(run[metric] for run in runs), 2) for metric in runs[0]}
+            # the warm-up ping runs in the new sandbox too, so it counts towards the cold start
+            result["cold_total_ms"] = round(result["import_ms"] + result["warmup_ms"] + result["first_invoke_ms"], 2)
+            results[name] = result
+
+    columns = list(next(iter(results.values())))
+    print(f"{'handler':<30}" + "".join(f"{c:>18}" for c in columns))
+    for name, result in results.items():
+        print(f"{name:<30}" + "".join(f"{str(result.get(c)):>18}" for c in columns))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved baseline: {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(results, baseline, args.tolerance, args.min_delta, TRACKED_METRICS)
+        if regressions:
+            print("Regressions:\n  " + "\n  ".join(regressions))
+            return 1
+        print("No regressions against baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
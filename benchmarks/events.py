@@ -0,0 +1,85 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Realistic test events for the plugin Lambdas, with configurable sizes.
+"""
+
+import json
+import time
+import uuid
+
+PASSAGE = ("Rayleigh scattering causes the sky to appear blue. Sunlight is made up of many colors, and "
+           "shorter blue wavelengths are scattered by the gases and particles in the atmosphere much more "
+           "than the longer red wavelengths, so blue light reaches our eyes from every direction. ")
+
+
+class LambdaContext:
+    """
+    Minimal stand-in for the Lambda context object.
+    """
+    def __init__(self, function_name="benchmark", timeout_ms=60000):
+        self.function_name = function_name
+        self.aws_request_id = str(uuid.uuid4())
+        self.memory_limit_in_mb = 128
+        self.timeout_ms = timeout_ms
+        self._deadline = time.monotonic() + timeout_ms / 1000.0
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self._deadline - time.monotonic()) * 1000))
+
+
+def qa_prompt(context_passages=5):
+    context = "\n\n".join(f"Passage {i}: {PASSAGE * 3}" for i in range(context_passages))
+    return ("\n\nHuman: You are a friendly AI assistant. Answer the question in <question> tags only based on the provided "
+            f"reference passages. Here are reference passages in <references> tags:\n<references>\n{context}\n</references>\n"
+            "<question>\nWhy is the sky blue?\n</question>\n\nAssistant: According to the reference passages, in under 50 words:")
+
+def chat_history(turns=6):
+    history = []
+    for i in range(turns):
+        history.append({"Human": f"Question number {i} about the colour of the sky at sunset?"})
+        history.append({"AI": PASSAGE})
+    return json.dumps(history)
+
+def llm_event(parameters, context_passages=5):
+    return {"prompt": qa_prompt(context_passages), "parameters": dict(parameters)}
+
+def embeddings_event(words=200):
+    return {"inputText": " ".join((PASSAGE.split() * (words // 40 + 1))[:words])}
+
+def warmup_event():
+    # input of the scheduled EventBridge warm-up rule
+    return {"warmup": {}}
+
+def lambdahook_event(args=None, history_turns=6, files=None):
+    """
+    A QnABot LambdaHook event (req / res), as received for the no_hits item.
+    """
+    session = {
+        "qnabotcontext": {"previous": {"q": "no_hits"}},
+        "userFilesUploaded": files or []
+    }
+    return {
+        "req": {
+            "question": "Why is the sky blue?",
+            "_event": {"inputTranscript": "why is the sky blue"},
+            "_userInfo": {
+                "UserId": "benchmark-user",
+                "Email": "user@example.com",
+                "isVerifiedIdentity": "true",
+                "chatMessageHistory": chat_history(history_turns)
+            },
+            "session": dict(session)
+        },
+        "res": {
+            "type": "PlainText",
+            "message": "",
+            "session": dict(session),
+            "result": {
+                "qid": "no_hits",
+                "args": [json.dumps(args)] if args is not None else []
+            },
+            "got_hits": 0
+        }
+    }
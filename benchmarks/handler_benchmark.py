@@ -0,0 +1,145 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Offline micro-benchmark of the overhead each plugin Lambda handler adds around its model call -
+event parsing, prompt formatting, logging and response formatting - against a local stub backend
+with injected latency. Reports p50/p99 overhead, peak and retained memory per invocation, and
+fails when a tracked metric regresses against a saved baseline.
+
+Usage:
+  python benchmarks/handler_benchmark.py [--handlers bedrock-llm,ai21-llm] [--iterations 200]
+      [--latency-ms 50] [--jitter-ms 10] [--baseline baseline.json] [--save-baseline baseline.json]
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+import events
+from handlers import handler_specs, load_handler
+from stub_backend import LatencyModel, StubBackend, stub_environment
+
+# metrics compared against the baseline - all are "lower is better"
+TRACKED_METRICS = ["p50_overhead_ms", "p99_overhead_ms", "peak_kib"]
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(p / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+@contextlib.contextmanager
+def quiet():
+    # handlers log to stdout - keep the serialization cost, discard the output
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+def benchmark_handler(module, make_event, backend, iterations, warmup, memory_iterations):
+    for _ in range(warmup):
+        with quiet():
+            module.lambda_handler(make_event(), events.LambdaContext())
+    overheads = []
+    for _ in range(iterations):
+        event = make_event()
+        backend.reset()
+        with quiet():
+            start = time.perf_counter()
+            module.lambda_handler(event, events.LambdaContext())
+            elapsed = time.perf_counter() - start
+        overheads.append((elapsed - backend.backend_seconds()) * 1000)
+    peaks = []
+    retained = []
+    tracemalloc.start()
+    try:
+        for _ in range(memory_iterations):
+            event = make_event()
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            with quiet():
+                module.lambda_handler(event, events.LambdaContext())
+            after, peak = tracemalloc.get_traced_memory()
+            peaks.append((peak - before) / 1024)
+            retained.append((after - before) / 1024)
+    finally:
+        tracemalloc.stop()
+    return {
+        "iterations": iterations,
+        "event_bytes": len(json.dumps(make_event())),
+        "p50_overhead_ms": round(percentile(overheads, 50), 3),
+        "p99_overhead_ms": round(percentile(overheads, 99), 3),
+        "mean_overhead_ms": round(statistics.mean(overheads), 3),
+        "peak_kib": round(statistics.median(peaks), 1) if peaks else None,
+        "retained_kib": round(statistics.median(retained), 1) if retained else None
+    }
+
+def find_regressions(results, baseline, tolerance, min_delta, tracked_metrics=TRACKED_METRICS):
+    regressions = []
+    for name, result in results.items():
+        for metric in tracked_metrics:
+            base = baseline.get(name, {}).get(metric)
+            value = result.get(metric)
+            if base is None or value is None:
+                continue
+            if value > base * (1 + tolerance) and value - base > min_delta:
+                regressions.append(f"{name}.{metric}: {value} > baseline {base} (+{tolerance:.0%})")
+    return regressions
+
+def print_table(results):
+    columns = ["event_bytes", "p50_overhead_ms", "p99_overhead_ms", "mean_overhead_ms", "peak_kib", "retained_kib"]
+    print(f"{'handler':<30}" + "".join(f"{c:>18}" for c in columns))
+    for name, result in results.items():
+        print(f"{name:<30}" + "".join(f"{str(result.get(c)):>18}" for c in columns))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--handlers", help="comma separated handler names (default: all)")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--memory-iterations", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=0, help="injected backend latency")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="mean of exponential jitter added to the latency")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--baseline", help="fail if a tracked metric regresses against this results file")
+    parser.add_argument("--save-baseline", help="write results to this file as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression")
+    parser.add_argument("--min-delta", type=float, default=0.5, help="ignore regressions smaller than this (ms / KiB)")
+    args = parser.parse_args(argv)
+
+    s3_objects = {"importbucket/attachment.txt": b"attachment " * 2048}
+    with StubBackend(LatencyModel(args.latency_ms, args.jitter_ms), s3_objects=s3_objects) as backend:
+        os.environ.update(stub_environment(backend.url))
+        specs = handler_specs(backend.url)
+        names = args.handlers.split(",") if args.handlers else list(specs)
+        results = {}
+        for name in names:
+            spec = specs[name]
+            with quiet():
+                module = load_handler(spec["dir"], spec["module"], spec["env"])
+            results[name] = benchmark_handler(module, spec["event"], backend, args.iterations, args.warmup, args.memory_iterations)
+    print_table(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved baseline: {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(results, baseline, args.tolerance, args.min_delta)
+        if regressions:
+            print("Regressions:\n  " + "\n  ".join(regressions))
+            return 1
+        print("No regressions against baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
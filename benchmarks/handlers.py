@@ -0,0 +1,119 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Loads the plugin Lambda handlers in-process. Each Lambda has its own src directory with
+modules of the same name (llm, lambdahook, settings, ...), so every handler is imported in
+isolation and keeps its own module objects.
+"""
+
+import contextlib
+import glob
+import importlib
+import os
+import sys
+
+import events
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAMBDAS_DIR = os.path.join(ROOT_DIR, "lambdas")
+QBUSINESS_MODEL_DIR = os.path.join(ROOT_DIR, "layers", "qbusiness_boto3_model", "model")
+
+
+def handler_specs(url):
+    """
+    Benchmark handlers: Lambda directory, handler module, environment and a realistic event factory.
+    """
+    return {
+        "bedrock-llm": {
+            "dir": "bedrock-embeddings-and-llm", "module": "llm", "env": {"ENDPOINT_URL": url},
+            "event": lambda: events.llm_event({"modelId": "anthropic.claude-instant-v1", "temperature": 0})
+        },
+        "bedrock-llm-claude3": {
+            "dir": "bedrock-embeddings-and-llm", "module": "llm", "env": {"ENDPOINT_URL": url},
+            "event": lambda: events.llm_event({"modelId": "anthropic.claude-3-sonnet-20240229-v1:0", "temperature": 0, "system": "You are a helpful AI assistant."})
+        },
+        "bedrock-lambdahook": {
+            "dir": "bedrock-embeddings-and-llm", "module": "lambdahook", "env": {"ENDPOINT_URL": url},
+            "event": lambda: events.lambdahook_event({"Prefix": "LLM Answer:", "Model_params": {"modelId": "anthropic.claude-instant-v1", "temperature": 0}, "Prompt": "Chat history:<br>{history}<br>Question: {query}"})
+        },
+        "bedrock-embeddings": {
+            "dir": "bedrock-embeddings-and-llm", "module": "embeddings", "env": {"ENDPOINT_URL": url},
+            "event": lambda: events.embeddings_event()
+        },
+        "ai21-llm": {
+            "dir": "ai21-llm", "module": "llm", "env": {"ENDPOINT_URL": url + "/studio/v1/{MODEL_TYPE}/complete"},
+            "event": lambda: events.llm_event({"model_type": "j2-mid", "temperature": 0})
+        },
+        "ai21-lambdahook": {
+            "dir": "ai21-llm", "module": "lambdahook", "env": {"ENDPOINT_URL": url + "/studio/v1/{MODEL_TYPE}/complete"},
+            "event": lambda: events.lambdahook_event({"Prefix": "LLM Answer:", "Model_params": {"model_type": "j2-mid"}})
+        },
+        "anthropic-llm": {
+            "dir": "anthropic-llm", "module": "llm", "env": {"ENDPOINT_URL": url + "/v1/complete"},
+            "event": lambda: events.llm_event({"model": "claude-instant-1", "temperature": 0})
+        },
+        "llama-2-13b-chat-llm": {
+            "dir": "llama-2-13b-chat-llm", "module": "llm", "env": {"SAGEMAKER_ENDPOINT_NAME": "jumpstart-dft-meta-textgeneration-llama-2-13b-f"},
+            "event": lambda: events.llm_event({"temperature": 0.1, "max_new_tokens": 256, "top_p": 0.5})
+        },
+        "mistral-7b-instruct-chat-llm": {
+            "dir": "mistral-7b-instruct-chat-llm", "module": "llm", "env": {"SAGEMAKER_ENDPOINT_NAME": "jumpstart-dft-hf-llm-mistral-7b-instruct"},
+            "event": lambda: events.llm_event({"temperature": 0.1, "max_new_tokens": 256, "top_p": 0.5})
+        },
+        "qbusiness-lambdahook": {
+            "dir": "qna_bot_qbusiness_lambdahook", "module": "lambdahook", "env": {"AMAZONQ_ENDPOINT_URL": url, "AWS_DATA_PATH": QBUSINESS_MODEL_DIR},
+            "event": lambda: events.lambdahook_event({"Prefix": "Amazon Q Answer:"}, files=[{"s3Path": "s3://importbucket/attachment.txt", "fileName": "attachment.txt"}])
+        }
+    }
+
+def lambda_module_names():
+    # module names that more than one Lambda src directory may define
+    return {os.path.splitext(os.path.basename(path))[0] for path in glob.glob(os.path.join(LAMBDAS_DIR, "*", "src", "*.py"))}
+
+LAMBDA_MODULE_NAMES = lambda_module_names()
+
+
+class LoadedHandler:
+    """
+    A handler module imported from one Lambda's src directory. Its src directory and its own
+    modules are swapped in around every call, as they would be in the Lambda runtime, so that
+    modules the handler imports lazily resolve to the right Lambda.
+    """
+    def __init__(self, src_dir, module_name):
+        self.src_dir = src_dir
+        self.modules = {}
+        with self.activate():
+            self.module = importlib.import_module(module_name)
+
+    @contextlib.contextmanager
+    def activate(self):
+        for name in LAMBDA_MODULE_NAMES:
+            sys.modules.pop(name, None)
+        sys.modules.update(self.modules)
+        sys.path.insert(0, self.src_dir)
+        try:
+            yield
+        finally:
+            sys.path.remove(self.src_dir)
+            for name in LAMBDA_MODULE_NAMES:
+                if name in sys.modules:
+                    self.modules[name] = sys.modules.pop(name)
+
+    def lambda_handler(self, event, context):
+        with self.activate():
+            return self.module.lambda_handler(event, context)
+
+    def __getattr__(self, name):
+        # other module attributes, e.g. handler.call_llm
+        if name == "module":
+            raise AttributeError(name)
+        return getattr(self.module, name)
+
+
+def load_handler(lambda_dir, module_name, env=None):
+    """
+    Imports module_name from lambdas/<lambda_dir>/src with the given environment.
+    """
+    os.environ.update(env or {})
+    return LoadedHandler(os.path.join(LAMBDAS_DIR, lambda_dir, "src"), module_name)
@@ -0,0 +1,306 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Replays LambdaHook events captured by the plugin Lambdas (CAPTURE_SAMPLE_RATE, see capture.py) against
+the local stub backend, at a configurable concurrency and arrival rate. Each worker process stands in for
+one Lambda sandbox, with its own warm handler modules, so that concurrency is limited the way the Lambda
+service limits it. The stub injects latency and throttling. Reports throughput, end-to-end, service and
+queueing latency percentiles, retry amplification (backend attempts per request) and cache hit rates.
+
+Without capture files, synthetic Bedrock LambdaHook events are replayed.
+
+Usage:
+  python benchmarks/load_test.py [captures/*.jsonl.gz ...] [--concurrency 16] [--rate 20]
+      [--arrival poisson|constant|captured] [--speedup 1] [--requests 500] [--max-queue-ms 1000]
+      [--latency-ms 800] [--jitter-ms 400] [--throttle-rate 0.05] [--handlers bedrock-lambdahook]
+      [--output results.json]
+"""
+
+import argparse
+import contextlib
+import glob
+import gzip
+import io
+import json
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+import events
+from handler_benchmark import percentile, quiet
+from handlers import handler_specs, load_handler
+from stub_backend import LatencyModel, StubBackend, stub_environment
+
+# handlers that receive LambdaHook events, and can be replayed
+LAMBDAHOOK_HANDLERS = ["bedrock-lambdahook", "qbusiness-lambdahook", "ai21-lambdahook"]
+SYNTHETIC_QUESTIONS = ["Why is the sky blue?", "Why are sunsets red?", "What is Rayleigh scattering?", "Why is the sea blue?", "What colour is the sky on Mars?"]
+# a model with prompt caching, and a system prompt long enough to be cached
+SYNTHETIC_MODEL_PARAMS = {"modelId": "anthropic.claude-3-7-sonnet-20250219-v1:0", "temperature": 0, "system": "You are a helpful AI assistant. " + events.PASSAGE * 20}
+# backend services whose requests are counted for retry amplification
+MODEL_SERVICES = ["bedrock", "sagemaker", "qbusiness", "ai21", "anthropic"]
+
+
+def read_captures(paths):
+    """
+    Reads captured events from compressed (.jsonl.gz) or plain JSONL files, or directories of them,
+    in capture order.
+    """
+    files = []
+    for path in paths:
+        files += sorted(glob.glob(os.path.join(path, "*.jsonl*"))) if os.path.isdir(path) else [path]
+    records = []
+    for path in files:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            records += [json.loads(line) for line in f if line.strip()]
+    return sorted(records, key=lambda record: record.get("captured_at", 0))
+
+def synthetic_events(count):
+    # Bedrock LambdaHook events, one second apart
+    records = []
+    for i in range(count):
+        event = events.lambdahook_event({"Prefix": "LLM Answer:", "Model_params": dict(SYNTHETIC_MODEL_PARAMS), "Prompt": "Chat history:<br>{history}<br>Question: {query}"})
+        event["req"]["question"] = SYNTHETIC_QUESTIONS[i % len(SYNTHETIC_QUESTIONS)]
+        records.append({"captured_at": float(i), "handler": "bedrock-lambdahook", "req": event["req"], "res": event["res"]})
+    return records
+
+def attachment_objects(records):
+    # stub S3 objects for the attachments that captured sessions refer to
+    objects = {}
+    for record in records:
+        for files in [record["req"].get("session", {}).get("userFilesUploaded"), record["res"].get("session", {}).get("userFilesUploaded")]:
+            for file in files or []:
+                if str(file.get("s3Path", "")).startswith("s3://"):
+                    objects[file["s3Path"][len("s3://"):]] = b"attachment " * 2048
+    return objects
+
+def get_arrival_offsets(records, indexes, args):
+    """
+    Seconds from the start of the run at which each request arrives, or None for a closed loop
+    (each worker sends its next request as soon as the last one returns).
+    """
+    if args.arrival == "captured":
+        start = records[indexes[0]].get("captured_at", 0)
+        offsets, previous, shift = [], None, 0.0
+        for index in indexes:
+            captured_at = records[index].get("captured_at", 0)
+            # when the captured events are replayed again, the next pass follows the last one
+            if previous is not None and captured_at < previous:
+                shift = offsets[-1] - (captured_at - start) / args.speedup
+            offsets.append((captured_at - start) / args.speedup + shift)
+            previous = captured_at
+        return offsets
+    if not args.rate:
+        return None
+    if args.arrival == "constant":
+        return [i / args.rate for i in range(len(indexes))]
+    random_arrivals = random.Random(args.seed)
+    offsets, offset = [], 0.0
+    for _ in indexes:
+        offsets.append(offset)
+        offset += random_arrivals.expovariate(args.rate)
+    return offsets
+
+def get_invocation_metrics(output):
+    # the invocation's CloudWatch EMF document, from the handler's log output
+    for line in reversed(output.splitlines()):
+        if '"_aws"' in line and '"TotalTime"' in line:
+            with contextlib.suppress(ValueError):
+                return json.loads(line)
+    return {}
+
+def worker(worker_id, url, records, names, max_queue_ms, tasks, results, ready):
+    """
+    One simulated Lambda sandbox: loads the handlers once, warms them with one event each, then
+    invokes them for each (index, scheduled time) task until it receives None.
+    """
+    os.environ.update(stub_environment(url))
+    specs = handler_specs(url)
+    loaded = {}
+    with quiet():
+        for name in names:
+            loaded[name] = load_handler(specs[name]["dir"], specs[name]["module"], specs[name]["env"])
+            first = next(record for record in records if record["handler"] == name)
+            with contextlib.suppress(Exception):
+                loaded[name].lambda_handler(json.loads(json.dumps({"req": first["req"], "res": first["res"]})), events.LambdaContext())
+    ready.put(worker_id)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        index, scheduled = task
+        start = time.time()
+        if max_queue_ms is not None and scheduled is not None and (start - scheduled) * 1000 > max_queue_ms:
+            # a sandbox was not free in time - Lambda would have throttled the invocation
+            results.put({"index": index, "rejected": True})
+            continue
+        record = records[index]
+        # a fresh copy - handlers modify the event they return
+        event = json.loads(json.dumps({"req": record["req"], "res": record["res"]}))
+        output = io.StringIO()
+        error = None
+        with contextlib.redirect_stdout(output):
+            try:
+                loaded[record["handler"]].lambda_handler(event, events.LambdaContext())
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"[:200]
+        end = time.time()
+        results.put({
+            "index": index,
+            "handler": record["handler"],
+            "worker": worker_id,
+            "scheduled": scheduled if scheduled is not None else start,
+            "start": start,
+            "end": end,
+            "error": error,
+            "metrics": get_invocation_metrics(output.getvalue())
+        })
+
+def summarize_latency(values):
+    if not values:
+        return {}
+    return {
+        "p50": round(percentile(values, 50), 1),
+        "p90": round(percentile(values, 90), 1),
+        "p99": round(percentile(values, 99), 1),
+        "max": round(max(values), 1)
+    }
+
+def get_metric_total(results, name):
+    total = 0
+    for result in results:
+        value = result["metrics"].get(name, 0)
+        total += sum(value) if isinstance(value, list) else value
+    return total
+
+def get_report(results, backend_requests, duration):
+    completed = [result for result in results if not result.get("rejected")]
+    succeeded = [result for result in completed if not result["error"]]
+    cache_results = [result for result in completed if "CacheHit" in result["metrics"]]
+    model_requests = [request for request in backend_requests if request["service"] in MODEL_SERVICES]
+    first_attempts = [request for request in model_requests if request["attempt"] == 1]
+    input_tokens = get_metric_total(completed, "InputTokens")
+    backend = {}
+    for request in backend_requests:
+        service = backend.setdefault(request["service"], {"requests": 0, "retries": 0, "throttled": 0})
+        service["requests"] += 1
+        service["retries"] += 1 if request["attempt"] > 1 else 0
+        service["throttled"] += 1 if request["status"] in [400, 429] else 0
+    by_handler = {}
+    for name in sorted({result["handler"] for result in completed}):
+        handler_results = [result for result in completed if result["handler"] == name]
+        by_handler[name] = {
+            "requests": len(handler_results),
+            "errors": sum(1 for result in handler_results if result["error"]),
+            "latency_ms": summarize_latency([(result["end"] - result["scheduled"]) * 1000 for result in handler_results])
+        }
+    return {
+        "requests": len(results),
+        "completed": len(completed),
+        "errors": len(completed) - len(succeeded),
+        "rejected": len(results) - len(completed),
+        "duration_s": round(duration, 2),
+        "throughput_rps": round(len(succeeded) / duration, 2) if duration else None,
+        # from arrival to response, including time queued for a free sandbox
+        "latency_ms": summarize_latency([(result["end"] - result["scheduled"]) * 1000 for result in completed]),
+        "service_ms": summarize_latency([(result["end"] - result["start"]) * 1000 for result in completed]),
+        "queue_ms": summarize_latency([(result["start"] - result["scheduled"]) * 1000 for result in completed]),
+        # model backend attempts per request the handlers made - 1.0 means no retries
+        "retry_amplification": round(len(model_requests) / len(first_attempts), 3) if first_attempts else None,
+        "cache_hit_rate": round(sum(1 for result in cache_results if result["metrics"]["CacheHit"] == "true") / len(cache_results), 3) if cache_results else None,
+        "cached_input_token_rate": round(get_metric_total(completed, "CacheReadInputTokens") / input_tokens, 3) if input_tokens else None,
+        "top_errors": dict(Counter(result["error"] for result in completed if result["error"]).most_common(5)),
+        "backend": backend,
+        "by_handler": by_handler
+    }
+
+def print_report(report):
+    print(f"requests {report['requests']}  completed {report['completed']}  errors {report['errors']}  rejected {report['rejected']}  "
+          f"duration {report['duration_s']}s  throughput {report['throughput_rps']} req/s")
+    for name in ["latency_ms", "service_ms", "queue_ms"]:
+        print(f"{name:<12}" + "".join(f"{key:>6} {value:<10}" for key, value in report[name].items()))
+    print(f"retry amplification {report['retry_amplification']}  cache hit rate {report['cache_hit_rate']}  cached input token rate {report['cached_input_token_rate']}")
+    print(f"{'backend':<16}{'requests':>10}{'retries':>10}{'throttled':>10}")
+    for service, counts in sorted(report["backend"].items()):
+        print(f"{service:<16}" + "".join(f"{counts[key]:>10}" for key in ["requests", "retries", "throttled"]))
+    for error, count in report["top_errors"].items():
+        print(f"  {count} x {error}")
+
+def run(records, args):
+    names = sorted({record["handler"] for record in records})
+    count = args.requests or len(records)
+    indexes = [i % len(records) for i in range(count)]
+    offsets = get_arrival_offsets(records, indexes, args)
+    s3_objects = attachment_objects(records)
+    latency = LatencyModel(args.latency_ms, args.jitter_ms, args.throttle_rate, seed=args.seed)
+    with StubBackend(latency, s3_objects=s3_objects) as backend:
+        # each worker is a fresh interpreter, as a Lambda sandbox is
+        context = multiprocessing.get_context("spawn")
+        tasks, results, ready = context.Queue(), context.Queue(), context.Queue()
+        workers = [context.Process(target=worker, args=(i, backend.url, records, names, args.max_queue_ms, tasks, results, ready), daemon=True) for i in range(args.concurrency)]
+        for process in workers:
+            process.start()
+        for _ in workers:
+            ready.get()
+        backend.reset()
+
+        def dispatch(start):
+            for i, index in enumerate(indexes):
+                if offsets is None:
+                    tasks.put((index, None))
+                    continue
+                delay = start + offsets[i] - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                tasks.put((index, start + offsets[i]))
+            for _ in workers:
+                tasks.put(None)
+
+        start = time.time()
+        dispatcher = threading.Thread(target=dispatch, args=(start,), daemon=True)
+        dispatcher.start()
+        collected = [results.get() for _ in indexes]
+        duration = time.time() - start
+        dispatcher.join()
+        for process in workers:
+            process.join(timeout=10)
+        return get_report(collected, list(backend.requests), duration)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("captures", nargs="*", help="capture files (.jsonl.gz / .jsonl) or directories - default: synthetic events")
+    parser.add_argument("--handlers", help="comma separated subset of the captured handlers (default: all)")
+    parser.add_argument("--concurrency", type=int, default=16, help="simulated Lambda sandboxes (worker processes)")
+    parser.add_argument("--rate", type=float, default=0, help="arrivals per second - 0 for a closed loop")
+    parser.add_argument("--arrival", choices=["poisson", "constant", "captured"], default="poisson", help="arrival process - captured replays the captured inter-arrival times")
+    parser.add_argument("--speedup", type=float, default=1.0, help="with --arrival captured, replay this many times faster")
+    parser.add_argument("--requests", type=int, help="requests to send, cycling through the events (default: one per event)")
+    parser.add_argument("--max-queue-ms", type=float, help="reject requests that wait longer than this for a free sandbox, as Lambda throttling would")
+    parser.add_argument("--latency-ms", type=float, default=500, help="injected backend latency")
+    parser.add_argument("--jitter-ms", type=float, default=250, help="mean of exponential jitter added to the latency")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of backend requests answered with a throttling error")
+    parser.add_argument("--synthetic", type=int, default=200, help="synthetic events, when no capture files are given")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the report as JSON to this file")
+    args = parser.parse_args(argv)
+
+    records = read_captures(args.captures) if args.captures else synthetic_events(args.synthetic)
+    records = [record for record in records if record.get("handler") in LAMBDAHOOK_HANDLERS and (not args.handlers or record["handler"] in args.handlers.split(","))]
+    if not records:
+        print("No events to replay")
+        return 1
+    report = run(records, args)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
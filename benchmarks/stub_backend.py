@@ -0,0 +1,308 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Local stand-in for the services the plugin Lambdas call - Bedrock runtime, SageMaker runtime,
+Amazon Q Business, S3, Secrets Manager and the AI21 / Anthropic APIs - served from one local
+HTTP server with configurable injected latency and throttling.
+Point the Lambdas at it with the ENDPOINT_URL / AWS_ENDPOINT_URL_* environment variables (see stub_environment).
+"""
+
+import base64
+import binascii
+import json
+import random
+import struct
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+GENERATED_TEXT = "The sky is blue because molecules in the air scatter blue light from the sun more than red light."
+
+
+class LatencyModel:
+    """
+    Injected backend latency: a fixed base plus exponentially distributed jitter, and an optional
+    probability of responding with a throttling error instead.
+    """
+    def __init__(self, latency_ms=0, jitter_ms=0, throttle_rate=0.0, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(seed)
+
+    def sample_ms(self):
+        jitter = self.random.expovariate(1.0 / self.jitter_ms) if self.jitter_ms else 0
+        return self.latency_ms + jitter
+
+    def throttled(self):
+        return self.throttle_rate > 0 and self.random.random() < self.throttle_rate
+
+
+def bedrock_response(model_id, output_tokens=20, body=None):
+    # cross-region inference profile ids, e.g. us.anthropic.claude-sonnet-4-..., answer like the model
+    model_id = re.sub(r"^(us|eu|apac|us-gov)\.", "", model_id)
+    provider = model_id.split(".")[0]
+    if provider == "anthropic":
+        # messages API models - claude-instant and claude-v2 use text completions
+        if not model_id.startswith(("anthropic.claude-instant", "anthropic.claude-v")):
+            return {
+                "content": [{"type": "text", "text": GENERATED_TEXT}],
+                "usage": {"input_tokens": 100, "output_tokens": output_tokens}
+            }
+        return {"completion": GENERATED_TEXT}
+    if provider == "ai21":
+        return {"completions": [{"data": {"text": GENERATED_TEXT}}]}
+    if provider == "amazon":
+        if "embed" in model_id:
+            return {"embedding": [0.01] * 1536, "inputTextTokenCount": 10}
+        return {"results": [{"outputText": GENERATED_TEXT, "tokenCount": output_tokens}]}
+    if provider == "cohere":
+        if "embed" in model_id:
+            # one embedding per text of a batched request
+            texts = json.loads(body or b"{}").get("texts", [""])
+            return {"embeddings": [[0.01] * 1024] * len(texts), "texts": texts}
+        return {"generations": [{"text": GENERATED_TEXT}]}
+    if provider == "meta":
+        return {"generation": GENERATED_TEXT}
+    return {}
+
+def event_stream_message(headers, payload):
+    # one message of the AWS event stream encoding, used by Bedrock response streams
+    encoded_headers = b"".join(struct.pack("B", len(name)) + name.encode() + b"\x07" + struct.pack(">H", len(value)) + value.encode() for name, value in headers.items())
+    prelude = struct.pack(">II", 16 + len(encoded_headers) + len(payload), len(encoded_headers))
+    message = prelude + struct.pack(">I", binascii.crc32(prelude)) + encoded_headers + payload
+    return message + struct.pack(">I", binascii.crc32(message))
+
+def bedrock_stream_response(model_id, input_tokens, output_tokens=20):
+    # the generated text in two chunks - the last chunk carries the invocation metrics
+    chunks = [{"completion": GENERATED_TEXT[:10]}, {"completion": GENERATED_TEXT[10:], "amazon-bedrock-invocationMetrics": {"inputTokenCount": input_tokens, "outputTokenCount": output_tokens}}]
+    headers = {":event-type": "chunk", ":content-type": "application/json", ":message-type": "event"}
+    return b"".join(event_stream_message(headers, json.dumps({"bytes": base64.b64encode(json.dumps(chunk).encode()).decode()}).encode()) for chunk in chunks)
+
+def sagemaker_response(endpoint_name, body):
+    inputs = json.loads(body or b"{}").get("inputs", [])
+    # batched requests (a list of prompts / dialogs) get one result per input
+    count = len(inputs) if isinstance(inputs, list) and inputs and isinstance(inputs[0], (list, str)) else 1
+    if "llama" in endpoint_name:
+        return [{"generation": {"role": "assistant", "content": GENERATED_TEXT}} for _ in range(count)]
+    return [{"generated_text": GENERATED_TEXT} for _ in range(count)]
+
+def qbusiness_response():
+    return {
+        "conversationId": "11111111-1111-1111-1111-111111111111",
+        "systemMessageId": "22222222-2222-2222-2222-222222222222",
+        "userMessageId": "33333333-3333-3333-3333-333333333333",
+        "systemMessage": GENERATED_TEXT,
+        "sourceAttributions": [
+            {"title": "Why is the sky blue", "snippet": GENERATED_TEXT, "url": "https://example.com/sky", "citationNumber": 1}
+        ]
+    }
+
+
+class StubBackend:
+    """
+    A threaded local HTTP server that answers like the AWS services and model APIs used by the Lambdas.
+    Records per-request backend time so that benchmarks can subtract it from handler time.
+    """
+    def __init__(self, latency=None, s3_objects=None, port=0, async_inference_seconds=0.2, async_inference_error=None):
+        self.latency = latency or LatencyModel()
+        self.s3_objects = s3_objects or {}
+        # time for an asynchronous inference endpoint to write its output to S3
+        self.async_inference_seconds = async_inference_seconds
+        # if set, asynchronous inference requests fail with this error
+        self.async_inference_error = async_inference_error
+        self.lock = threading.Lock()
+        self.requests = []
+        # prompt prefixes cached by the simulated Bedrock prompt cache
+        self.prompt_prefixes = set()
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self.make_handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def reset(self):
+        with self.lock:
+            self.requests = []
+
+    def backend_seconds(self):
+        with self.lock:
+            return sum(r["seconds"] for r in self.requests)
+
+    def record(self, service, seconds, status, attempt=1):
+        # attempt > 1 is a retry by the SDK
+        with self.lock:
+            self.requests.append({"service": service, "seconds": seconds, "status": status, "attempt": attempt})
+
+    def prompt_cache_usage(self, body):
+        """
+        Simulated Bedrock prompt caching: the request up to its last cache checkpoint is read from the cache
+        when the same prefix was sent before, and written to it otherwise.
+        """
+        try:
+            request = json.loads(body or b"{}")
+        except ValueError:
+            return {}
+        # the system prompt is always part of the cached prefix
+        system = request.get("system") or []
+        system = [{"type": "text", "text": system}] if isinstance(system, str) else system
+        blocks = system + [block for message in request.get("messages", []) if isinstance(message.get("content"), list) for block in message["content"]]
+        checkpoints = [i for i, block in enumerate(blocks) if isinstance(block, dict) and block.get("cache_control")]
+        if not checkpoints:
+            return {}
+        prefix = json.dumps(blocks[:checkpoints[-1] + 1])
+        with self.lock:
+            hit = prefix in self.prompt_prefixes
+            self.prompt_prefixes.add(prefix)
+        tokens = len(prefix) // 4
+        return {"cache_read_input_tokens": tokens if hit else 0, "cache_creation_input_tokens": 0 if hit else tokens}
+
+    def route(self, method, path, headers, body):
+        # returns (service, status, content_type, payload bytes)
+        target = headers.get("X-Amz-Target", "")
+        if target.startswith("secretsmanager."):
+            payload = {"ARN": "arn:aws:secretsmanager:us-east-1:123456789012:secret:stub", "Name": "stub", "SecretString": "stub-api-key"}
+            return "secretsmanager", 200, "application/x-amz-json-1.1", json.dumps(payload).encode()
+        match = re.match(r"^/model/([^/]+)/invoke-with-response-stream", path)
+        if match:
+            return "bedrock", 200, "application/vnd.amazon.eventstream", bedrock_stream_response(unquote(match.group(1)), len(body) // 4)
+        match = re.match(r"^/model/([^/]+)/invoke", path)
+        if match:
+            model_id = unquote(match.group(1))
+            response = bedrock_response(model_id, body=body)
+            if "usage" in response:
+                response["usage"].update(self.prompt_cache_usage(body))
+            return "bedrock", 200, "application/json", json.dumps(response).encode()
+        match = re.match(r"^/endpoints/([^/]+)/async-invocations", path)
+        if match:
+            return self.invoke_async(match.group(1), headers)
+        match = re.match(r"^/endpoints/([^/]+)/invocations", path)
+        if match:
+            return "sagemaker", 200, "application/json", json.dumps(sagemaker_response(match.group(1), body)).encode()
+        if re.match(r"^/applications/[^/]+/conversations", path):
+            return "qbusiness", 200, "application/json", json.dumps(qbusiness_response()).encode()
+        if path.startswith("/studio/v1/"):
+            return "ai21", 200, "application/json", json.dumps({"completions": [{"data": {"text": GENERATED_TEXT}}]}).encode()
+        if path.startswith("/v1/complete") or path.startswith("/v1/messages"):
+            return "anthropic", 200, "application/json", json.dumps({"completion": GENERATED_TEXT}).encode()
+        if method == "PUT":
+            self.s3_objects[unquote(path.lstrip("/").split("?")[0])] = body
+            return "s3", 200, "application/xml", b""
+        if method in ["GET", "HEAD"]:
+            key = unquote(path.lstrip("/").split("?")[0])
+            if key in self.s3_objects:
+                return "s3", 200, "application/octet-stream", self.s3_objects[key]
+            return "s3", 404, "application/xml", b"<Error><Code>NoSuchKey</Code><Message>Not found</Message></Error>"
+        return "unknown", 404, "application/json", b"{}"
+
+    def invoke_async(self, endpoint_name, headers):
+        """
+        An asynchronous inference endpoint: reads the staged input from S3, and writes the result to the output
+        location (or an error to the failure location) after async_inference_seconds.
+        """
+        input_location = headers.get("X-Amzn-SageMaker-InputLocation", "")
+        inference_id = str(uuid.uuid4())
+        bucket = input_location[len("s3://"):].split("/")[0]
+        output_key = f"{bucket}/async-output/{inference_id}.out"
+        failure_key = f"{bucket}/async-failures/{inference_id}-error.out"
+        def complete():
+            body = self.s3_objects.get(input_location[len("s3://"):])
+            if self.async_inference_error:
+                self.s3_objects[failure_key] = self.async_inference_error.encode()
+            elif body is None:
+                self.s3_objects[failure_key] = b"Input location not found"
+            else:
+                self.s3_objects[output_key] = json.dumps(sagemaker_response(endpoint_name, body)).encode()
+        threading.Timer(self.async_inference_seconds, complete).start()
+        return "sagemaker", 202, "application/json", json.dumps({"InferenceId": inference_id}).encode(), {
+            "X-Amzn-SageMaker-OutputLocation": f"s3://{output_key}",
+            "X-Amzn-SageMaker-FailureLocation": f"s3://{failure_key}"
+        }
+
+    def make_handler(self):
+        backend = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def handle_request(self):
+                start = time.perf_counter()
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                # routes return (service, status, content_type, payload), optionally with response headers
+                service, status, content_type, payload, *extra_headers = backend.route(self.command, self.path, self.headers, body)
+                time.sleep(backend.latency.sample_ms() / 1000.0)
+                if status in [200, 202] and backend.latency.throttled():
+                    status = 429 if service in ["ai21", "anthropic"] else 400
+                    content_type = "application/json"
+                    payload = json.dumps({"__type": "ThrottlingException", "message": "Rate exceeded"}).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(payload)))
+                for name, value in (extra_headers[0] if extra_headers else {}).items():
+                    self.send_header(name, value)
+                if service == "bedrock" and status == 200:
+                    # Bedrock reports token counts in response headers, for every provider
+                    self.send_header("x-amzn-bedrock-input-token-count", str(len(body) // 4))
+                    self.send_header("x-amzn-bedrock-output-token-count", "20")
+                if status >= 400:
+                    self.send_header("x-amzn-ErrorType", "ThrottlingException" if b"Throttling" in payload else "ResourceNotFoundException")
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(payload)
+                # botocore numbers the attempts of each request
+                attempt = re.search(r"attempt=(\d+)", self.headers.get("amz-sdk-request", ""))
+                backend.record(service, time.perf_counter() - start, status, int(attempt.group(1)) if attempt else 1)
+
+            do_GET = handle_request
+            do_POST = handle_request
+            do_PUT = handle_request
+            do_HEAD = handle_request
+
+        return Handler
+
+
+def stub_environment(url):
+    """
+    Environment variables that point every plugin Lambda at the stub backend.
+    """
+    return {
+        "AWS_REGION": "us-east-1",
+        "AWS_DEFAULT_REGION": "us-east-1",
+        "AWS_ACCESS_KEY_ID": "testing",
+        "AWS_SECRET_ACCESS_KEY": "testing",
+        "AWS_SESSION_TOKEN": "testing",
+        "ENDPOINT_URL": url,
+        "AMAZONQ_ENDPOINT_URL": url,
+        "AMAZONQ_APP_ID": "00000000-0000-4000-8000-000000000000",
+        "API_KEY_SECRET_NAME": "stub",
+        "AWS_ENDPOINT_URL_SAGEMAKER_RUNTIME": url,
+        "AWS_ENDPOINT_URL_S3": url,
+        "AWS_ENDPOINT_URL_SECRETS_MANAGER": url,
+        "AWS_ENDPOINT_URL_QBUSINESS": url
+    }
@@ -0,0 +1,130 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Query latency of the Bedrock LambdaHook's local vector index against corpus size. For each size, a
+synthetic clustered corpus is written in the bulk embedding output format and indexed, then the same
+queries are run with an exhaustive search and, for larger corpora, with IVF partitions. Reports
+p50/p99 query latency, index size, and the recall of the IVF search against the exhaustive one.
+
+Requires numpy.
+
+Usage:
+  python benchmarks/vector_index_benchmark.py [--sizes 1000,10000,100000] [--dimensions 1536]
+      [--dtype float32] [--queries 100] [--top-k 3] [--nprobe 8] [--output results.json]
+"""
+
+import argparse
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+
+from handler_benchmark import percentile
+from handlers import LAMBDAS_DIR
+
+# clusters in the synthetic corpus, relative to its size - real corpora have topics, not uniform noise
+ITEMS_PER_CLUSTER = 50
+# corpora smaller than this are only searched exhaustively
+IVF_MIN_ROWS = 10000
+
+
+def write_corpus(output_dir, rows, dimensions, dtype, seed=0):
+    # vectors around random cluster centers, in the bulk_embeddings.py output format
+    import numpy as np
+    random = np.random.default_rng(seed)
+    centers = random.standard_normal((max(1, rows // ITEMS_PER_CLUSTER), dimensions)).astype(np.float32)
+    suffix = {"float32": "f32", "float16": "f16"}[dtype]
+    vectors = np.memmap(os.path.join(output_dir, f"vectors.{suffix}"), dtype=dtype, mode="w+", shape=(rows, dimensions))
+    for start in range(0, rows, 10000):
+        end = min(start + 10000, rows)
+        vectors[start:end] = centers[random.integers(0, len(centers), end - start)] + 0.5 * random.standard_normal((end - start, dimensions), dtype=np.float32)
+    vectors.flush()
+    manifest = {"model_id": "amazon.titan-embed-text-v1", "dtype": dtype, "dimensions": dimensions, "rows": rows, "items": {str(row): [row, ""] for row in range(rows)}}
+    with open(os.path.join(output_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f)
+    with open(os.path.join(output_dir, "ids.json"), "w") as f:
+        json.dump([str(row) for row in range(rows)], f)
+    return vectors
+
+def time_queries(index, queries, top_k, nprobe):
+    latencies = []
+    results = []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(index.search(query, top_k, nprobe))
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies, results
+
+def recall(results, expected):
+    found = sum(len({row for row, _ in got} & {row for row, _ in want}) for got, want in zip(results, expected))
+    return round(found / max(1, sum(len(want) for want in expected)), 3)
+
+def benchmark_size(vector_index, rows, args):
+    import numpy as np
+    with tempfile.TemporaryDirectory() as output_dir:
+        vectors = write_corpus(output_dir, rows, args.dimensions, args.dtype)
+        random = np.random.default_rng(1)
+        # queries near corpus items, as real questions are near their answers
+        queries = [np.asarray(vectors[row], dtype=np.float32) + 0.1 * random.standard_normal(args.dimensions, dtype=np.float32) for row in random.integers(0, rows, args.queries)]
+        partitions = int(math.sqrt(rows)) if rows >= IVF_MIN_ROWS else 0
+        start = time.perf_counter()
+        vector_index.build_index(output_dir, partitions=partitions)
+        build_seconds = time.perf_counter() - start
+        index = vector_index.VectorIndex(output_dir)
+        # first pass pages the matrix in, as the first requests of a sandbox would
+        time_queries(index, queries[:5], args.top_k, 0)
+        exact_latencies, exact_results = time_queries(index, queries, args.top_k, 0)
+        result = {
+            "rows": rows,
+            "index_mib": round(vectors.nbytes / 1024 / 1024, 1),
+            "build_s": round(build_seconds, 2),
+            "exact_p50_ms": round(percentile(exact_latencies, 50), 3),
+            "exact_p99_ms": round(percentile(exact_latencies, 99), 3),
+            "partitions": partitions,
+            "ivf_p50_ms": None,
+            "ivf_p99_ms": None,
+            "ivf_recall": None
+        }
+        if partitions:
+            ivf_latencies, ivf_results = time_queries(index, queries, args.top_k, args.nprobe)
+            result.update({
+                "ivf_p50_ms": round(percentile(ivf_latencies, 50), 3),
+                "ivf_p99_ms": round(percentile(ivf_latencies, 99), 3),
+                "ivf_recall": recall(ivf_results, exact_results)
+            })
+        del index, vectors
+        return result
+
+def print_table(results):
+    columns = ["index_mib", "build_s", "exact_p50_ms", "exact_p99_ms", "partitions", "ivf_p50_ms", "ivf_p99_ms", "ivf_recall"]
+    print(f"{'rows':>10}" + "".join(f"{c:>14}" for c in columns))
+    for result in results:
+        print(f"{result['rows']:>10}" + "".join(f"{str(result.get(c)):>14}" for c in columns))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,10000,100000", help="comma separated corpus sizes (rows)")
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--dtype", choices=["float32", "float16"], default="float32")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--nprobe", type=int, default=8, help="IVF partitions searched per query")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault("AWS_REGION", "us-east-1")
+    sys.path.insert(0, os.path.join(LAMBDAS_DIR, "bedrock-embeddings-and-llm", "src"))
+    import vector_index
+    results = [benchmark_size(vector_index, int(size), args) for size in args.sizes.split(",")]
+    print_table(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,147 @@
+import asyncio
+import json
+import os
+import time
+import aio
+import log
+import metrics
+import prompt_template
+import usage
+
+# Defaults
+# concurrent calls per model in batch mode - keep below the model's throttling limit
+BATCH_MAX_CONCURRENCY = int(os.environ.get("BATCH_MAX_CONCURRENCY") or 4)
+BATCH_MAX_PROMPTS = int(os.environ.get("BATCH_MAX_PROMPTS") or 100)
+# optional deadline for the whole batch - otherwise the Lambda timeout, less time to return the results
+BATCH_TIMEOUT_SECONDS = float(os.environ.get("BATCH_TIMEOUT_SECONDS") or 0)
+BATCH_DEADLINE_MARGIN_SECONDS = 3
+# models that accept several prompts per request (SageMaker endpoints) get packs of up to BATCH_PACK_MAX_PROMPTS
+# prompts, with up to BATCH_PACK_MAX_TOKENS (estimated) input and max_new_tokens output tokens in all
+BATCH_PACK_MAX_PROMPTS = int(os.environ.get("BATCH_PACK_MAX_PROMPTS") or 8)
+BATCH_PACK_MAX_TOKENS = int(os.environ.get("BATCH_PACK_MAX_TOKENS") or 8192)
+
+
+def get_items(event):
+    """
+    Returns a list of (parameters, prompt) from a batch request, e.g.
+    {"prompts": ["...", {"prompt": "...", "parameters": {"temperature": 0.5}}], "parameters": {"temperature": 0}}
+    where the parameters of a prompt are merged over the shared parameters.
+    """
+    prompts = event["prompts"]
+    if not isinstance(prompts, list):
+        raise Exception("prompts must be a list")
+    if len(prompts) > BATCH_MAX_PROMPTS:
+        raise Exception(f"Too many prompts: {len(prompts)} > {BATCH_MAX_PROMPTS}")
+    shared = event.get("parameters", {})
+    items = []
+    for prompt in prompts:
+        parameters = dict(shared)
+        if isinstance(prompt, dict):
+            parameters.update(prompt.get("parameters", {}))
+            prompt = prompt["prompt"]
+        # QnABot fills in the prompt template placeholders - only expand any remaining <br> markup
+        items.append((parameters, prompt_template.expand_markup(prompt)))
+    return items
+
+def get_deadline(context):
+    remaining = context.get_remaining_time_in_millis() / 1000 - BATCH_DEADLINE_MARGIN_SECONDS if context is not None else None
+    timeouts = [seconds for seconds in [remaining, BATCH_TIMEOUT_SECONDS or None] if seconds is not None]
+    return time.monotonic() + min(timeouts) if timeouts else None
+
+def get_packs(items, get_model_id):
+    """
+    Groups the items into packs of consecutive prompts for the same model with the same parameters, within
+    BATCH_PACK_MAX_PROMPTS and BATCH_PACK_MAX_TOKENS. Returns a list of lists of item indexes.
+    """
+    packs = []
+    open_packs = {}
+    for index, (parameters, prompt) in enumerate(items):
+        key = (get_model_id(parameters), json.dumps(parameters, sort_keys=True))
+        tokens = usage.estimate_tokens(prompt) + int(parameters.get("max_new_tokens") or 0)
+        pack = open_packs.get(key)
+        if pack is None or len(pack["indexes"]) >= BATCH_PACK_MAX_PROMPTS or pack["tokens"] + tokens > BATCH_PACK_MAX_TOKENS:
+            pack = {"indexes": [], "tokens": 0}
+            packs.append(pack)
+            open_packs[key] = pack
+        pack["indexes"].append(index)
+        pack["tokens"] += tokens
+    return [pack["indexes"] for pack in packs]
+
+async def run_batch(items, generate, get_model_id, deadline=None, generate_packed=None):
+    """
+    Runs the coroutine generate(parameters, prompt) for every item, at most BATCH_MAX_CONCURRENCY at a time
+    per model, until the deadline. Returns one result per item, in order: the generated text or an error,
+    with the elapsed time and token usage.
+    With generate_packed(parameters, prompts), which returns one generated text per prompt from a single
+    model request, items are run in packs (see get_packs) - a pack that fails is retried one prompt at a time.
+    """
+    semaphores = {model: asyncio.Semaphore(BATCH_MAX_CONCURRENCY) for model in {get_model_id(parameters) for parameters, _ in items}}
+    async def run(item):
+        parameters, prompt = item
+        async with semaphores[get_model_id(parameters)]:
+            start = time.perf_counter()
+            with usage.collect() as records:
+                try:
+                    result = {"generated_text": await generate(dict(parameters), prompt)}
+                except Exception as e:
+                    log.warning("Batch prompt failed", error=e)
+                    result = {"error": f"{type(e).__name__}: {e}"}
+            result["elapsed_ms"] = metrics.elapsed_ms(start)
+            result["usage"] = usage.sum_usage(records)
+            return result
+    async def run_pack(indexes):
+        if len(indexes) == 1:
+            return [await run(items[indexes[0]])]
+        parameters = items[indexes[0]][0]
+        prompts = [items[index][1] for index in indexes]
+        async with semaphores[get_model_id(parameters)]:
+            start = time.perf_counter()
+            with usage.collect() as records:
+                try:
+                    generated_texts = await generate_packed(dict(parameters), prompts)
+                except Exception as e:
+                    log.warning("Packed prompts failed - retrying one at a time", prompts=len(prompts), error=e)
+                    generated_texts = None
+            elapsed_ms = metrics.elapsed_ms(start)
+        if generated_texts is None:
+            metrics.emit_metric("BatchPackFallbacks", 1)
+            return await asyncio.gather(*[run(items[index]) for index in indexes])
+        # generate_packed records the usage of each prompt, in order
+        return [{"generated_text": generated_text, "elapsed_ms": elapsed_ms, "usage": usage.sum_usage(records[n:n + 1])} for n, generated_text in enumerate(generated_texts)]
+    if not items:
+        return []
+    packs = get_packs(items, get_model_id) if generate_packed else [[index] for index in range(len(items))]
+    if generate_packed:
+        metrics.emit_metric("BatchPacks", len(packs))
+    tasks = [asyncio.ensure_future(run_pack(indexes)) for indexes in packs]
+    _, pending = await asyncio.wait(tasks, timeout=None if deadline is None else max(0, deadline - time.monotonic()))
+    # prompts still waiting or running at the deadline are cancelled
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    results = [None] * len(items)
+    for task, indexes in zip(tasks, packs):
+        pack_results = task.result() if task.done() and not task.cancelled() else [{"error": "Deadline exceeded"} for _ in indexes]
+        for index, result in zip(indexes, pack_results):
+            results[index] = result
+    return results
+
+def handle(event, context, generate, get_model_id, generate_packed=None):
+    """
+    Batch mode of an LLM lambda_handler: {"prompts": [...]} returns {"results": [...]}, in the same order.
+    generate is a coroutine function - the prompts share the sandbox's event loop. generate_packed is
+    optional, for models that generate several prompts per request.
+    """
+    with metrics.timer("Parse"):
+        items = get_items(event)
+    metrics.emit_metric("BatchSize", len(items))
+    results = aio.run(run_batch(items, generate, get_model_id, get_deadline(context), generate_packed))
+    errors = sum(1 for result in results if "error" in result)
+    metrics.emit_metric("BatchErrors", errors)
+    log.info("Batch results", prompts=len(results), errors=errors)
+    response = {
+        'results': results
+    }
+    if usage.RETURN_USAGE:
+        response['usage'] = usage.get_totals()
+    return response
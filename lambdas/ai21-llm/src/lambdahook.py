@@ -1,8 +1,14 @@
 import os
 import json
-import urllib3
-import boto3
-from botocore.exceptions import ClientError
+import aio
+import clients
+import log
+import metrics
+import profiling
+import tracing
+import prompt_template
+import usage
+import warmup
 
 # Defaults
 API_KEY_SECRET_NAME = os.environ['API_KEY_SECRET_NAME']
@@ -10,20 +16,13 @@ DEFAULT_MODEL_TYPE = os.environ.get("DEFAULT_MODEL_TYPE","j2-mid")
 ENDPOINT_URL = os.environ.get("ENDPOINT_URL", "https://api.ai21.com/studio/v1/{MODEL_TYPE}/complete")
 MAX_TOKENS = 256
 
-def get_secret(secret_name):
-    print("Getting API key from Secrets Manager")
-    secrets_client = boto3.client('secretsmanager')
-    try:
-        response = secrets_client.get_secret_value(
-            SecretId=secret_name
-        )
-    except ClientError as e:
-        raise e
-    api_key = response['SecretString']
-    return api_key
+def warm_up():
+    # prefetch the API key and open a pooled connection to the API endpoint
+    clients.get_secret(API_KEY_SECRET_NAME)
+    clients.open_http_connection(ENDPOINT_URL.format(MODEL_TYPE=DEFAULT_MODEL_TYPE))
 
-def get_llm_response(parameters, prompt):
-    api_key = get_secret(API_KEY_SECRET_NAME)
+async def get_llm_response_async(parameters, prompt):
+    api_key = await aio.get_secret(API_KEY_SECRET_NAME)
     # Default parameters
     data = {
         "maxTokens": MAX_TOKENS
@@ -37,32 +36,51 @@ def get_llm_response(parameters, prompt):
     }
     # Endpoint URL is a template, so we need to replace the model type with the one specified in parameters
     endpoint_url = ENDPOINT_URL.format(MODEL_TYPE=parameters.get("model_type", DEFAULT_MODEL_TYPE))
-    http = urllib3.PoolManager()
+    metrics.set_dimensions(ModelId=parameters.get("model_type", DEFAULT_MODEL_TYPE), Provider="ai21", StreamMode="false")
     try:
-        response = http.request(
-            "POST",
-            endpoint_url,
-            body=json.dumps(data),
-            headers=headers
-        )
+        body = json.dumps(data)
+        attributes = {"gen_ai.system": "ai21", "gen_ai.request.model": parameters.get("model_type", DEFAULT_MODEL_TYPE), "gen_ai.prompt.size": len(body)}
+        with metrics.timer("ModelInvoke"), tracing.span("ai21.complete", attributes) as span:
+            response = await aio.request(
+                "POST",
+                endpoint_url,
+                body=body,
+                headers=headers
+            )
+            if span is not None:
+                span.set_attributes({"http.response.status_code": response.status, "http.response.body.size": len(response.data), "http.request.resend_count": len(response.retries.history) if response.retries else 0})
+                if response.status >= 300:
+                    # an error response, like a failed AWS API call
+                    span.record_exception(Exception(f"HTTP {response.status}"))
         if response.status != 200:
             raise Exception(f"Error: {response.status} - {response.data}")
-        generated_text = json.loads(response.data)["completions"][0]["data"]["text"].strip()
+        # responses are not streamed - the first token arrives with the response
+        metrics.first_token()
+        with metrics.timer("ResponseDecode"):
+            response_body = json.loads(response.data)
+            generated_text = response_body["completions"][0]["data"]["text"].strip()
+        usage.record_usage(parameters.get("model_type", DEFAULT_MODEL_TYPE), prompt, generated_text, *usage.get_token_counts(response_body=response_body), max_tokens=data["maxTokens"])
         return generated_text
     except Exception as err:
-        print(err)
+        log.error("Model call failed", error=err)
         raise
 
+def get_llm_response(parameters, prompt):
+    return aio.run(get_llm_response_async(parameters, prompt))
+
+def replace_template_placeholders(prompt, event):
+    values = prompt_template.get_lambdahook_values(event)
+    return prompt_template.render(prompt, values)
+
 def get_args_from_lambdahook_args(event):
     parameters = {}
     lambdahook_args_list = event["res"]["result"].get("args",[])
-    print("LambdaHook args: ", lambdahook_args_list)
+    log.debug("LambdaHook args", args=lambdahook_args_list)
     if len(lambdahook_args_list):
         try:
             parameters = json.loads(lambdahook_args_list[0])
         except Exception as e:
-            print(f"Failed to parse JSON:", lambdahook_args_list[0], e)
-            print("..continuing")
+            log.warning("Failed to parse JSON - continuing", args=lambdahook_args_list[0], error=e)
     return parameters
 
 def format_response(event, llm_response, prefix):
@@ -89,15 +107,31 @@ def format_response(event, llm_response, prefix):
     event["res"]["got_hits"] = 1   
     return event
 
+@metrics.invocation
+@profiling.profiled
 def lambda_handler(event, context):
-    print("Received event: %s" % json.dumps(event))
-    # args = {"Prefix:"<Prefix|None>", "Model_params":{"max_tokens":256}, "Prompt":"<prompt>"}
-    args = get_args_from_lambdahook_args(event)
-    # prompt set from args, or from req.question if not specified in args.
-    prompt = args.get("Prompt", event["req"]["question"])
+    if warmup.is_warmup_event(event):
+        return warmup.handle(event, context, warm_up)
+    usage.reset()
+    with profiling.track_memory("event_dump"):
+        log.debug("Received event", event=event)
+    # logged with the metrics, to find the QnA items that cost the most
+    metrics.set_properties(QnAItemId=event["res"]["result"].get("qid"))
+    with metrics.timer("Parse"):
+        # args = {"Prefix:"<Prefix|None>", "Model_params":{"max_tokens":256}, "Prompt":"<prompt>"}
+        args = get_args_from_lambdahook_args(event)
+    with metrics.timer("PromptFormat"):
+        # prompt set from args (a template that may use placeholders), or from req.question if not specified in args.
+        prompt = args.get("Prompt")
+        if prompt:
+            prompt = replace_template_placeholders(prompt, event)
+        else:
+            prompt = event["req"]["question"]
     model_params = args.get("Model_params",{})
     llm_response = get_llm_response(model_params, prompt)
     prefix = args.get("Prefix","LLM Answer:")
-    event = format_response(event, llm_response, prefix)
-    print("Returning response: %s" % json.dumps(event))
+    with metrics.timer("ResponseFormat"):
+        event = format_response(event, llm_response, prefix)
+    with profiling.track_memory("response_dump"):
+        log.debug("Returning response", event=event)
     return event
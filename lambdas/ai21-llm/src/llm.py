@@ -1,8 +1,15 @@
 import os
 import json
-import urllib3
-import boto3
-from botocore.exceptions import ClientError
+import aio
+import batch
+import clients
+import log
+import metrics
+import profiling
+import tracing
+import prompt_template
+import usage
+import warmup
 
 # Defaults
 API_KEY_SECRET_NAME = os.environ['API_KEY_SECRET_NAME']
@@ -10,20 +17,16 @@ DEFAULT_MODEL_TYPE = os.environ.get("DEFAULT_MODEL_TYPE","j2-mid")
 ENDPOINT_URL = os.environ.get("ENDPOINT_URL", "https://api.ai21.com/studio/v1/{MODEL_TYPE}/complete")
 MAX_TOKENS = 256
 
-def get_secret(secret_name):
-    print("Getting API key from Secrets Manager")
-    secrets_client = boto3.client('secretsmanager')
-    try:
-        response = secrets_client.get_secret_value(
-            SecretId=secret_name
-        )
-    except ClientError as e:
-        raise e
-    api_key = response['SecretString']
-    return api_key
+def warm_up():
+    # prefetch the API key and open a pooled connection to the API endpoint
+    clients.get_secret(API_KEY_SECRET_NAME)
+    clients.open_http_connection(ENDPOINT_URL.format(MODEL_TYPE=DEFAULT_MODEL_TYPE))
 
-def call_llm(parameters, prompt):
-    api_key = get_secret(API_KEY_SECRET_NAME)
+def get_model_id(parameters):
+    return parameters.get("model_type", DEFAULT_MODEL_TYPE)
+
+async def call_llm_async(parameters, prompt):
+    api_key = await aio.get_secret(API_KEY_SECRET_NAME)
     # Default parameters
     data = {
         "maxTokens": MAX_TOKENS
@@ -37,22 +40,38 @@ def call_llm(parameters, prompt):
     }
     # Endpoint URL is a template, so we need to replace the model type with the one specified in parameters
     endpoint_url = ENDPOINT_URL.format(MODEL_TYPE=parameters.get("model_type", DEFAULT_MODEL_TYPE))
-    http = urllib3.PoolManager()
+    metrics.set_dimensions(ModelId=parameters.get("model_type", DEFAULT_MODEL_TYPE), Provider="ai21", StreamMode="false")
     try:
-        response = http.request(
-            "POST",
-            endpoint_url,
-            body=json.dumps(data),
-            headers=headers
-        )
+        body = json.dumps(data)
+        attributes = {"gen_ai.system": "ai21", "gen_ai.request.model": parameters.get("model_type", DEFAULT_MODEL_TYPE), "gen_ai.prompt.size": len(body)}
+        with metrics.timer("ModelInvoke"), tracing.span("ai21.complete", attributes) as span:
+            response = await aio.request(
+                "POST",
+                endpoint_url,
+                body=body,
+                headers=headers
+            )
+            if span is not None:
+                span.set_attributes({"http.response.status_code": response.status, "http.response.body.size": len(response.data), "http.request.resend_count": len(response.retries.history) if response.retries else 0})
+                if response.status >= 300:
+                    # an error response, like a failed AWS API call
+                    span.record_exception(Exception(f"HTTP {response.status}"))
         if response.status != 200:
             raise Exception(f"Error: {response.status} - {response.data}")
-        generated_text = json.loads(response.data)["completions"][0]["data"]["text"].strip()
+        # responses are not streamed - the first token arrives with the response
+        metrics.first_token()
+        with metrics.timer("ResponseDecode"):
+            response_body = json.loads(response.data)
+            generated_text = response_body["completions"][0]["data"]["text"].strip()
+        usage.record_usage(parameters.get("model_type", DEFAULT_MODEL_TYPE), prompt, generated_text, *usage.get_token_counts(response_body=response_body), max_tokens=data["maxTokens"])
         return generated_text
     except Exception as err:
-        print(err)
+        log.error("Model call failed", error=err)
         raise
 
+def call_llm(parameters, prompt):
+    return aio.run(call_llm_async(parameters, prompt))
+
 """
 Example Test Event:
 {
@@ -62,15 +81,33 @@ Example Test Event:
     "temperature": 0
   }
 }
+Batch mode - prompts are run concurrently, and results are returned in order:
+{
+  "prompts": ["Why is the sky blue?\nAssistant:", "Why is grass green?\nAssistant:"],
+  "parameters": {"model_type": "j2-mid", "temperature": 0}
+}
 For supported parameters, see the link to AI21 docs: https://docs.ai21.com/reference/j2-complete-ref
 """
+@metrics.invocation
+@profiling.profiled
 def lambda_handler(event, context):
-    print("Event: ", json.dumps(event))
+    if warmup.is_warmup_event(event):
+        return warmup.handle(event, context, warm_up)
+    usage.reset()
+    with profiling.track_memory("event_dump"):
+        log.debug("Event", event=event)
+    if "prompts" in event:
+        return batch.handle(event, context, call_llm_async, get_model_id)
     global secret
-    prompt = event["prompt"]
-    parameters = event["parameters"] 
+    with metrics.timer("Parse"):
+        # QnABot fills in the prompt template placeholders - only expand any remaining <br> markup
+        prompt = prompt_template.expand_markup(event["prompt"])
+        parameters = event["parameters"] 
     generated_text = call_llm(parameters, prompt)
-    print("Result:", json.dumps(generated_text))
-    return {
+    log.info("Result", generated_text=generated_text)
+    response = {
         'generated_text': generated_text
     }
+    if usage.RETURN_USAGE:
+        response['usage'] = usage.get_totals()
+    return response
@@ -1,8 +1,15 @@
 import os
 import json
-import urllib3
-import boto3
-from botocore.exceptions import ClientError
+import aio
+import batch
+import clients
+import log
+import metrics
+import profiling
+import tracing
+import prompt_template
+import usage
+import warmup
 
 # Defaults
 API_KEY_SECRET_NAME = os.environ['API_KEY_SECRET_NAME']
@@ -10,20 +17,16 @@ ENDPOINT_URL = os.environ.get("ENDPOINT_URL", "https://api.anthropic.com/v1/comp
 DEFAULT_MODEL = os.environ.get("DEFAULT_MODEL","claude-instant-1")
 MAX_TOKENS_TO_SAMPLE = 256
 
-def get_secret(secret_name):
-    print("Getting API key from Secrets Manager")
-    secrets_client = boto3.client('secretsmanager')
-    try:
-        response = secrets_client.get_secret_value(
-            SecretId=secret_name
-        )
-    except ClientError as e:
-        raise e
-    api_key = response['SecretString']
-    return api_key
+def warm_up():
+    # prefetch the API key and open a pooled connection to the API endpoint
+    clients.get_secret(API_KEY_SECRET_NAME)
+    clients.open_http_connection(ENDPOINT_URL)
 
-def call_llm(parameters, prompt):
-    api_key = get_secret(API_KEY_SECRET_NAME)
+def get_model_id(parameters):
+    return parameters.get("model", DEFAULT_MODEL)
+
+async def call_llm_async(parameters, prompt):
+    api_key = await aio.get_secret(API_KEY_SECRET_NAME)
     # # Default parameters
     data = {
         "max_tokens_to_sample": MAX_TOKENS_TO_SAMPLE,
@@ -31,28 +34,45 @@ def call_llm(parameters, prompt):
     }
     data.update(parameters)
     data["prompt"] = prompt
+    metrics.set_dimensions(ModelId=data["model"], Provider="anthropic", StreamMode="false")
     headers = {
         "anthropic-version": "2023-06-01", 
         "x-api-key": api_key,
         "content-type": "application/json",
         "accept": "application/json"
     }
-    http = urllib3.PoolManager()
     try:
-        response = http.request(
-            "POST",
-            ENDPOINT_URL,
-            body=json.dumps(data),
-            headers=headers
-        )
+        body = json.dumps(data)
+        attributes = {"gen_ai.system": "anthropic", "gen_ai.request.model": data["model"], "gen_ai.prompt.size": len(body)}
+        with metrics.timer("ModelInvoke"), tracing.span("anthropic.complete", attributes) as span:
+            response = await aio.request(
+                "POST",
+                ENDPOINT_URL,
+                body=body,
+                headers=headers
+            )
+            if span is not None:
+                span.set_attributes({"http.response.status_code": response.status, "http.response.body.size": len(response.data), "http.request.resend_count": len(response.retries.history) if response.retries else 0})
+                if response.status >= 300:
+                    # an error response, like a failed AWS API call
+                    span.record_exception(Exception(f"HTTP {response.status}"))
         if response.status != 200:
             raise Exception(f"Error: {response.status} - {response.data}")
-        generated_text = json.loads(response.data)["completion"].strip()
+        # responses are not streamed - the first token arrives with the response
+        metrics.first_token()
+        with metrics.timer("ResponseDecode"):
+            response_body = json.loads(response.data)
+            generated_text = response_body["completion"].strip()
+        # the text completions API doesn't report token counts - they are estimated
+        usage.record_usage(data["model"], prompt, generated_text, *usage.get_token_counts(response_body=response_body), max_tokens=data["max_tokens_to_sample"])
         return generated_text
     except Exception as err:
-        print(err)
+        log.error("Model call failed", error=err)
         raise
 
+def call_llm(parameters, prompt):
+    return aio.run(call_llm_async(parameters, prompt))
+
 """
 Example Test Event:
 {
@@ -62,15 +82,33 @@ Example Test Event:
     "temperature": 0
   }
 }
+Batch mode - prompts are run concurrently, and results are returned in order:
+{
+  "prompts": ["\n\nHuman:Why is the sky blue?\n\nAssistant:", "\n\nHuman:Why is grass green?\n\nAssistant:"],
+  "parameters": {"model": "claude-instant-1", "temperature": 0}
+}
 For supported parameters, see the link to Anthropic docs: https://docs.anthropic.com/claude/reference/complete_post
 """
+@metrics.invocation
+@profiling.profiled
 def lambda_handler(event, context):
-    print("Event: ", json.dumps(event))
+    if warmup.is_warmup_event(event):
+        return warmup.handle(event, context, warm_up)
+    usage.reset()
+    with profiling.track_memory("event_dump"):
+        log.debug("Event", event=event)
+    if "prompts" in event:
+        return batch.handle(event, context, call_llm_async, get_model_id)
     global secret
-    prompt = event["prompt"]
-    parameters = event["parameters"] 
+    with metrics.timer("Parse"):
+        # QnABot fills in the prompt template placeholders - only expand any remaining <br> markup
+        prompt = prompt_template.expand_markup(event["prompt"])
+        parameters = event["parameters"] 
     generated_text = call_llm(parameters, prompt)
-    print("Result:", json.dumps(generated_text))
-    return {
+    log.info("Result", generated_text=generated_text)
+    response = {
         'generated_text': generated_text
     }
+    if usage.RETURN_USAGE:
+        response['usage'] = usage.get_totals()
+    return response
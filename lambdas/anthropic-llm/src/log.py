@@ -0,0 +1,65 @@
+import json
+import os
+
+# Defaults
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+LOG_LEVEL = (os.environ.get("LOG_LEVEL") or os.environ.get("AWS_LAMBDA_LOG_LEVEL") or "INFO").upper()
+# strings longer than this are truncated, and lists are cut to LOG_MAX_ITEMS items
+LOG_MAX_FIELD_LENGTH = int(os.environ.get("LOG_MAX_FIELD_LENGTH") or 1000)
+LOG_MAX_ITEMS = int(os.environ.get("LOG_MAX_ITEMS") or 20)
+LOG_MAX_DEPTH = 8
+# values of these keys are never logged (compared in lower case)
+REDACTED_KEYS = {"authorization", "x-api-key", "api_key", "apikey", "secretstring", "secret", "password", "token", "sessiontoken"}
+
+
+def is_enabled(level):
+    return LEVELS[level] >= LEVELS.get(LOG_LEVEL, LEVELS["INFO"])
+
+def sanitize(value, depth=0):
+    """
+    Returns a copy of value that is safe and small to log: long strings and lists are truncated,
+    binary data is replaced by its size, and secrets are redacted.
+    """
+    if isinstance(value, str):
+        if len(value) > LOG_MAX_FIELD_LENGTH:
+            return f"{value[:LOG_MAX_FIELD_LENGTH]}...[truncated {len(value) - LOG_MAX_FIELD_LENGTH} chars]"
+        return value
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, (bytes, bytearray)):
+        return f"[{len(value)} bytes]"
+    if depth >= LOG_MAX_DEPTH:
+        return "[...]"
+    if isinstance(value, dict):
+        return {str(key): "[REDACTED]" if str(key).lower() in REDACTED_KEYS else sanitize(item, depth + 1) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        items = [sanitize(item, depth + 1) for item in value[:LOG_MAX_ITEMS]]
+        if len(value) > LOG_MAX_ITEMS:
+            items.append(f"[{len(value) - LOG_MAX_ITEMS} more items]")
+        return items
+    if isinstance(value, BaseException):
+        return f"{type(value).__name__}: {sanitize(str(value), depth + 1)}"
+    # e.g. a botocore StreamingBody
+    return f"[{type(value).__name__}]"
+
+def log(level, message, fields):
+    if not is_enabled(level):
+        # nothing is serialized for disabled levels
+        return
+    record = {"level": level, "message": message}
+    for key, value in fields.items():
+        # callables are evaluated lazily, e.g. log.debug("Prompt", prompt=lambda: format_prompt(...))
+        record[key] = "[REDACTED]" if key.lower() in REDACTED_KEYS else sanitize(value() if callable(value) else value)
+    print(json.dumps(record))
+
+def debug(message, **fields):
+    log("DEBUG", message, fields)
+
+def info(message, **fields):
+    log("INFO", message, fields)
+
+def warning(message, **fields):
+    log("WARNING", message, fields)
+
+def error(message, **fields):
+    log("ERROR", message, fields)
@@ -0,0 +1,113 @@
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import time
+
+# Defaults
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "QnABotPlugins")
+# dimensions emitted with every invocation's metrics, in this order, when set
+DIMENSION_NAMES = ["ModelId", "Provider", "CacheHit", "StreamMode"]
+
+# global variables - metrics recorded during the current invocation, flushed once when it ends
+invocation_start = None
+dimensions = {}
+values = {}
+# searchable, high cardinality values logged with the metrics but not used as dimensions, e.g. QnAItemId
+properties = {}
+# duration of the last run of each timed stage in the current thread or asyncio task, in milliseconds - kept per task,
+# so that concurrent model calls (e.g. batch mode) each see their own ModelInvoke time
+last_elapsed = contextvars.ContextVar("last_elapsed", default={})
+
+
+def emit_metric(name, value, unit="Count"):
+    # buffered during an invocation - otherwise logged right away
+    if invocation_start is None:
+        print(json.dumps(get_document({name: ([value], unit)}, {})))
+        return
+    values.setdefault(name, ([], unit))[0].append(value)
+
+def set_dimensions(**kwargs):
+    # e.g. set_dimensions(ModelId=modelId, Provider=provider)
+    dimensions.update({name: str(value) for name, value in kwargs.items() if value is not None})
+
+def set_properties(**kwargs):
+    properties.update({name: value for name, value in kwargs.items() if value is not None})
+
+def elapsed_ms(start):
+    return round((time.perf_counter() - start) * 1000, 3)
+
+@contextlib.contextmanager
+def timer(stage):
+    """
+    Records the time spent in a stage of the invocation, e.g. with timer("ModelInvoke"): ...
+    as the metric <stage>Time, in milliseconds.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = elapsed_ms(start)
+        last_elapsed.set({**last_elapsed.get(), stage: elapsed})
+        emit_metric(f"{stage}Time", elapsed, "Milliseconds")
+
+def get_last_elapsed(stage):
+    # e.g. get_last_elapsed("ModelInvoke")
+    return last_elapsed.get().get(stage)
+
+def first_token():
+    # time from the start of the invocation until the first generated token is available
+    if invocation_start is not None and "TimeToFirstToken" not in values:
+        emit_metric("TimeToFirstToken", elapsed_ms(invocation_start), "Milliseconds")
+
+def get_document(metric_values, metric_dimensions, metric_properties=None):
+    # CloudWatch Embedded Metric Format - logged metrics are extracted by CloudWatch Logs
+    dimension_set = [name for name in DIMENSION_NAMES if name in metric_dimensions]
+    document = {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": METRICS_NAMESPACE,
+                # metrics are aggregated per dimension set, and across all invocations
+                "Dimensions": [dimension_set, []] if dimension_set else [[]],
+                "Metrics": [{"Name": name, "Unit": unit} for name, (_, unit) in metric_values.items()]
+            }]
+        }
+    }
+    document.update(metric_properties or {})
+    document.update(metric_dimensions)
+    document.update({name: value_list[0] if len(value_list) == 1 else value_list for name, (value_list, _) in metric_values.items()})
+    return document
+
+def start_invocation():
+    global invocation_start
+    invocation_start = time.perf_counter()
+    dimensions.clear()
+    values.clear()
+    properties.clear()
+
+def flush():
+    global invocation_start
+    if invocation_start is None:
+        return
+    emit_metric("TotalTime", elapsed_ms(invocation_start), "Milliseconds")
+    invocation_start = None
+    print(json.dumps(get_document(values, dimensions, properties)))
+    dimensions.clear()
+    values.clear()
+    properties.clear()
+
+def invocation(lambda_handler):
+    """
+    Decorates a lambda_handler, so that the metrics recorded during each invocation are logged
+    as a single EMF line when it returns or raises.
+    """
+    @functools.wraps(lambda_handler)
+    def wrapper(event, context):
+        start_invocation()
+        try:
+            return lambda_handler(event, context)
+        finally:
+            flush()
+    return wrapper
@@ -0,0 +1,147 @@
+import contextlib
+import functools
+import json
+import os
+import random
+import time
+import log
+
+# Defaults
+PROFILING_ENABLED = (os.environ.get("PROFILING_ENABLED") or "false").lower() == "true"
+# profile 1 in N invocations - an event with "profile": true is always profiled
+PROFILING_SAMPLE_RATE = int(os.environ.get("PROFILING_SAMPLE_RATE") or 100)
+# stop sampling while profiling has cost more than this fraction of the sandbox's total handler time
+PROFILING_OVERHEAD_BUDGET = float(os.environ.get("PROFILING_OVERHEAD_BUDGET") or 0.05)
+PROFILING_OUTPUT_DIR = os.environ.get("PROFILING_OUTPUT_DIR") or "/tmp/profiles"
+# optional copy of each profile, to an S3 bucket (s3://bucket/prefix) or a local directory
+PROFILING_UPLOAD_TARGET = os.environ.get("PROFILING_UPLOAD_TARGET")
+PROFILING_TOP_STATS = 10
+
+# global variables - per sandbox
+handler_seconds = 0.0
+unprofiled_seconds = 0.0
+unprofiled_count = 0
+overhead_seconds = 0.0
+# profiler and memory snapshots of the current profiled invocation, or None when not profiling
+profiler = None
+memory_reports = None
+
+
+def should_profile(event):
+    if isinstance(event, dict) and event.get("profile") is True:
+        return True
+    if not PROFILING_ENABLED or random.randrange(PROFILING_SAMPLE_RATE) != 0:
+        return False
+    if overhead_seconds > PROFILING_OVERHEAD_BUDGET * handler_seconds:
+        log.info("Profiling skipped - overhead budget used")
+        return False
+    return True
+
+@contextlib.contextmanager
+def track_memory(label):
+    """
+    Records the memory allocated in a block, e.g. around json.dumps(event), when the invocation is profiled.
+    """
+    if memory_reports is None:
+        yield
+        return
+    import tracemalloc
+    # snapshots are compared after the invocation, and are kept out of the CPU profile
+    profiler.disable()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        peak = tracemalloc.get_traced_memory()[1]
+        memory_reports.append((label, peak, before, tracemalloc.take_snapshot()))
+        profiler.enable()
+
+def get_memory_report(label, peak, before, after):
+    import tracemalloc
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+    top = after.filter_traces(filters).compare_to(before.filter_traces(filters), "lineno")[:PROFILING_TOP_STATS]
+    return {
+        "label": label,
+        "peak_kib": round(peak / 1024, 1),
+        "top": [{"location": str(stat.traceback), "size_diff_kib": round(stat.size_diff / 1024, 1), "count_diff": stat.count_diff} for stat in top]
+    }
+
+def upload(path):
+    name = os.path.basename(path)
+    if PROFILING_UPLOAD_TARGET.startswith("s3://"):
+        import clients
+        bucket, _, prefix = PROFILING_UPLOAD_TARGET[5:].partition("/")
+        key = f"{prefix.rstrip('/')}/{name}" if prefix else name
+        with open(path, "rb") as f:
+            clients.get_client("s3").put_object(Bucket=bucket, Key=key, Body=f.read())
+    else:
+        import shutil
+        os.makedirs(PROFILING_UPLOAD_TARGET, exist_ok=True)
+        shutil.copy(path, os.path.join(PROFILING_UPLOAD_TARGET, name))
+
+def write_profile(context, elapsed_seconds):
+    import io
+    import pstats
+    os.makedirs(PROFILING_OUTPUT_DIR, exist_ok=True)
+    function_name = os.environ.get("AWS_LAMBDA_FUNCTION_NAME") or getattr(context, "function_name", None) or "handler"
+    request_id = getattr(context, "aws_request_id", None) or str(int(time.time() * 1000))
+    base = os.path.join(PROFILING_OUTPUT_DIR, f"{function_name}-{request_id}")
+    # cProfile stats - open with pstats or snakeviz
+    profiler.dump_stats(base + ".prof")
+    summary = io.StringIO()
+    pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(PROFILING_TOP_STATS)
+    with open(base + ".json", "w") as f:
+        json.dump({"function": function_name, "request_id": request_id, "elapsed_ms": round(elapsed_seconds * 1000, 3), "memory": [get_memory_report(*report) for report in memory_reports], "cumulative": summary.getvalue()}, f, indent=2)
+    paths = [base + ".prof", base + ".json"]
+    if PROFILING_UPLOAD_TARGET:
+        for path in paths:
+            try:
+                upload(path)
+            except Exception as e:
+                log.warning("Failed to upload profile", path=path, error=e)
+    log.info("Profile written", paths=paths)
+
+def profiled(lambda_handler):
+    """
+    Decorates a lambda_handler, so that sampled invocations are profiled with cProfile and tracemalloc.
+    """
+    @functools.wraps(lambda_handler)
+    def wrapper(event, context):
+        global handler_seconds, unprofiled_seconds, unprofiled_count, overhead_seconds, profiler, memory_reports
+        start = time.perf_counter()
+        if not should_profile(event):
+            try:
+                return lambda_handler(event, context)
+            finally:
+                elapsed = time.perf_counter() - start
+                handler_seconds += elapsed
+                unprofiled_seconds += elapsed
+                unprofiled_count += 1
+        import cProfile
+        import tracemalloc
+        profiler = cProfile.Profile()
+        memory_reports = []
+        tracemalloc.start()
+        profiler.enable()
+        try:
+            return lambda_handler(event, context)
+        finally:
+            profiler.disable()
+            tracemalloc.stop()
+            handler_elapsed = time.perf_counter() - start
+            try:
+                write_profile(context, handler_elapsed)
+            except Exception as e:
+                # the handler's own result or error is returned - e.g. when /tmp is full
+                log.warning("Failed to write profile", error=e)
+            profiler = None
+            memory_reports = None
+            elapsed = time.perf_counter() - start
+            handler_seconds += elapsed
+            # overhead - time beyond a typical unprofiled invocation
+            typical = unprofiled_seconds / unprofiled_count if unprofiled_count else 0.0
+            overhead_seconds += max(0.0, elapsed - typical)
+    return wrapper
@@ -1,5 +1,7 @@
 import cfnresponse
 import json
+import log
+import profiling
 
 # Default prompt temnplates
 ANTHROPIC_GENERATE_QUERY_PROMPT_TEMPLATE = """<br><br>Human: Here is a chat history in <chatHistory> tags:<br><chatHistory><br>{history}<br></chatHistory><br>Human: And here is a follow up question or statement from the human in <followUpMessage> tags:<br><followUpMessage><br>{input}<br></followUpMessage><br>Human: Rephrase the follow up question or statement as a standalone question or statement that makes sense without reading the chat history.<br><br>Assistant: Here is the rephrased follow up question or statement:"""
@@ -34,8 +36,9 @@ def getModelSettings(model):
     
     return settings
 
+@profiling.profiled
 def lambda_handler(event, context): 
-    print("Event: ", json.dumps(event))
+    log.info("Event", event=event)
     status = cfnresponse.SUCCESS
     responseData = {}
     reason = ""
@@ -44,7 +47,7 @@ def lambda_handler(event, context):
             model = event['ResourceProperties'].get('Model', '')
             responseData = getModelSettings(model) 
         except Exception as e:
-            print(e)
+            log.error("Failed to get model settings", error=e)
             status = cfnresponse.FAILED
             reason = f"Exception thrown: {e}"              
     cfnresponse.send(event, context, status, responseData, reason=reason) 
\ No newline at end of file
@@ -0,0 +1,146 @@
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import log
+import metrics
+
+# Defaults
+# add the invocation's token usage and cost to the handler response, e.g. {"generated_text": "...", "usage": {...}}
+RETURN_USAGE = (os.environ.get("RETURN_USAGE") or "false").lower() == "true"
+# USD per 1000 input and output tokens, matched by the longest model id prefix - on-demand list prices, which change,
+# so override or extend them with MODEL_PRICES, e.g. {"anthropic.claude-3-sonnet": [0.003, 0.015], "my-endpoint": [0.001, 0.001]}
+DEFAULT_MODEL_PRICES = {
+    "anthropic.claude-instant": [0.0008, 0.0024],
+    "anthropic.claude-v2": [0.008, 0.024],
+    "anthropic.claude-3-sonnet": [0.003, 0.015],
+    "anthropic.claude-3-haiku": [0.00025, 0.00125],
+    "ai21.j2-mid": [0.0125, 0.0125],
+    "ai21.j2-ultra": [0.0188, 0.0188],
+    "amazon.titan-text-lite": [0.0003, 0.0004],
+    "amazon.titan-text-express": [0.0008, 0.0016],
+    "amazon.titan-embed-text": [0.0001, 0.0],
+    "cohere.command-light-text": [0.0003, 0.0006],
+    "cohere.command-text": [0.0015, 0.002],
+    "meta.llama2-13b-chat": [0.00075, 0.001],
+    "meta.llama2-70b-chat": [0.00195, 0.00256],
+    # AI21 and Anthropic APIs
+    "j2-mid": [0.01, 0.01],
+    "j2-ultra": [0.015, 0.015],
+    "claude-instant-1": [0.0008, 0.0024],
+    "claude-2": [0.008, 0.024]
+}
+MODEL_PRICES = {**DEFAULT_MODEL_PRICES, **json.loads(os.environ.get("MODEL_PRICES") or "{}")}
+
+# global variables - token usage of the current invocation, summed over all its model calls
+totals = {}
+totals_lock = threading.Lock()
+# usage records of the model calls made inside a collect() block, in the current thread or asyncio task
+collector = contextvars.ContextVar("collector", default=None)
+
+
+def estimate_tokens(text):
+    # about 4 characters per token, for models that don't report their token counts
+    return len(text) // 4 + 1 if text else 0
+
+def get_price(modelId):
+    # also matches Bedrock inference profile ids, e.g. us.anthropic.claude-sonnet-4-...
+    matches = [prefix for prefix in MODEL_PRICES if modelId.startswith(prefix) or modelId.partition(".")[2].startswith(prefix)]
+    return MODEL_PRICES[max(matches, key=len)] if matches else None
+
+def get_token_counts(response=None, response_body=None):
+    """
+    Returns (input_tokens, output_tokens) reported by the model, or (None, None). Bedrock reports
+    token counts in response headers for every provider - otherwise the response body is used.
+    """
+    headers = (response or {}).get("ResponseMetadata", {}).get("HTTPHeaders", {})
+    if "x-amzn-bedrock-input-token-count" in headers and "x-amzn-bedrock-output-token-count" in headers:
+        return int(headers["x-amzn-bedrock-input-token-count"]), int(headers["x-amzn-bedrock-output-token-count"])
+    body = response_body or {}
+    # Claude 3 / Anthropic messages API
+    if isinstance(body.get("usage"), dict) and "input_tokens" in body["usage"]:
+        return body["usage"]["input_tokens"], body["usage"].get("output_tokens", 0)
+    # AI21 Jurassic - lists of tokens
+    if isinstance(body.get("prompt"), dict) and "tokens" in body["prompt"]:
+        return len(body["prompt"]["tokens"]), sum(len(completion["data"].get("tokens", [])) for completion in body.get("completions", []))
+    # Amazon Titan
+    if "inputTextTokenCount" in body:
+        return body["inputTextTokenCount"], sum(result.get("tokenCount", 0) for result in body.get("results", []))
+    # Meta Llama
+    if "prompt_token_count" in body:
+        return body["prompt_token_count"], body.get("generation_token_count", 0)
+    return None, None
+
+def reset():
+    totals.clear()
+
+def record_usage(modelId, prompt, generated_text, input_tokens=None, output_tokens=None, max_tokens=None):
+    """
+    Records the token usage and cost of one model call as metrics, and adds it to the invocation's totals.
+    Token counts the model doesn't report are estimated from the number of characters.
+    """
+    generated_text = generated_text or ""
+    usage = {
+        "input_characters": len(prompt),
+        "output_characters": len(generated_text),
+        "input_tokens": input_tokens if input_tokens is not None else estimate_tokens(prompt),
+        "output_tokens": output_tokens if output_tokens is not None else estimate_tokens(generated_text),
+        "estimated": input_tokens is None or output_tokens is None
+    }
+    # generation speed, over the last model call's round trip
+    invoke_ms = metrics.get_last_elapsed("ModelInvoke")
+    if invoke_ms:
+        usage["output_tokens_per_second"] = round(usage["output_tokens"] / (invoke_ms / 1000), 2)
+    price = get_price(modelId)
+    if price:
+        usage["cost"] = round((usage["input_tokens"] * price[0] + usage["output_tokens"] * price[1]) / 1000, 8)
+    if max_tokens and usage["output_tokens"] >= max_tokens:
+        # the answer was probably cut off - max_tokens may be too low for this model
+        usage["max_tokens_reached"] = True
+    metrics.emit_metric("InputTokens", usage["input_tokens"])
+    metrics.emit_metric("OutputTokens", usage["output_tokens"])
+    metrics.emit_metric("InputCharacters", usage["input_characters"])
+    metrics.emit_metric("OutputCharacters", usage["output_characters"])
+    if "output_tokens_per_second" in usage:
+        metrics.emit_metric("OutputTokensPerSecond", usage["output_tokens_per_second"], "Count/Second")
+    if "cost" in usage:
+        metrics.emit_metric("EstimatedCost", usage["cost"], "None")
+    metrics.emit_metric("MaxTokensReached", 1 if usage.get("max_tokens_reached") else 0)
+    log.info("Token usage", modelId=modelId, **usage)
+    with totals_lock:
+        add_usage(totals, usage)
+    if collector.get() is not None:
+        collector.get().append(usage)
+    return usage
+
+def add_usage(target, usage):
+    for key in ["input_characters", "output_characters", "input_tokens", "output_tokens", "cost"]:
+        if key in usage:
+            target[key] = round(target.get(key, 0) + usage[key], 8)
+    target["model_calls"] = target.get("model_calls", 0) + 1
+    target["estimated"] = target.get("estimated", False) or usage["estimated"]
+    return target
+
+def get_totals():
+    with totals_lock:
+        return dict(totals)
+
+@contextlib.contextmanager
+def collect():
+    """
+    Collects the usage of the model calls made in a block, e.g. for one prompt of a batch:
+    with usage.collect() as records: ...
+    """
+    records = []
+    token = collector.set(records)
+    try:
+        yield records
+    finally:
+        collector.reset(token)
+
+def sum_usage(records):
+    summed = {}
+    for usage in records:
+        add_usage(summed, usage)
+    return summed
@@ -0,0 +1,293 @@
+"""
+Bulk offline embedding of a JSONL corpus, e.g. to re-embed all QnA items and documents after an
+embeddings model change. Lines are streamed, one {"id": ..., "text": ...} object per line, and texts
+are truncated and embedded exactly as by the embeddings Lambda, in concurrent batches under a rate limit.
+
+Vectors are written to a contiguous memory-mapped matrix in the output directory:
+  vectors.f32 (or vectors.f16)  rows of float32 (float16) values - load with load_vectors()
+  ids.json                      the item id of each row
+  manifest.json                 model, dtype, dimensions, row count, and the row and content hash of each id
+The manifest is saved at every checkpoint. A rerun (e.g. after an interruption) skips items whose text
+hasn't changed, re-embeds changed items in place, and appends new ones. An id that occurs more than once in
+the corpus keeps the text of its last occurrence.
+
+Usage:
+  AWS_REGION=us-east-1 python bulk_embeddings.py corpus.jsonl output_dir [--model-id amazon.titan-embed-text-v1]
+      [--dtype float32] [--batch-size 16] [--concurrency 4] [--max-rps 20] [--checkpoint-every 1000]
+"""
+
+import argparse
+import asyncio
+import gzip
+import hashlib
+import json
+import os
+import sys
+import time
+import embeddings
+import log
+
+# Defaults
+BULK_BATCH_SIZE = 16
+BULK_CONCURRENCY = 4
+BULK_MAX_RPS = 20
+BULK_CHECKPOINT_EVERY = 1000
+# growth of the vectors file, in rows - it is trimmed to the rows used when the job ends
+BULK_MIN_CAPACITY = 1024
+DTYPES = {"float32": "f32", "float16": "f16"}
+
+
+def read_corpus(path, id_field="id", text_field="text"):
+    # yields (id, text), one line at a time - gzipped files are read as they are decompressed
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if id_field not in item or text_field not in item:
+                log.warning("Skipping line without id or text", line=number)
+                continue
+            yield str(item[id_field]), item[text_field]
+
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class RateLimiter:
+    """
+    Spaces out requests to at most `rate` per second, across all tasks on the event loop.
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_time = 0
+
+    async def acquire(self):
+        if not self.interval:
+            return
+        now = time.monotonic()
+        delay = self.next_time - now
+        self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class VectorStore:
+    """
+    A growable (rows, dimensions) matrix in a memory-mapped file, with the manifest that indexes it.
+    """
+    def __init__(self, output_dir, modelId, dtype):
+        self.output_dir = output_dir
+        self.manifest_path = os.path.join(output_dir, "manifest.json")
+        self.manifest = {"model_id": modelId, "dtype": dtype, "dimensions": None, "rows": 0, "items": {}}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+            if self.manifest["model_id"] != modelId or self.manifest["dtype"] != dtype:
+                raise Exception(f"{output_dir} has {self.manifest['dtype']} vectors of {self.manifest['model_id']} - use a new output directory")
+        self.path = os.path.join(output_dir, f"vectors.{DTYPES[dtype]}")
+        self.matrix = None
+        self.capacity = 0
+
+    def open(self, dimensions):
+        import numpy as np
+        if self.manifest["dimensions"] not in [None, dimensions]:
+            raise Exception(f"Model returned {dimensions} dimensions, but {self.path} has {self.manifest['dimensions']}")
+        self.manifest["dimensions"] = dimensions
+        self.itemsize = np.dtype(self.manifest["dtype"]).itemsize
+        if not os.path.exists(self.path):
+            open(self.path, "wb").close()
+        self.capacity = os.path.getsize(self.path) // (dimensions * self.itemsize)
+        self.resize(max(self.capacity, self.manifest["rows"], BULK_MIN_CAPACITY))
+
+    def resize(self, capacity):
+        import numpy as np
+        self.close_matrix()
+        with open(self.path, "r+b") as f:
+            f.truncate(capacity * self.manifest["dimensions"] * self.itemsize)
+        self.capacity = capacity
+        self.matrix = np.memmap(self.path, dtype=self.manifest["dtype"], mode="r+", shape=(capacity, self.manifest["dimensions"]))
+
+    def close_matrix(self):
+        if self.matrix is not None:
+            self.matrix.flush()
+            del self.matrix
+            self.matrix = None
+
+    def get_row(self, id):
+        # the row of a changed item is overwritten - new items get the next row
+        if id in self.manifest["items"]:
+            return self.manifest["items"][id][0]
+        row = self.manifest["rows"]
+        self.manifest["rows"] += 1
+        return row
+
+    def write(self, id, row, text_hash, vector):
+        if self.matrix is None:
+            self.open(len(vector))
+        if row >= self.capacity:
+            self.resize(max(row + 1, self.capacity * 2))
+        self.matrix[row] = vector
+        self.manifest["items"][id] = [row, text_hash]
+
+    def checkpoint(self):
+        # the vectors are flushed before the manifest that points to them is replaced
+        if self.matrix is not None:
+            self.matrix.flush()
+        ids = [None] * self.manifest["rows"]
+        for id, (row, _) in self.manifest["items"].items():
+            ids[row] = id
+        write_json(os.path.join(self.output_dir, "ids.json"), ids)
+        write_json(self.manifest_path, self.manifest)
+
+    def close(self):
+        self.checkpoint()
+        if self.matrix is not None:
+            rows = self.manifest["rows"]
+            self.close_matrix()
+            with open(self.path, "r+b") as f:
+                f.truncate(rows * self.manifest["dimensions"] * self.itemsize)
+
+def write_json(path, value):
+    # written to a temporary file first, so that an interrupted write never leaves a partial file
+    with open(path + ".tmp", "w") as f:
+        json.dump(value, f)
+    os.replace(path + ".tmp", path)
+
+def load_vectors(output_dir):
+    """
+    Returns (ids, vectors) from the output of a bulk embedding job - vectors is a read-only memory-mapped
+    (rows, dimensions) matrix, and ids[row] is the item id of each row (None for unused rows).
+    """
+    import numpy as np
+    with open(os.path.join(output_dir, "manifest.json")) as f:
+        manifest = json.load(f)
+    with open(os.path.join(output_dir, "ids.json")) as f:
+        ids = json.load(f)
+    path = os.path.join(output_dir, f"vectors.{DTYPES[manifest['dtype']]}")
+    return ids, np.memmap(path, dtype=manifest["dtype"], mode="r", shape=(manifest["rows"], manifest["dimensions"]))
+
+
+async def embed_request(backend, texts, limiter):
+    # one model request - a failed request fails each of its texts
+    await limiter.acquire()
+    try:
+        return await backend.embed_batch_async(texts, "document")
+    except Exception as e:
+        return [e] * len(texts)
+
+async def embed_batch(modelId, batch, limiter):
+    # results (or errors) in the order of the batch
+    backend = embeddings.get_backend(modelId=modelId)
+    texts = [text for _, _, text in batch]
+    if backend.local:
+        # one batched inference in this process - there is no request rate to limit
+        try:
+            return await backend.embed_async(texts, "document")
+        except Exception as e:
+            return [e] * len(batch)
+    # as many texts per request as the provider accepts - one for Titan, up to 96 for Cohere
+    results = await asyncio.gather(*[embed_request(backend, texts, limiter) for texts in backend.get_batches(texts)])
+    return [result for request_results in results for result in request_results]
+
+def get_batch_size(modelId):
+    # at least a full request per batch, for providers with batched requests
+    backend = embeddings.get_backend(modelId=modelId)
+    return BULK_BATCH_SIZE if backend.local else max(BULK_BATCH_SIZE, embeddings.get_codec(modelId).max_texts)
+
+def get_pending_items(corpus, store, stats, max_words, latest):
+    # (id, hash, truncated text) of the items that are new or changed since the last run - latest records
+    # the hash of the last occurrence of each id in this run, so that an id repeated in the corpus keeps its last text
+    for id, text in corpus:
+        stats["read"] += 1
+        text = embeddings.truncate_text(text.strip(), max_words)
+        text_hash = content_hash(text)
+        if latest.get(id, store.manifest["items"].get(id, [None, None])[1]) == text_hash:
+            stats["skipped"] += 1
+            continue
+        latest[id] = text_hash
+        yield id, text_hash, text
+
+async def run_job(corpus, store, modelId, batch_size=BULK_BATCH_SIZE, concurrency=BULK_CONCURRENCY, max_rps=BULK_MAX_RPS,
+                  checkpoint_every=BULK_CHECKPOINT_EVERY, max_words=int(embeddings.EMBEDDING_MAX_WORDS)):
+    """
+    Embeds the new and changed items of the corpus, `concurrency` batches at a time, at most `max_rps`
+    model requests per second, and checkpoints every `checkpoint_every` embedded items. Returns the job stats.
+    """
+    stats = {"read": 0, "skipped": 0, "embedded": 0, "failed": 0, "superseded": 0}
+    latest = {}
+    limiter = RateLimiter(max_rps)
+    start = time.perf_counter()
+    since_checkpoint = 0
+    async def run(batch):
+        return batch, await embed_batch(modelId, batch, limiter)
+    def save(done):
+        nonlocal since_checkpoint
+        for task in done:
+            batch, results = task.result()
+            for (id, text_hash, _), result in zip(batch, results):
+                if isinstance(result, BaseException):
+                    # not recorded in the manifest, so it is retried by the next run
+                    log.warning("Embedding failed", id=id, error=result)
+                    stats["failed"] += 1
+                    continue
+                if latest[id] != text_hash:
+                    # a later occurrence of the id in the corpus has other text, and replaces this one
+                    stats["superseded"] += 1
+                    continue
+                store.write(id, store.get_row(id), text_hash, result)
+                stats["embedded"] += 1
+                since_checkpoint += 1
+        if since_checkpoint >= checkpoint_every:
+            store.checkpoint()
+            since_checkpoint = 0
+            log.info("Checkpoint", **get_throughput(stats, start))
+    pending = set()
+    for batch in batched(get_pending_items(corpus, store, stats, max_words, latest), batch_size):
+        if len(pending) >= concurrency:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            save(done)
+        pending.add(asyncio.ensure_future(run(batch)))
+    if pending:
+        done, _ = await asyncio.wait(pending)
+        save(done)
+    store.close()
+    return get_throughput(stats, start)
+
+def get_throughput(stats, start):
+    elapsed = time.perf_counter() - start
+    return {**stats, "elapsed_seconds": round(elapsed, 1), "embedded_per_second": round(stats["embedded"] / elapsed, 2) if elapsed else None}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("corpus", help="JSONL file (optionally .gz) with one {\"id\": ..., \"text\": ...} object per line")
+    parser.add_argument("output_dir")
+    parser.add_argument("--model-id", default=embeddings.get_model_id(), help="Bedrock model id, or onnx:<model> for the model in EMBEDDINGS_ONNX_MODEL_DIR")
+    parser.add_argument("--id-field", default="id")
+    parser.add_argument("--text-field", default="text")
+    parser.add_argument("--dtype", choices=list(DTYPES), default="float32")
+    parser.add_argument("--batch-size", type=int, help=f"texts per batch (default {BULK_BATCH_SIZE}, or a full request of the model)")
+    parser.add_argument("--concurrency", type=int, default=BULK_CONCURRENCY, help="batches in flight")
+    parser.add_argument("--max-rps", type=float, default=BULK_MAX_RPS, help="model requests per second (0 for no limit)")
+    parser.add_argument("--checkpoint-every", type=int, default=BULK_CHECKPOINT_EVERY, help="embedded items between checkpoints")
+    args = parser.parse_args(argv)
+    os.makedirs(args.output_dir, exist_ok=True)
+    store = VectorStore(args.output_dir, args.model_id, args.dtype)
+    corpus = read_corpus(args.corpus, args.id_field, args.text_field)
+    stats = asyncio.run(run_job(corpus, store, args.model_id, args.batch_size or get_batch_size(args.model_id), args.concurrency, args.max_rps, args.checkpoint_every))
+    log.info("Bulk embedding complete", model_id=args.model_id, **stats)
+    return 1 if stats["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
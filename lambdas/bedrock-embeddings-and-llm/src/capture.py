@@ -0,0 +1,141 @@
+import functools
+import gzip
+import hashlib
+import json
+import os
+import random
+import re
+import time
+import uuid
+import log
+
+# Defaults
+# fraction of LambdaHook events captured for load test replay (0 to disable)
+CAPTURE_SAMPLE_RATE = float(os.environ.get("CAPTURE_SAMPLE_RATE") or 0)
+CAPTURE_OUTPUT_DIR = os.environ.get("CAPTURE_OUTPUT_DIR") or "/tmp/captures"
+# optional copy of each capture file, to an S3 bucket (s3://bucket/prefix) or a local directory
+CAPTURE_UPLOAD_TARGET = os.environ.get("CAPTURE_UPLOAD_TARGET")
+# events are buffered per sandbox, and written at the end of the first invocation after CAPTURE_FLUSH_EVENTS are
+# buffered or the oldest is CAPTURE_FLUSH_SECONDS old
+CAPTURE_FLUSH_EVENTS = int(os.environ.get("CAPTURE_FLUSH_EVENTS") or 20)
+CAPTURE_FLUSH_SECONDS = float(os.environ.get("CAPTURE_FLUSH_SECONDS") or 60)
+# user ids and email addresses are replaced by salted hashes - set the salt to keep pseudonyms stable across sandboxes
+CAPTURE_PSEUDONYM_SALT = os.environ.get("CAPTURE_PSEUDONYM_SALT") or uuid.uuid4().hex
+# values of these keys identify the user (compared in lower case)
+PSEUDONYMIZED_KEYS = {"userid", "username", "user_id", "email", "sub", "cognito:username", "preferred_username"}
+EMAIL_PATTERN = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+# phone numbers have 10 to 15 digits - longer runs are ids
+PHONE_PATTERN = re.compile(r"(?<![\w-])\+?\d[\d ()-]{8,}\d(?![\w-])")
+
+# global variables - events captured by this sandbox and not yet written
+buffer = []
+buffer_start = None
+sandbox_id = uuid.uuid4().hex[:8]
+file_count = 0
+
+
+def should_capture(event):
+    return CAPTURE_SAMPLE_RATE > 0 and isinstance(event, dict) and "req" in event and random.random() < CAPTURE_SAMPLE_RATE
+
+def pseudonym(value):
+    digest = hashlib.sha256((CAPTURE_PSEUDONYM_SALT + value).encode("utf-8")).hexdigest()[:12]
+    # emails stay emails - the Amazon Q Business hook uses them as user ids
+    return f"user-{digest}@example.com" if "@" in value else f"user-{digest}"
+
+def is_secret_key(key):
+    # e.g. idtokenjwt, accesstokenjwt, refreshtoken - but not max_tokens
+    return key in log.REDACTED_KEYS or key.endswith("jwt") or key.endswith("token")
+
+def redact(value, key=""):
+    """
+    Returns a copy of a LambdaHook event that is safe to store: secrets and tokens are removed, user ids
+    and email addresses are replaced by pseudonyms, and phone numbers are masked. Questions, history and
+    arguments are kept, as their sizes and repeats drive prompt sizes and cache hits in a replay.
+    """
+    if isinstance(value, dict):
+        return {str(name): "[REDACTED]" if is_secret_key(str(name).lower()) else redact(item, str(name).lower()) for name, item in value.items()}
+    if isinstance(value, list):
+        return [redact(item, key) for item in value]
+    if isinstance(value, str):
+        if key in PSEUDONYMIZED_KEYS and value:
+            return pseudonym(value)
+        value = EMAIL_PATTERN.sub(lambda match: pseudonym(match.group(0)), value)
+        return PHONE_PATTERN.sub(lambda match: "[PHONE]" if 10 <= sum(c.isdigit() for c in match.group(0)) <= 15 else match.group(0), value)
+    return value
+
+def upload(path):
+    name = os.path.basename(path)
+    if CAPTURE_UPLOAD_TARGET.startswith("s3://"):
+        import clients
+        bucket, _, prefix = CAPTURE_UPLOAD_TARGET[5:].partition("/")
+        key = f"{prefix.rstrip('/')}/{name}" if prefix else name
+        with open(path, "rb") as f:
+            clients.get_client("s3").put_object(Bucket=bucket, Key=key, Body=f.read())
+    else:
+        import shutil
+        os.makedirs(CAPTURE_UPLOAD_TARGET, exist_ok=True)
+        shutil.copy(path, os.path.join(CAPTURE_UPLOAD_TARGET, name))
+
+def flush(context=None):
+    """
+    Writes the buffered events to a compressed JSONL file, and uploads it to CAPTURE_UPLOAD_TARGET.
+    """
+    global buffer, buffer_start, file_count
+    if not buffer:
+        return None
+    os.makedirs(CAPTURE_OUTPUT_DIR, exist_ok=True)
+    function_name = os.environ.get("AWS_LAMBDA_FUNCTION_NAME") or getattr(context, "function_name", None) or "handler"
+    file_count += 1
+    path = os.path.join(CAPTURE_OUTPUT_DIR, f"{function_name}-{int(time.time())}-{sandbox_id}-{file_count}.jsonl.gz")
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        for record in buffer:
+            f.write(json.dumps(record) + "\n")
+    log.info("Captured events written", path=path, events=len(buffer))
+    buffer, buffer_start = [], None
+    if CAPTURE_UPLOAD_TARGET:
+        try:
+            upload(path)
+        except Exception as e:
+            log.warning("Failed to upload captured events", path=path, error=e)
+    return path
+
+def is_flush_due():
+    return bool(buffer) and (len(buffer) >= CAPTURE_FLUSH_EVENTS or time.monotonic() - buffer_start >= CAPTURE_FLUSH_SECONDS)
+
+def invocation(lambda_handler):
+    """
+    Decorates a LambdaHook's lambda_handler, so that buffered events are written when they are due at the end
+    of every invocation - including those that aren't captured, such as warm-up pings - rather than only
+    when the next event is captured.
+    """
+    @functools.wraps(lambda_handler)
+    def wrapper(event, context):
+        try:
+            return lambda_handler(event, context)
+        finally:
+            try:
+                if is_flush_due():
+                    flush(context)
+            except Exception as e:
+                log.warning("Failed to write captured events", error=e)
+    return wrapper
+
+def record(event, context, handler):
+    """
+    Captures a sample of LambdaHook events as received (req / res), redacted, for replay by
+    benchmarks/load_test.py. handler names the hook, e.g. "bedrock-lambdahook". Never fails the invocation.
+    The events are written by the invocation decorator.
+    """
+    global buffer_start
+    if not should_capture(event):
+        return
+    try:
+        buffer.append({
+            "captured_at": round(time.time(), 3),
+            "handler": handler,
+            "req": redact(event.get("req")),
+            "res": redact(event.get("res"))
+        })
+        buffer_start = buffer_start or time.monotonic()
+    except Exception as e:
+        log.warning("Failed to capture event", error=e)
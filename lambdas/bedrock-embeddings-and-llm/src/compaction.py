@@ -0,0 +1,105 @@
+import html
+import os
+import re
+import zlib
+import models
+from history import estimate_tokens
+
+# Defaults
+PROMPT_COMPACTION_ENABLED = (os.environ.get("PROMPT_COMPACTION_ENABLED") or "false").lower() == "true"
+# overrides the per-model input budget below, in (estimated) tokens
+PROMPT_MAX_INPUT_TOKENS = os.environ.get("PROMPT_MAX_INPUT_TOKENS")
+# passages whose shingle sets overlap by at least this much (Jaccard) are considered duplicates
+DUPLICATE_THRESHOLD = float(os.environ.get("PROMPT_DUPLICATE_THRESHOLD") or 0.8)
+SHINGLE_SIZE = 5
+
+# approximate model context windows, in tokens, by modelId prefix (longest matching prefix wins)
+MODEL_INPUT_TOKENS = {
+    "amazon.titan-text-express": 8000,
+    "amazon.titan-text-lite": 4000,
+    "ai21.j2": 8000,
+    "anthropic.claude-instant": 100000,
+    "anthropic.claude-v2": 100000,
+    "anthropic.claude-v2:1": 200000,
+    "anthropic.claude-3": 200000,
+    "anthropic.claude-sonnet-4": 200000,
+    "anthropic.claude-opus-4": 200000,
+    "cohere.command": 4000,
+    "meta.llama2": 4000
+}
+DEFAULT_INPUT_TOKENS = 4000
+
+# the {context} part of our QA prompt templates - see settings.py. The instructions mention the tag ("in <references> tags"),
+# so the block starts at the last <references> before </references>
+CONTEXT_PATTERNS = [
+    re.compile(r"(<references>)((?:(?!<references>).)*?)(</references>)", re.DOTALL),
+    re.compile(r"(Documents:)(.*?)(Instruction:)", re.DOTALL)
+]
+PASSAGE_SEPARATOR = re.compile(r"\n\s*-{3,}\s*\n|\n\s*\n")
+# HTML markup of passages from web pages - other <...> text (e.g. XML in a passage, or "a <b> c") is kept
+HTML_TAG = re.compile(r"</?(?:a|b|i|u|p|br|hr|em|strong|span|div|font|sup|sub|h[1-6]|ul|ol|li|dl|dt|dd|table|thead|tbody|tr|td|th|blockquote|pre|code|img)(?:\s[^<>]*)?/?>", re.IGNORECASE)
+WHITESPACE = re.compile(r"\s+")
+WORD = re.compile(r"\w+")
+
+
+def get_input_budget(modelId, max_output_tokens):
+    if PROMPT_MAX_INPUT_TOKENS:
+        return int(PROMPT_MAX_INPUT_TOKENS)
+    matches = [prefix for prefix in MODEL_INPUT_TOKENS if models.get_base_model_id(modelId).startswith(prefix)]
+    budget = MODEL_INPUT_TOKENS[max(matches, key=len)] if matches else DEFAULT_INPUT_TOKENS
+    return budget - max_output_tokens
+
+def normalize_passage(passage):
+    passage = HTML_TAG.sub(" ", passage)
+    passage = html.unescape(passage)
+    return WHITESPACE.sub(" ", passage).strip()
+
+def get_shingles(passage):
+    words = WORD.findall(passage.lower())
+    if len(words) < SHINGLE_SIZE:
+        return {zlib.crc32(" ".join(words).encode("utf-8"))}
+    return {zlib.crc32(" ".join(words[i:i + SHINGLE_SIZE]).encode("utf-8")) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+def remove_near_duplicates(passages, threshold=DUPLICATE_THRESHOLD):
+    # passages are in retrieval rank order, so the first of any near-duplicate group is kept
+    kept = []
+    kept_shingles = []
+    for passage in passages:
+        shingles = get_shingles(passage)
+        duplicate = any(len(shingles & other) / len(shingles | other) >= threshold for other in kept_shingles)
+        if not duplicate:
+            kept.append(passage)
+            kept_shingles.append(shingles)
+    return kept
+
+def compact_prompt(modelId, prompt, max_output_tokens):
+    """
+    Compacts the reference passages ({context}) of a QA prompt: normalizes whitespace and markup,
+    removes near-duplicate passages, and drops the lowest ranked (last) passages until the prompt
+    fits the model's input budget. Returns the compacted prompt and stats on the tokens saved.
+    """
+    tokens_before = estimate_tokens(prompt)
+    stats = {"tokens_before": tokens_before, "tokens_after": tokens_before, "tokens_saved": 0, "passages_removed": 0}
+    match = None
+    for pattern in CONTEXT_PATTERNS:
+        match = pattern.search(prompt)
+        if match:
+            break
+    if not match:
+        return prompt, stats
+    head, tail = prompt[:match.start(2)], prompt[match.end(2):]
+    passages = [normalize_passage(p) for p in PASSAGE_SEPARATOR.split(match.group(2))]
+    passages = [p for p in passages if p]
+    count = len(passages)
+    passages = remove_near_duplicates(passages)
+    budget = get_input_budget(modelId, max_output_tokens)
+    fixed_tokens = estimate_tokens(head + tail)
+    passage_tokens = [estimate_tokens(p) for p in passages]
+    while len(passages) > 1 and fixed_tokens + sum(passage_tokens) > budget:
+        passages.pop()
+        passage_tokens.pop()
+    prompt = head + "\n" + "\n\n".join(passages) + "\n" + tail
+    stats["tokens_after"] = estimate_tokens(prompt)
+    stats["tokens_saved"] = tokens_before - stats["tokens_after"]
+    stats["passages_removed"] = count - len(passages)
+    return prompt, stats
@@ -1,21 +1,48 @@
-import boto3
+import asyncio
 import json
 import os
+import threading
+import aio
+import clients
+import log
+import metrics
+import models
+import profiling
+import warmup
 
 # Defaults
 DEFAULT_MODEL_ID = os.environ.get("DEFAULT_MODEL_ID","amazon.titan-embed-text-v1")
 AWS_REGION = os.environ["AWS_REGION_OVERRIDE"] if "AWS_REGION_OVERRIDE" in os.environ else os.environ["AWS_REGION"]
 ENDPOINT_URL = os.environ.get("ENDPOINT_URL", f'https://bedrock-runtime.{AWS_REGION}.amazonaws.com')
 EMBEDDING_MAX_WORDS = os.environ.get("EMBEDDING_MAX_WORDS") or 6000  # limit 8k token ~ 6k words
+# "bedrock", or "onnx" for an in-process sentence embedding model on the Lambda CPU
+EMBEDDINGS_BACKEND = os.environ.get("EMBEDDINGS_BACKEND") or "bedrock"
+# directory with model.onnx, tokenizer.json and config.json - e.g. from a Lambda layer
+EMBEDDINGS_ONNX_MODEL_DIR = os.environ.get("EMBEDDINGS_ONNX_MODEL_DIR") or "/opt/embeddings-model"
+EMBEDDINGS_ONNX_MAX_TOKENS = int(os.environ.get("EMBEDDINGS_ONNX_MAX_TOKENS") or 256)
+EMBEDDINGS_ONNX_BATCH_SIZE = int(os.environ.get("EMBEDDINGS_ONNX_BATCH_SIZE") or 32)
+# intra-op threads - 0 for one per vCPU (Lambda allocates one vCPU per 1,769 MB of memory)
+EMBEDDINGS_ONNX_THREADS = int(os.environ.get("EMBEDDINGS_ONNX_THREADS") or 0)
+# Cohere embeds texts for a purpose - "document" (search_document) or "query" (search_query). Unset, each event
+# gets its own: its inputType, else "query" for a single inputText (a lookup) and "document" for inputTexts
+EMBEDDINGS_INPUT_TYPE = os.environ.get("EMBEDDINGS_INPUT_TYPE")
+BEDROCK_DIMENSIONS = {
+    "amazon.titan-embed-text-v1": 1536,
+    "amazon.titan-embed-text-v2:0": 1024,
+    "cohere.embed-english-v3": 1024,
+    "cohere.embed-multilingual-v3": 1024
+}
+
+# global variables - backends are loaded once per sandbox
+backends = {}
+backends_lock = threading.Lock()
 
-# global variables - avoid creating a new client for every request
-client = None
 
 # limit number of words to avoid exceeding model token limit
 def truncate_text(text, n=500):
     words = text.split()
     if (len(words) > n):
-        print(f"Truncating input text from {len(words)} to {n} words")
+        log.info("Truncating input text", words=len(words), max_words=n)
         truncated_words = words[:n]
         truncated_text = " ".join(truncated_words)
         return truncated_text
@@ -23,26 +50,289 @@ def truncate_text(text, n=500):
         return text
 
 def get_client():
-    print("Connecting to Bedrock Service: ", ENDPOINT_URL)
-    client = boto3.client(service_name='bedrock-runtime', region_name=AWS_REGION, endpoint_url=ENDPOINT_URL)
-    return client
+    return clients.get_client('bedrock-runtime', AWS_REGION, ENDPOINT_URL)
+
+def get_async_client():
+    return aio.get_client('bedrock-runtime', AWS_REGION, ENDPOINT_URL)
+
+
+class TitanCodec:
+    """
+    Amazon Titan embeddings - {"inputText": ...}, one text per request.
+    """
+    max_texts = 1
+
+    def encode(self, modelId, texts, input_type=None):
+        return json.dumps({"inputText": texts[0]})
+
+    def decode(self, response_body):
+        return [response_body["embedding"]]
+
+    def get_fields(self, response_body):
+        # e.g. inputTextTokenCount
+        return {name: value for name, value in response_body.items() if name != "embedding"}
+
+
+class CohereCodec:
+    """
+    Cohere embeddings - {"texts": [...]}, up to 96 texts of up to 2,048 characters per request.
+    """
+    max_texts = 96
+    max_characters = 2048
+    input_types = {"document": "search_document", "query": "search_query"}
+
+    def encode(self, modelId, texts, input_type=None):
+        input_type = input_type or EMBEDDINGS_INPUT_TYPE or "document"
+        return json.dumps({
+            "texts": [text[:self.max_characters] for text in texts],
+            "input_type": self.input_types.get(input_type, input_type),
+            # texts over the model's 512 token limit are cut, rather than failing the whole batch
+            "truncate": "END"
+        })
+
+    def decode(self, response_body):
+        return response_body["embeddings"]
+
+    def get_fields(self, response_body):
+        # e.g. id, response_type - without the echoed texts
+        return {name: value for name, value in response_body.items() if name not in ("embeddings", "texts")}
+
+
+CODECS = {
+    "amazon": TitanCodec(),
+    "cohere": CohereCodec()
+}
+
+def get_codec(modelId):
+    provider = models.get_provider(modelId)
+    if provider not in CODECS:
+        raise Exception(f"Unsupported provider for embeddings: {provider}")
+    return CODECS[provider]
+
+def get_request_body(modelId, texts, input_type=None):
+    return get_codec(modelId).encode(modelId, texts, input_type)
+
+def decode_response(modelId, texts, response, fields=None):
+    """
+    Returns the vectors of a response. The response's other fields are added to fields, if given: counts are
+    summed over the requests of a call, other values are kept from the first request.
+    """
+    codec = get_codec(modelId)
+    response_body = json.loads(response.get('body').read())
+    vectors = codec.decode(response_body)
+    if len(vectors) != len(texts):
+        raise Exception(f"{modelId} returned {len(vectors)} embeddings for {len(texts)} texts")
+    if fields is not None:
+        for name, value in codec.get_fields(response_body).items():
+            if name in fields and isinstance(value, int) and isinstance(fields[name], int):
+                fields[name] += value
+            else:
+                fields.setdefault(name, value)
+    return vectors
+
+async def invoke_model_async(modelId, body):
+    return await get_async_client().invoke_model(body=body, modelId=modelId, accept='application/json', contentType='application/json')
+
+
+class BedrockBackend:
+    """
+    Embeddings from a Bedrock model. Texts are packed into as few requests as the provider allows,
+    and the requests are sent concurrently.
+    """
+    provider = "bedrock"
+    # remote backends are called under the caller's request rate limits
+    local = False
+
+    def __init__(self, modelId):
+        self.model_id = modelId
+
+    def get_dimensions(self):
+        return BEDROCK_DIMENSIONS.get(self.model_id)
+
+    def warm_up(self):
+        clients.open_connection(get_client())
+
+    def get_batches(self, texts):
+        # consecutive texts, up to the provider's texts per request
+        size = get_codec(self.model_id).max_texts
+        return [texts[start:start + size] for start in range(0, len(texts), size)]
+
+    async def embed_batch_async(self, texts, input_type=None, fields=None):
+        # one request
+        response = await invoke_model_async(self.model_id, get_request_body(self.model_id, texts, input_type))
+        return decode_response(self.model_id, texts, response, fields)
+
+    async def embed_async(self, texts, input_type=None, fields=None):
+        results = await asyncio.gather(*[self.embed_batch_async(batch, input_type, fields) for batch in self.get_batches(texts)])
+        return [vector for vectors in results for vector in vectors]
+
+
+class OnnxBackend:
+    """
+    Embeddings from a sentence embedding model (e.g. all-MiniLM-L6-v2 exported to ONNX), run with
+    ONNX Runtime on the Lambda CPU - no network round-trip and no model TPS quota. The model is loaded
+    on first use and kept for the lifetime of the sandbox. Requires onnxruntime, tokenizers and numpy.
+    """
+    provider = "onnx"
+    local = True
+
+    def __init__(self, model_dir):
+        self.model_dir = model_dir
+        self.model_id = "onnx:" + os.path.basename(os.path.normpath(model_dir))
+        self.session = None
+        self.tokenizer = None
+        self.dimensions = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            if self.session is not None:
+                return
+            import onnxruntime
+            from tokenizers import Tokenizer
+            with metrics.timer("ModelLoad"):
+                options = onnxruntime.SessionOptions()
+                options.intra_op_num_threads = EMBEDDINGS_ONNX_THREADS
+                options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+                session = onnxruntime.InferenceSession(os.path.join(self.model_dir, "model.onnx"), options, providers=["CPUExecutionProvider"])
+                tokenizer = Tokenizer.from_file(os.path.join(self.model_dir, "tokenizer.json"))
+                tokenizer.enable_truncation(max_length=EMBEDDINGS_ONNX_MAX_TOKENS)
+                # each batch is padded to its longest text
+                tokenizer.enable_padding()
+            self.input_names = {input.name for input in session.get_inputs()}
+            self.output_names = [output.name for output in session.get_outputs()]
+            self.tokenizer = tokenizer
+            self.session = session
+            log.info("Loaded embeddings model", model_id=self.model_id, inputs=sorted(self.input_names), outputs=self.output_names)
+
+    def get_dimensions(self):
+        """
+        The embedding size, from the model's config.json (hidden_size), so that it can be reported without
+        loading the model - otherwise from an inference.
+        """
+        if self.dimensions is None:
+            for name in ["config.json", os.path.join("1_Pooling", "config.json")]:
+                path = os.path.join(self.model_dir, name)
+                if os.path.exists(path):
+                    with open(path) as f:
+                        config = json.load(f)
+                    self.dimensions = config.get("hidden_size") or config.get("word_embedding_dimension")
+                    if self.dimensions:
+                        break
+            if not self.dimensions:
+                self.dimensions = len(self.embed(["dimensions"])[0])
+        return self.dimensions
+
+    def warm_up(self):
+        self.load()
+        self.embed(["warm up"])
+
+    def run(self, texts):
+        import numpy as np
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([encoding.ids for encoding in encodings], dtype=np.int64)
+        attention_mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+        feeds = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            feeds["token_type_ids"] = np.zeros_like(input_ids)
+        outputs = dict(zip(self.output_names, self.session.run(None, feeds)))
+        if "sentence_embedding" in outputs:
+            vectors = outputs["sentence_embedding"]
+        else:
+            # mean of the token embeddings, without padding - sentence-transformers pooling
+            tokens = outputs.get("last_hidden_state", outputs[self.output_names[0]])
+            mask = attention_mask[:, :, None].astype(np.float32)
+            vectors = (tokens * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+    def embed(self, texts, input_type=None):
+        """
+        Returns one normalized vector per text, in order. Texts are sorted by length and run in batches of
+        EMBEDDINGS_ONNX_BATCH_SIZE, so that texts of similar length are padded together.
+        """
+        self.load()
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        vectors = [None] * len(texts)
+        for start in range(0, len(order), EMBEDDINGS_ONNX_BATCH_SIZE):
+            rows = order[start:start + EMBEDDINGS_ONNX_BATCH_SIZE]
+            for i, vector in zip(rows, self.run([texts[i] for i in rows])):
+                vectors[i] = vector.tolist()
+        return vectors
+
+    async def embed_async(self, texts, input_type=None, fields=None):
+        # ONNX Runtime releases the GIL during inference, so the event loop keeps running
+        return await aio.call(self.embed, texts)
+
+
+def get_backend(name=None, modelId=None):
+    """
+    Returns the embeddings backend, cached for the lifetime of the sandbox:
+    embeddings.get_backend().embed_async(["..."]) returns one vector per text.
+    A model id of the form "onnx:<model>" (as recorded by bulk_embeddings.py) selects the ONNX backend.
+    """
+    name = name or EMBEDDINGS_BACKEND
+    if modelId and modelId.startswith("onnx:"):
+        name = "onnx"
+    if name == "onnx":
+        key = (name, EMBEDDINGS_ONNX_MODEL_DIR)
+    elif name == "bedrock":
+        key = (name, modelId or DEFAULT_MODEL_ID)
+    else:
+        raise Exception(f"Unsupported embeddings backend: {name}")
+    with backends_lock:
+        if key not in backends:
+            backends[key] = OnnxBackend(key[1]) if name == "onnx" else BedrockBackend(key[1])
+        backend = backends[key]
+    if name == "onnx" and modelId and modelId != backend.model_id:
+        raise Exception(f"{modelId} is not the model in EMBEDDINGS_ONNX_MODEL_DIR ({backend.model_id})")
+    return backend
+
+def get_model_id():
+    return get_backend().model_id
+
+def warm_up():
+    get_backend().warm_up()
+
+def get_input_type(event):
+    """
+    The purpose of an event's texts, for Cohere: the event's inputType if it is one of Cohere's, else
+    EMBEDDINGS_INPUT_TYPE, else "query" for a single inputText (QnABot looking up a question) and
+    "document" for inputTexts (indexing).
+    """
+    input_type = event.get("inputType")
+    if input_type in CohereCodec.input_types or input_type in CohereCodec.input_types.values():
+        return input_type
+    return EMBEDDINGS_INPUT_TYPE or ("document" if "inputTexts" in event else "query")
 
 """
-Example Test Event:
+Example Test Events:
 {
   "inputText": "Why is the sky blue?"
 }
+{
+  "inputTexts": ["Why is the sky blue?", "Why is the sea salty?"],
+  "inputType": "document"
+}
 """
+@metrics.invocation
+@profiling.profiled
 def lambda_handler(event, context):
-    print("Event:", json.dumps(event))
-    global client
-    modelId = DEFAULT_MODEL_ID
+    if warmup.is_warmup_event(event):
+        return warmup.handle(event, context, warm_up)
+    with profiling.track_memory("event_dump"):
+        log.debug("Event", event=event)
+    backend = get_backend()
+    metrics.set_dimensions(ModelId=backend.model_id, Provider=models.get_provider(backend.model_id) if backend.provider == "bedrock" else backend.provider, StreamMode="false")
     max_words = EMBEDDING_MAX_WORDS
-    text = truncate_text(event["inputText"].strip(), int(max_words))
-    body = json.dumps({"inputText": text})
-    if (client is None):
-        client = get_client()
-    response = client.invoke_model(body=body, modelId=modelId, accept='application/json', contentType='application/json')
-    response_body = json.loads(response.get('body').read())
-    print("Embeddings length:", len(response_body["embedding"]))
-    return response_body
+    with metrics.timer("Parse"):
+        texts = event["inputTexts"] if "inputTexts" in event else [event["inputText"]]
+        texts = [truncate_text(text.strip(), int(max_words)) for text in texts]
+    # other fields of the model's responses, e.g. inputTextTokenCount, are returned with the vectors
+    fields = {}
+    with metrics.timer("ModelInvoke"):
+        vectors = aio.run(backend.embed_async(texts, get_input_type(event), fields))
+    metrics.emit_metric("EmbeddedTexts", len(texts))
+    log.info("Embeddings length", length=len(vectors[0]) if vectors else 0, texts=len(texts))
+    if "inputTexts" in event:
+        return {"embeddings": vectors, **fields}
+    return {"embedding": vectors[0], **fields}
@@ -0,0 +1,96 @@
+import hashlib
+import json
+import os
+import log
+import metrics
+import prompt_template
+
+# Defaults
+# A turn is one entry of QnABot's chatMessageHistory, e.g. {"Human": "..."} or {"AI": "..."}
+HISTORY_MAX_TURNS = int(os.environ.get("HISTORY_MAX_TURNS") or 6)
+HISTORY_MAX_TOKENS = int(os.environ.get("HISTORY_MAX_TOKENS") or 1000)
+# number of turns that may fall out of the window before they are folded into the summary - until then they are left out
+HISTORY_SUMMARY_BATCH = int(os.environ.get("HISTORY_SUMMARY_BATCH") or 4)
+HISTORY_SUMMARY_PROMPT_TEMPLATE = """Here is a summary of an earlier conversation in <summary> tags:
+<summary>
+{summary}
+</summary>
+Here are later messages from the same conversation in <messages> tags:
+<messages>
+{messages}
+</messages>
+Write a concise summary, in under 100 words, of the whole conversation that keeps any facts, names and open questions needed to understand later messages. Respond only with the summary."""
+# key used to cache the rolling summary in the QnABot session (qnabotcontext)
+SESSION_CONTEXT_KEY = "llm_history_summary"
+
+
+# rough token estimate (~4 characters per token) - avoids loading a tokenizer in the Lambda
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+def format_messages(messages):
+    return '\n'.join(f"{key}: {value}" for item in messages for key, value in item.items())
+
+def message_hash(message):
+    return hashlib.sha1(json.dumps(message, sort_keys=True).encode("utf-8")).hexdigest()
+
+def get_window_start(messages, max_turns, max_tokens):
+    # walk back from the most recent message until either limit is reached
+    start = len(messages)
+    tokens = 0
+    while start > 0 and len(messages) - start < max_turns:
+        tokens += estimate_tokens(format_messages([messages[start - 1]]))
+        if tokens > max_tokens:
+            break
+        start -= 1
+    return start
+
+def get_unsummarized_start(messages, cached):
+    # QnABot keeps its own sliding window of chatMessageHistory, so locate the last summarized
+    # message by its hash rather than by position
+    last = cached.get("last") if cached else None
+    if last:
+        for i in range(len(messages) - 1, -1, -1):
+            if message_hash(messages[i]) == last:
+                return i + 1
+    return 0
+
+def summarize(summarize_fn, summary, messages):
+    prompt = prompt_template.render(HISTORY_SUMMARY_PROMPT_TEMPLATE, {"summary": summary or "None", "messages": format_messages(messages)})
+    return summarize_fn(prompt).strip()
+
+def get_history(event, summarize_fn=None, max_turns=HISTORY_MAX_TURNS, max_tokens=HISTORY_MAX_TOKENS, batch=HISTORY_SUMMARY_BATCH):
+    """
+    Returns the {history} string for the prompt: the cached rolling summary of older turns (if any),
+    followed by the most recent turns that fit within max_turns and max_tokens - never more.
+    Turns that fall out of the window are folded into the summary using summarize_fn(prompt) once
+    'batch' of them have accumulated (or the token budget is exceeded), and the new summary is
+    cached in the session so that it is not regenerated on every turn. If summarization fails, the
+    cached summary is kept and the turns are folded in on a later turn.
+    """
+    history_array = json.loads(event["req"]["_userInfo"].get("chatMessageHistory") or "[]")
+    qnabotcontext = event["req"]["session"].get("qnabotcontext") or {}
+    cached = qnabotcontext.get(SESSION_CONTEXT_KEY) or {}
+    summary = cached.get("summary", "")
+    unsummarized = history_array[get_unsummarized_start(history_array, cached):]
+    start = get_window_start(unsummarized, max_turns, max_tokens)
+    pending, recent = unsummarized[:start], unsummarized[start:]
+    total_tokens = estimate_tokens(format_messages(unsummarized))
+    if pending and (len(pending) >= batch or total_tokens > max_tokens or summarize_fn is None):
+        if summarize_fn is None:
+            log.info("History summarization disabled - dropping older turns", turns=len(pending))
+        else:
+            log.info("Folding older turns into history summary", turns=len(pending))
+            try:
+                summary = summarize(summarize_fn, summary, pending)
+                cached = {"summary": summary, "last": message_hash(pending[-1])}
+                event["res"]["session"].setdefault("qnabotcontext", {})[SESSION_CONTEXT_KEY] = cached
+            except Exception as e:
+                # the window of recent turns is used as is, and the session keeps the turns to fold in next time
+                metrics.emit_metric("HistorySummaryFailures", 1)
+                log.warning("Failed to summarize history - continuing with the cached summary and recent turns", turns=len(pending), error=e)
+    log.info("History", turns=len(history_array), verbatim=len(recent), pending=len(pending), summary_cached=bool(summary))
+    history_str = format_messages(recent)
+    if summary:
+        history_str = f"Summary of earlier conversation: {summary}\n{history_str}"
+    return history_str
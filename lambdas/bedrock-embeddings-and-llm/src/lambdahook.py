@@ -1,33 +1,49 @@
-import boto3
 import json
 import os
+import aio
+import capture
+import clients
+import history
+import log
+import metrics
+import models
+import profiling
+import prompt_cache
+import prompt_template
+import usage
+import vector_index
+import warmup
 
 # Defaults
 DEFAULT_MODEL_ID = os.environ.get("DEFAULT_MODEL_ID","anthropic.claude-instant-v1")
+# model used to fold older chat history into a rolling summary - use a small, fast model
+HISTORY_SUMMARY_MODEL_ID = os.environ.get("HISTORY_SUMMARY_MODEL_ID")
 AWS_REGION = os.environ["AWS_REGION_OVERRIDE"] if "AWS_REGION_OVERRIDE" in os.environ else os.environ["AWS_REGION"]
 ENDPOINT_URL = os.environ.get("ENDPOINT_URL", f'https://bedrock-runtime.{AWS_REGION}.amazonaws.com')
 DEFAULT_MAX_TOKENS = 256
 
-# global variables - avoid creating a new client for every request
-client = None
-
 def get_client():
-    print("Connecting to Bedrock Service: ", ENDPOINT_URL)
-    client = boto3.client(service_name='bedrock-runtime', region_name=AWS_REGION, endpoint_url=ENDPOINT_URL)
-    return client
+    return clients.get_client('bedrock-runtime', AWS_REGION, ENDPOINT_URL)
+
+def get_async_client():
+    return aio.get_client('bedrock-runtime', AWS_REGION, ENDPOINT_URL)
 
-def get_request_body(modelId, parameters, prompt):
-    provider = modelId.split(".")[0]
+def get_request_body(modelId, parameters, prompt, static_prefix=None):
+    provider = models.get_provider(modelId)
     request_body = None
     if provider == "anthropic":
-        # claude-3 models use new messages format
-        if modelId.startswith("anthropic.claude-3"):
+        # claude-3 and later models use new messages format
+        if prompt_cache.is_messages_api(modelId):
+            # mark the static system prompt / prompt prefix as cacheable, for models that support prompt caching
+            system, content = prompt_cache.get_cacheable_request(modelId, parameters.get("system"), prompt, static_prefix)
             request_body = {
                 "anthropic_version": "bedrock-2023-05-31",
-                "messages": [{"role": "user", "content": [{'type':'text','text': prompt}]}],
+                "messages": [{"role": "user", "content": content}],
                 "max_tokens": DEFAULT_MAX_TOKENS
             }
             request_body.update(parameters)
+            if system:
+                request_body["system"] = system
         else:
             request_body = {
                 "prompt": prompt,
@@ -66,14 +82,15 @@ def get_request_body(modelId, parameters, prompt):
     return request_body
 
 def get_generate_text(modelId, response):
-    provider = modelId.split(".")[0]
+    provider = models.get_provider(modelId)
     generated_text = None
     response_body = json.loads(response.get("body").read())
-    print("Response body: ", json.dumps(response_body))
+    log.debug("Response body", modelId=modelId, body=response_body)
     if provider == "anthropic":
-        # claude-3 models use new messages format
-        if modelId.startswith("anthropic.claude-3"):
+        # claude-3 and later models use new messages format
+        if prompt_cache.is_messages_api(modelId):
             generated_text = response_body.get("content")[0].get("text")
+            prompt_cache.record_cache_usage(response, response_body)
         else:
             generated_text = response_body.get("completion")
     elif provider == "ai21":
@@ -88,49 +105,66 @@ def get_generate_text(modelId, response):
         raise Exception("Unsupported provider: ", provider)
     return generated_text
 
-def replace_template_placeholders(prompt, event):
-    # history
-    history_array = json.loads(event["req"]["_userInfo"].get("chatMessageHistory","[]"))
-    history_str = '\n'.join(f"{key}: {value}" for item in history_array for key, value in item.items())
-    prompt = prompt.replace("{history}", history_str)
-    # TODO - replace additional prompt template placeholders - eg query, input, session attributes, user info
-    return prompt
+def summarize_history(modelId, prompt):
+    summary_model_id = HISTORY_SUMMARY_MODEL_ID or modelId
+    return get_llm_response(summary_model_id, {}, format_prompt(summary_model_id, prompt))
+
+def replace_template_placeholders(prompt, event, modelId):
+    # history is only parsed (and summarized) when the prompt uses it
+    values = prompt_template.get_lambdahook_values(
+        event,
+        history=lambda: history.get_history(event, lambda p: summarize_history(modelId, p))
+    )
+    if vector_index.VECTOR_INDEX_S3_URI:
+        # passages are only retrieved when the prompt uses {context}
+        values["context"] = lambda: vector_index.get_context(values["query"])
+    return prompt_template.render(prompt, values)
 
 def format_prompt(modelId, prompt):  
-    provider = modelId.split(".")[0]
+    provider = models.get_provider(modelId)
     if provider == "anthropic":
-        # Claude models prior to v3 required 'Human/Assistant' formatting
-        if not modelId.startswith("anthropic.claude-3"):
-            print("Model provider is Anthropic v2. Checking prompt format.")
+        # Claude models on the text completions API (prior to v3) require 'Human/Assistant' formatting
+        if not prompt_cache.is_messages_api(modelId):
+            log.debug("Model provider is Anthropic v2. Checking prompt format.")
             if not prompt.startswith("\n\nHuman:") or not prompt.startswith("\n\nSystem:"):
                 prompt = "\n\nHuman: " + prompt
-                print("Prepended '\\n\\nHuman:'")
+                log.debug("Prepended '\\n\\nHuman:'")
             if not prompt.endswith("\n\nAssistant:"):
                 prompt = prompt + "\n\nAssistant:"
-                print("Appended '\\n\\nHuman:'")
-    print(f"Prompt: {json.dumps(prompt)}")
+                log.debug("Appended '\\n\\nAssistant:'")
+    log.debug("Prompt", prompt=prompt)
     return prompt
 
-def get_llm_response(modelId, parameters, prompt):
-    global client
-    body = get_request_body(modelId, parameters, prompt)
-    print("ModelId", modelId, "-  Body: ", body)
-    if (client is None):
-        client = get_client()
-    response = client.invoke_model(body=json.dumps(body), modelId=modelId, accept='application/json', contentType='application/json')
-    generated_text = get_generate_text(modelId, response)
+def get_max_tokens(parameters):
+    for key in ["max_tokens", "max_tokens_to_sample", "maxTokens", "maxTokenCount", "max_gen_len"]:
+        if key in parameters:
+            return int(parameters[key])
+    return DEFAULT_MAX_TOKENS
+
+async def get_llm_response_async(modelId, parameters, prompt, static_prefix=None):
+    body = get_request_body(modelId, parameters, prompt, static_prefix)
+    log.debug("Request body", modelId=modelId, body=body)
+    with metrics.timer("ModelInvoke"):
+        response = await get_async_client().invoke_model(body=json.dumps(body), modelId=modelId, accept='application/json', contentType='application/json')
+    # responses are not streamed - the first token arrives with the response
+    metrics.first_token()
+    with metrics.timer("ResponseDecode"):
+        generated_text = get_generate_text(modelId, response)
+    usage.record_usage(modelId, prompt, generated_text, *usage.get_token_counts(response), max_tokens=get_max_tokens(parameters))
     return generated_text
 
+def get_llm_response(modelId, parameters, prompt, static_prefix=None):
+    return aio.run(get_llm_response_async(modelId, parameters, prompt, static_prefix))
+
 def get_args_from_lambdahook_args(event):
     parameters = {}
     lambdahook_args_list = event["res"]["result"].get("args",[])
-    print("LambdaHook args: ", lambdahook_args_list)
+    log.debug("LambdaHook args", args=lambdahook_args_list)
     if len(lambdahook_args_list):
         try:
             parameters = json.loads(lambdahook_args_list[0])
         except Exception as e:
-            print(f"Failed to parse JSON:", lambdahook_args_list[0], e)
-            print("..continuing")
+            log.warning("Failed to parse JSON - continuing", args=lambdahook_args_list[0], error=e)
     return parameters
 
 def format_response(event, llm_response, prefix):
@@ -157,18 +191,46 @@ def format_response(event, llm_response, prefix):
     event["res"]["got_hits"] = 1   
     return event
 
+def warm_up():
+    clients.open_connection(get_client())
+    if vector_index.VECTOR_INDEX_S3_URI:
+        # download and map the index ahead of the first request
+        vector_index.get_index()
+
+@metrics.invocation
+@capture.invocation
+@profiling.profiled
 def lambda_handler(event, context):
-    print("Received event: %s" % json.dumps(event)) 
-    # args = {"Prefix:"<Prefix|None>", "Model_params":{"modelId":"anthropic.claude-instant-v1", "max_tokens":256}, "Prompt":"<prompt>"}
-    args = get_args_from_lambdahook_args(event)
-    model_params = args.get("Model_params",{})
-    modelId = model_params.pop("modelId", DEFAULT_MODEL_ID)
-    # prompt set from args, or from req.question if not specified in args.
-    prompt = args.get("Prompt", event["req"]["question"])
-    prompt = format_prompt(modelId, prompt)
-    prompt = replace_template_placeholders(prompt, event)
-    llm_response = get_llm_response(modelId, model_params, prompt)
+    if warmup.is_warmup_event(event):
+        return warmup.handle(event, context, warm_up)
+    usage.reset()
+    with profiling.track_memory("event_dump"):
+        log.debug("Received event", event=event)
+    # a sample of events, redacted, for load test replay
+    capture.record(event, context, "bedrock-lambdahook")
+    with metrics.timer("Parse"):
+        # args = {"Prefix:"<Prefix|None>", "Model_params":{"modelId":"anthropic.claude-instant-v1", "max_tokens":256}, "Prompt":"<prompt>"}
+        args = get_args_from_lambdahook_args(event)
+        model_params = args.get("Model_params",{})
+        modelId = model_params.pop("modelId", DEFAULT_MODEL_ID)
+    metrics.set_dimensions(ModelId=modelId, Provider=models.get_provider(modelId), CacheHit="false", StreamMode="false")
+    # logged with the metrics, to find the QnA items that cost the most
+    metrics.set_properties(QnAItemId=event["res"]["result"].get("qid"))
+    # includes summarizing older chat history, when the prompt uses {history}
+    with metrics.timer("PromptFormat"):
+        # prompt set from args (a template that may use placeholders), or from req.question if not specified in args.
+        prompt = args.get("Prompt")
+        static_prefix = None
+        if prompt:
+            static_prefix = prompt_cache.get_static_prefix(prompt)
+            prompt = replace_template_placeholders(prompt, event, modelId)
+        else:
+            prompt = event["req"]["question"]
+        prompt = format_prompt(modelId, prompt)
+    llm_response = get_llm_response(modelId, model_params, prompt, static_prefix)
     prefix = args.get("Prefix","LLM Answer:")
-    event = format_response(event, llm_response, prefix)
-    print("Returning response: %s" % json.dumps(event))
+    with metrics.timer("ResponseFormat"):
+        event = format_response(event, llm_response, prefix)
+    with profiling.track_memory("response_dump"):
+        log.debug("Returning response", event=event)
     return event
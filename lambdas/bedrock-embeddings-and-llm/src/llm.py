@@ -1,33 +1,49 @@
-import boto3
 import json
 import os
+import aio
+import batch
+import clients
+import prompt_cache
+import prompt_template
+import compaction
+import log
+import metrics
+import models
+import profiling
+import rephrase
+import usage
+import warmup
 
 # Defaults
 DEFAULT_MODEL_ID = os.environ.get("DEFAULT_MODEL_ID","anthropic.claude-instant-v1")
 AWS_REGION = os.environ["AWS_REGION_OVERRIDE"] if "AWS_REGION_OVERRIDE" in os.environ else os.environ["AWS_REGION"]
 ENDPOINT_URL = os.environ.get("ENDPOINT_URL", f'https://bedrock-runtime.{AWS_REGION}.amazonaws.com')
 DEFAULT_MAX_TOKENS = 256
-
-# global variables - avoid creating a new client for every request
-client = None
+# send a second, parallel request when a model call takes longer than this, e.g. the stack's RecommendedLLMHedgingDelayMs - 0 to disable
+LLM_HEDGING_DELAY_MS = float(os.environ.get("LLM_HEDGING_DELAY_MS") or 0)
 
 def get_client():
-    print("Connecting to Bedrock Service: ", ENDPOINT_URL)
-    client = boto3.client(service_name='bedrock-runtime', region_name=AWS_REGION, endpoint_url=ENDPOINT_URL)
-    return client
+    return clients.get_client('bedrock-runtime', AWS_REGION, ENDPOINT_URL)
+
+def get_async_client():
+    return aio.get_client('bedrock-runtime', AWS_REGION, ENDPOINT_URL)
 
-def get_request_body(modelId, parameters, prompt):
-    provider = modelId.split(".")[0]
+def get_request_body(modelId, parameters, prompt, static_prefix=None):
+    provider = models.get_provider(modelId)
     request_body = None
     if provider == "anthropic":
-        # claude-3 models use new messages format
-        if modelId.startswith("anthropic.claude-3"):
+        # claude-3 and later models use new messages format
+        if prompt_cache.is_messages_api(modelId):
+            # mark the static system prompt / prompt prefix as cacheable, for models that support prompt caching
+            system, content = prompt_cache.get_cacheable_request(modelId, parameters.get("system"), prompt, static_prefix)
             request_body = {
                 "anthropic_version": "bedrock-2023-05-31",
-                "messages": [{"role": "user", "content": [{'type':'text','text': prompt}]}],
+                "messages": [{"role": "user", "content": content}],
                 "max_tokens": DEFAULT_MAX_TOKENS
             }
             request_body.update(parameters)
+            if system:
+                request_body["system"] = system
         else:
             request_body = {
                 "prompt": prompt,
@@ -66,14 +82,15 @@ def get_request_body(modelId, parameters, prompt):
     return request_body
 
 def get_generate_text(modelId, response):
-    provider = modelId.split(".")[0]
+    provider = models.get_provider(modelId)
     generated_text = None
     response_body = json.loads(response.get("body").read())
-    print("Response body: ", json.dumps(response_body))
+    log.debug("Response body", modelId=modelId, body=response_body)
     if provider == "anthropic":
-        # claude-3 models use new messages format
-        if modelId.startswith("anthropic.claude-3"):
+        # claude-3 and later models use new messages format
+        if prompt_cache.is_messages_api(modelId):
             generated_text = response_body.get("content")[0].get("text")
+            prompt_cache.record_cache_usage(response, response_body)
         else:
             generated_text = response_body.get("completion")
     elif provider == "ai21":
@@ -88,17 +105,64 @@ def get_generate_text(modelId, response):
         raise Exception("Unsupported provider: ", provider)
     return generated_text
 
-def call_llm(parameters, prompt):
-    global client
+def get_max_tokens(parameters):
+    for key in ["max_tokens", "max_tokens_to_sample", "maxTokens", "maxTokenCount", "max_gen_len"]:
+        if key in parameters:
+            return int(parameters[key])
+    return DEFAULT_MAX_TOKENS
+
+async def call_llm_async(parameters, prompt):
     modelId = parameters.pop("modelId", DEFAULT_MODEL_ID)
-    body = get_request_body(modelId, parameters, prompt)
-    print("ModelId", modelId, "-  Body: ", body)
-    if (client is None):
-        client = get_client()
-    response = client.invoke_model(body=json.dumps(body), modelId=modelId, accept='application/json', contentType='application/json')
-    generated_text = get_generate_text(modelId, response)
+    metrics.set_dimensions(ModelId=modelId, Provider=models.get_provider(modelId), CacheHit="false", StreamMode="false")
+    with metrics.timer("PromptFormat"):
+        if compaction.PROMPT_COMPACTION_ENABLED:
+            prompt, stats = compaction.compact_prompt(modelId, prompt, get_max_tokens(parameters))
+            log.info("Prompt compaction", **stats)
+            metrics.emit_metric("PromptTokensSaved", stats["tokens_saved"])
+            # compacted / original prompt tokens - 1.0 when nothing was removed
+            metrics.emit_metric("PromptCompactionRatio", round(stats["tokens_after"] / max(1, stats["tokens_before"]), 4), "None")
+        body = get_request_body(modelId, parameters, prompt)
+    log.debug("Request body", modelId=modelId, body=body)
+    request_body = json.dumps(body)
+    with metrics.timer("ModelInvoke"):
+        response = await aio.hedge(lambda: get_async_client().invoke_model(body=request_body, modelId=modelId, accept='application/json', contentType='application/json'), LLM_HEDGING_DELAY_MS / 1000)
+    # responses are not streamed - the first token arrives with the response
+    metrics.first_token()
+    with metrics.timer("ResponseDecode"):
+        generated_text = get_generate_text(modelId, response)
+    usage.record_usage(modelId, prompt, generated_text, *usage.get_token_counts(response), max_tokens=get_max_tokens(parameters))
     return generated_text
 
+def call_llm(parameters, prompt):
+    return aio.run(call_llm_async(parameters, prompt))
+
+
+def get_model_id(parameters):
+    return parameters.get("modelId", DEFAULT_MODEL_ID)
+
+async def generate_async(parameters, prompt):
+    # skip the LLM round trip for query rephrasing when the question is already standalone
+    generated_text = await aio.call(rephrase.get_standalone_question, prompt, get_embeddings)
+    if generated_text is None:
+        generated_text = await call_llm_async(parameters, prompt)
+    return generated_text
+
+def generate(parameters, prompt):
+    return aio.run(generate_async(parameters, prompt))
+
+def get_embeddings(text):
+    # the request and response formats of the embeddings model's provider
+    import embeddings
+    modelId = rephrase.REPHRASE_EMBEDDINGS_MODEL_ID
+    response = get_client().invoke_model(body=embeddings.get_request_body(modelId, [text], "query"), modelId=modelId, accept='application/json', contentType='application/json')
+    return embeddings.decode_response(modelId, [text], response)[0]
+
+def warm_up():
+    # everything a first request would otherwise pay for, except the model call
+    clients.open_connection(get_client())
+    rephrase.get_generate_query_patterns()
+    prompt_cache.get_known_static_prefixes()
+
 
 """
 Example Test Event:
@@ -110,14 +174,32 @@ Example Test Event:
     "system": "You are an AI assistant that always answers in ryhming couplets"
   }
 }
+Batch mode - prompts are run concurrently, and results are returned in order:
+{
+  "prompts": ["\n\nHuman:Why is the sky blue?\n\nAssistant:", {"prompt": "\n\nHuman:Why is grass green?\n\nAssistant:", "parameters": {"temperature": 0.5}}],
+  "parameters": {"modelId": "anthropic.claude-instant-v1", "temperature": 0}
+}
 For supported parameters for each provider model, see Bedrock docs: https://us-east-1.console.aws.amazon.com/bedrock/home?region=us-east-1#/providers
 """
+@metrics.invocation
+@profiling.profiled
 def lambda_handler(event, context):
-    print("Event: ", json.dumps(event))
-    prompt = event["prompt"]
-    parameters = event["parameters"] 
-    generated_text = call_llm(parameters, prompt)
-    print("Result:", json.dumps(generated_text))
-    return {
+    if warmup.is_warmup_event(event):
+        return warmup.handle(event, context, warm_up)
+    usage.reset()
+    with profiling.track_memory("event_dump"):
+        log.debug("Event", event=event)
+    if "prompts" in event:
+        return batch.handle(event, context, generate_async, get_model_id)
+    with metrics.timer("Parse"):
+        # QnABot fills in the prompt template placeholders - only expand any remaining <br> markup
+        prompt = prompt_template.expand_markup(event["prompt"])
+        parameters = event["parameters"] 
+    generated_text = generate(parameters, prompt)
+    log.info("Result", generated_text=generated_text)
+    response = {
         'generated_text': generated_text
-    }
\ No newline at end of file
+    }
+    if usage.RETURN_USAGE:
+        response['usage'] = usage.get_totals()
+    return response
\ No newline at end of file
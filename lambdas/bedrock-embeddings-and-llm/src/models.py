@@ -0,0 +1,15 @@
+# Bedrock model ids. Cross-region inference profile ids prefix the model id with a geography, e.g.
+# us.anthropic.claude-sonnet-4-20250514-v1:0 - some models (e.g. Claude 3.7 Sonnet and Claude 4) can only be
+# invoked on demand through one. Provider and capability checks use the model id without the prefix.
+GEO_PREFIXES = ("us.", "eu.", "apac.", "us-gov.")
+
+
+def get_base_model_id(modelId):
+    for prefix in GEO_PREFIXES:
+        if modelId.startswith(prefix):
+            return modelId[len(prefix):]
+    return modelId
+
+def get_provider(modelId):
+    # e.g. "anthropic" for anthropic.claude-3-haiku-20240307-v1:0 and us.anthropic.claude-sonnet-4-20250514-v1:0
+    return get_base_model_id(modelId).split(".")[0]
@@ -0,0 +1,99 @@
+import functools
+import os
+import log
+import metrics
+import models
+import prompt_template
+from history import estimate_tokens
+
+# Defaults
+PROMPT_CACHING_ENABLED = (os.environ.get("PROMPT_CACHING_ENABLED") or "true").lower() == "true"
+CACHE_CONTROL = {"type": "ephemeral"}
+
+# Anthropic models on the text completions API - every other Claude model (claude-3, claude-sonnet-4, ...) uses the messages API
+TEXT_COMPLETIONS_MODELS = ("anthropic.claude-instant", "anthropic.claude-v")
+
+# Bedrock models that support prompt caching, by modelId prefix, with the minimum number of
+# tokens in a cacheable prefix (shorter prefixes are not cached by the model). The system prompt and
+# static template heads of the default settings.py templates are well below these minimums, so only
+# longer system prompts or LambdaHook prompt templates are cached - see PromptCacheSkipped.
+PROMPT_CACHING_MODELS = {
+    "anthropic.claude-3-5-haiku": 2048,
+    "anthropic.claude-3-7-sonnet": 1024,
+    "anthropic.claude-sonnet-4": 1024,
+    "anthropic.claude-opus-4": 1024
+}
+
+def is_messages_api(modelId):
+    modelId = models.get_base_model_id(modelId)
+    return modelId.startswith("anthropic.") and not modelId.startswith(TEXT_COMPLETIONS_MODELS)
+
+def get_static_prefix(template):
+    # the literal text before the first placeholder is identical for every request
+    segments = prompt_template.compile_template(template).segments
+    return segments[0] if len(segments) > 1 else ""
+
+@functools.lru_cache(maxsize=None)
+def get_known_static_prefixes():
+    # static prefixes of the prompt templates in settings.py, longest first
+    import settings
+    return sorted(set(
+        prefix.strip() for prefix in [
+            get_static_prefix(settings.ANTHROPIC_QA_PROMPT_TEMPLATE),
+            get_static_prefix(settings.ANTHROPIC_GENERATE_QUERY_PROMPT_TEMPLATE)
+        ] if prefix.strip()
+    ), key=len, reverse=True)
+
+
+def get_min_cacheable_tokens(modelId):
+    if not PROMPT_CACHING_ENABLED:
+        return None
+    for prefix, min_tokens in PROMPT_CACHING_MODELS.items():
+        if models.get_base_model_id(modelId).startswith(prefix):
+            return min_tokens
+    return None
+
+def split_prompt(prompt, static_prefix=None):
+    # returns (static, dynamic) parts of the prompt - static is empty if no known prefix matches
+    prefixes = [static_prefix] if static_prefix else get_known_static_prefixes()
+    stripped = prompt.lstrip()
+    for prefix in prefixes:
+        if stripped.startswith(prefix) and len(stripped) > len(prefix):
+            split = len(prompt) - len(stripped) + len(prefix)
+            return prompt[:split], prompt[split:]
+    return "", prompt
+
+def get_cacheable_request(modelId, system, prompt, static_prefix=None):
+    """
+    Returns the messages API 'system' value and user message content, with cache checkpoints
+    after the system prompt and the static prompt prefix, if the model supports prompt caching.
+    """
+    content = [{"type": "text", "text": prompt}]
+    min_tokens = get_min_cacheable_tokens(modelId)
+    if min_tokens is None or not isinstance(system, (str, type(None))):
+        return system, content
+    static, dynamic = split_prompt(prompt, static_prefix)
+    cacheable_tokens = estimate_tokens(system or "") + (estimate_tokens(static) if static else 0)
+    if cacheable_tokens < min_tokens:
+        log.debug("Prompt prefix too short to cache", tokens=cacheable_tokens, min_tokens=min_tokens)
+        metrics.emit_metric("PromptCacheSkipped", 1)
+        return system, content
+    if static:
+        content = [
+            {"type": "text", "text": static, "cache_control": CACHE_CONTROL},
+            {"type": "text", "text": dynamic}
+        ]
+    elif system:
+        system = [{"type": "text", "text": system, "cache_control": CACHE_CONTROL}]
+    return system, content
+
+def record_cache_usage(response, response_body):
+    usage = response_body.get("usage") or {}
+    headers = response.get("ResponseMetadata", {}).get("HTTPHeaders", {})
+    cache_read = usage.get("cache_read_input_tokens", headers.get("x-amzn-bedrock-cache-read-input-token-count"))
+    cache_write = usage.get("cache_creation_input_tokens", headers.get("x-amzn-bedrock-cache-write-input-token-count"))
+    if cache_read is not None:
+        metrics.emit_metric("CacheReadInputTokens", int(cache_read))
+        metrics.set_dimensions(CacheHit="true" if int(cache_read) > 0 else "false")
+    if cache_write is not None:
+        metrics.emit_metric("CacheWriteInputTokens", int(cache_write))
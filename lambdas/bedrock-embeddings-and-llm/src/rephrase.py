@@ -0,0 +1,105 @@
+import functools
+import math
+import os
+import re
+import log
+import metrics
+import prompt_template
+
+# Defaults
+# off: always call the LLM; history: skip when the chat history is empty;
+# heuristic: also skip when the follow up looks self-contained; embeddings: also skip when the
+# follow up is semantically unrelated to the last turn (costs one embeddings call)
+REPHRASE_FAST_PATH = (os.environ.get("REPHRASE_FAST_PATH") or "history").lower()
+REPHRASE_EMBEDDINGS_MODEL_ID = os.environ.get("REPHRASE_EMBEDDINGS_MODEL_ID", "amazon.titan-embed-text-v1")
+REPHRASE_SIMILARITY_THRESHOLD = float(os.environ.get("REPHRASE_SIMILARITY_THRESHOLD") or 0.5)
+REPHRASE_MIN_WORDS = 4
+
+# words that usually refer back to earlier turns, so the follow up is not standalone
+ANAPHORA = set("""it its it's this that these those they them their theirs he him his she her hers
+there then one ones another other others same such former latter above else also more too again""".split())
+WORD = re.compile(r"[\w']+")
+
+
+def compile_generate_query_pattern(template):
+    # a regex that matches a prompt built from the template, capturing {history} and {input}
+    text = prompt_template.expand_markup(template)
+    pattern = []
+    for part in re.split(r"(\{history\}|\{input\})", text):
+        if part in ["{history}", "{input}"]:
+            pattern.append(f"(?P<{part[1:-1]}>.*?)")
+        else:
+            # QnABot may trim or re-flow whitespace, so match any amount of it
+            pattern.append(r"\s*".join(re.escape(word) for word in part.split()))
+    return re.compile(r"\s*" + r"\s*".join(pattern) + r"\s*", re.DOTALL)
+
+@functools.lru_cache(maxsize=None)
+def get_generate_query_patterns():
+    # compiled on first use - settings (and its cfnresponse / urllib3 imports) is not needed at cold start
+    import settings
+    return [
+        compile_generate_query_pattern(template)
+        for template in set([
+            settings.AMAZON_GENERATE_QUERY_PROMPT_TEMPLATE,
+            settings.ANTHROPIC_GENERATE_QUERY_PROMPT_TEMPLATE,
+            settings.AI21_GENERATE_QUERY_PROMPT_TEMPATE,
+            settings.COHERE_GENERATE_QUERY_PROMPT_TEMPLATE,
+            settings.META_GENERATE_QUERY_PROMPT_TEMPLATE
+        ])
+    ]
+
+def parse_generate_query_prompt(prompt):
+    for pattern in get_generate_query_patterns():
+        match = pattern.fullmatch(prompt)
+        if match:
+            return match.group("history").strip(), match.group("input").strip()
+    return None
+
+def is_self_contained(followup):
+    words = [word.lower() for word in WORD.findall(followup)]
+    if len(words) < REPHRASE_MIN_WORDS:
+        return False
+    return not any(word in ANAPHORA for word in words)
+
+def cosine_similarity(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+def get_last_turn(history):
+    lines = [line for line in history.split("\n") if line.strip()]
+    return lines[-1] if lines else ""
+
+def get_fast_path_reason(history, followup, embed_fn=None):
+    mode = REPHRASE_FAST_PATH
+    if not history:
+        return "empty history"
+    if mode in ["heuristic", "embeddings"] and is_self_contained(followup):
+        return "self-contained follow up"
+    if mode == "embeddings" and embed_fn:
+        try:
+            similarity = cosine_similarity(embed_fn(followup), embed_fn(get_last_turn(history)))
+            log.info("Follow up similarity to last turn", similarity=round(similarity, 3))
+            if similarity < REPHRASE_SIMILARITY_THRESHOLD:
+                return "follow up unrelated to history"
+        except Exception as e:
+            log.warning("Failed to compare embeddings", error=e)
+    return None
+
+def get_standalone_question(prompt, embed_fn=None):
+    """
+    If the prompt was built from one of our LLM_GENERATE_QUERY_PROMPT_TEMPLATEs and rephrasing
+    is unnecessary, returns the follow up question as is, otherwise returns None.
+    """
+    if REPHRASE_FAST_PATH == "off":
+        return None
+    parsed = parse_generate_query_prompt(prompt)
+    if parsed is None:
+        return None
+    history, followup = parsed
+    reason = get_fast_path_reason(history, followup, embed_fn)
+    metrics.emit_metric("RephraseSkipped" if reason else "RephraseCalled", 1)
+    if reason:
+        log.info("Skipping query rephrase LLM call", reason=reason)
+        return followup
+    return None
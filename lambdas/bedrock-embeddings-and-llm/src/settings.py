@@ -1,5 +1,9 @@
 import cfnresponse
 import json
+import math
+import log
+import models
+import profiling
 
 # Default prompt templates
 AMAZON_GENERATE_QUERY_PROMPT_TEMPLATE = """Given the following conversation and a follow up question, rephrase the follow up question to be a standalone question.<br>Chat History: <br>{history}<br>Follow up question: {input}<br>Standalone question:"""
@@ -12,20 +16,53 @@ COHERE_GENERATE_QUERY_PROMPT_TEMPLATE = AMAZON_GENERATE_QUERY_PROMPT_TEMPLATE
 COHERE_QA_PROMPT_TEMPLATE = AMAZON_QA_PROMPT_TEMPLATE
 META_GENERATE_QUERY_PROMPT_TEMPLATE = AMAZON_GENERATE_QUERY_PROMPT_TEMPLATE
 META_QA_PROMPT_TEMPLATE = AMAZON_QA_PROMPT_TEMPLATE
+# QnABot embeddings score thresholds (question, answer, text passage) by provider - Cohere and small
+# sentence embedding models (e.g. all-MiniLM-L6-v2) score related texts lower than Titan
+EMBEDDINGS_THRESHOLDS = {
+    "amazon": (0.8, 0.6, 0.7),
+    "cohere": (0.6, 0.4, 0.5),
+    "onnx": (0.7, 0.5, 0.6)
+}
+# minimum successful benchmark calls per model, for recommended settings
+BENCHMARK_MIN_CALLS = 10
 
-def getEmbeddingSettings(modelId):
-    provider = modelId.split(".")[0]
+def getEmbeddingSettings(modelId, backend="bedrock"):
+    # the embeddings function's backend reports the dimensions - an onnx model's are read from its files,
+    # in the layer shared with the embeddings function
+    import embeddings
+    embeddingsBackend = embeddings.get_backend(backend, modelId if backend == "bedrock" else None)
+    provider = "onnx" if backend == "onnx" else models.get_provider(modelId)
+    dimensions = embeddingsBackend.get_dimensions()
+    if provider not in EMBEDDINGS_THRESHOLDS or not dimensions:
+        raise Exception("Unsupported model for embeddings: ", modelId)
+    scoreThreshold, answerThreshold, passageThreshold = EMBEDDINGS_THRESHOLDS[provider]
+    settings = {
+        "EMBEDDINGS_SCORE_THRESHOLD": scoreThreshold,
+        "EMBEDDINGS_SCORE_ANSWER_THRESHOLD": answerThreshold,
+        "EMBEDDINGS_TEXT_PASSAGE_SCORE_THRESHOLD": passageThreshold,
+        "EMBEDDINGS_DIMENSIONS": dimensions
+    }
+    return settings
+
+def getBenchmarkSettings(benchmark):
+    """
+    Recommended client settings, from the deployment benchmark of the TestBedrockModel custom resource:
+    hedge (send a second request) when a call takes longer than the p95 latency, and limit concurrent
+    calls to the level that was measured without throttling.
+    """
     settings = {}
-    # Currently, only Amazon embeddings are supported
-    if provider == "amazon":
-        settings.update({
-            "EMBEDDINGS_SCORE_THRESHOLD": 0.8,
-            "EMBEDDINGS_SCORE_ANSWER_THRESHOLD": 0.6,
-            "EMBEDDINGS_TEXT_PASSAGE_SCORE_THRESHOLD": 0.7,
-            "EMBEDDINGS_DIMENSIONS": 1536
-        })
-    else:
-        raise Exception("Unsupported provider for embeddings: ", provider)    
+    for name, results in [("LLM", benchmark.get("llm", {})), ("EMBEDDINGS", benchmark.get("embeddings", {}))]:
+        successes = results.get("calls", 0) - results.get("errors", 0)
+        # percentiles of a handful of calls are not worth acting on
+        if successes < BENCHMARK_MIN_CALLS:
+            settings[f"RECOMMENDED_{name}_HEDGING_DELAY_MS"] = "n/a"
+            settings[f"RECOMMENDED_{name}_CONCURRENCY"] = "n/a"
+            continue
+        settings[f"RECOMMENDED_{name}_HEDGING_DELAY_MS"] = str(int(math.ceil(results["p95_ms"])))
+        concurrency = results["concurrency"]
+        if results.get("throttle_rate"):
+            concurrency = max(1, int(concurrency * (1 - results["throttle_rate"])))
+        settings[f"RECOMMENDED_{name}_CONCURRENCY"] = str(concurrency)
     return settings
 
 def getModelSettings(modelId):
@@ -34,10 +71,11 @@ def getModelSettings(modelId):
         "temperature": 0
     }
     params_qa = params.copy()
-    # claude-3 message API params are slightly different
-    provider = modelId.split(".")[0]
+    # claude-3 and later message API params are slightly different
+    provider = models.get_provider(modelId)
     if provider == "anthropic":
-        if modelId.startswith("anthropic.claude-3"):
+        import prompt_cache
+        if prompt_cache.is_messages_api(modelId):
             params = {
                 "modelId": modelId,
                 "temperature": 0,
@@ -61,7 +99,7 @@ def getModelSettings(modelId):
         'LLM_QA_MODEL_PARAMS': json.dumps(params_qa),
         'QNAITEM_LAMBDAHOOK_ARGS': json.dumps(lambdahook_args)
     }
-    provider = modelId.split(".")[0]
+    provider = models.get_provider(modelId)
     if provider == "anthropic":
         settings.update({
         'LLM_GENERATE_QUERY_PROMPT_TEMPLATE': ANTHROPIC_GENERATE_QUERY_PROMPT_TEMPLATE,
@@ -91,8 +129,9 @@ def getModelSettings(modelId):
         raise Exception("Unsupported provider: ", provider)
     return settings
 
+@profiling.profiled
 def lambda_handler(event, context): 
-    print("Event: ", json.dumps(event))
+    log.info("Event", event=event)
     status = cfnresponse.SUCCESS
     responseData = {}
     reason = ""
@@ -101,9 +140,11 @@ def lambda_handler(event, context):
             llmModelId = event['ResourceProperties'].get('LLMModelId', '')
             embeddingsModelId = event['ResourceProperties'].get('EmbeddingsModelId', '')
             responseData = getModelSettings(llmModelId)
-            responseData.update(getEmbeddingSettings(embeddingsModelId))
+            embeddingsBackend = event['ResourceProperties'].get('EmbeddingsBackend') or 'bedrock'
+            responseData.update(getEmbeddingSettings(embeddingsModelId, embeddingsBackend))
+            responseData.update(getBenchmarkSettings(json.loads(event['ResourceProperties'].get('Benchmark') or '{}')))
         except Exception as e:
-            print(e)
+            log.error("Failed to get model settings", error=e)
             status = cfnresponse.FAILED
             reason = f"Exception thrown: {e}"              
     cfnresponse.send(event, context, status, responseData, reason=reason) 
\ No newline at end of file
@@ -1,8 +1,190 @@
 import boto3
 import json
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 import cfnresponse
+import clients
+import embeddings
 import llm
+import log
+import profiling
+import usage
+
+# Defaults
+# the checks and benchmark must finish well within the Lambda timeout, since CloudFormation waits for the response
+BENCHMARK_TIME_BUDGET_SECONDS = 40
+BENCHMARK_MAX_CONCURRENCY = 16
+# error codes of throttled Bedrock calls
+THROTTLING_ERROR_CODES = ["ThrottlingException", "ServiceQuotaExceededException", "TooManyRequestsException", "ModelNotReadyException"]
+PROMPT = "\n\nHuman: Why is the sky blue?\n\nAssistant:"
+
+# global variables
+streaming_unsupported = set()
+
+def get_benchmark_client():
+    # no retries, so that throttled calls are counted rather than hidden by retries
+    from botocore.config import Config
+    config = clients.get_client_config().merge(Config(retries={"mode": "standard", "total_max_attempts": 1}))
+    return boto3.client('bedrock-runtime', region_name=llm.AWS_REGION, endpoint_url=llm.ENDPOINT_URL, config=config)
+
+def elapsed_ms(start):
+    return round((time.perf_counter() - start) * 1000, 1)
+
+def percentile(values, p):
+    # nearest rank
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))]
+
+def invoke_embeddings(client, modelId):
+    # an "onnx:" model id selects the onnx backend
+    backend = embeddings.get_backend("bedrock", modelId)
+    start = time.perf_counter()
+    if backend.local:
+        # e.g. onnx - the model runs in this function, so the client isn't used
+        backend.embed([PROMPT])
+    else:
+        response = client.invoke_model(body=embeddings.get_request_body(modelId, [PROMPT]), modelId=modelId, accept='application/json', contentType='application/json')
+        response.get("body").read()
+    latency = elapsed_ms(start)
+    return {"latency_ms": latency, "ttft_ms": latency, "output_tokens": None}
+
+def invoke_llm_stream(client, modelId):
+    # streamed, to measure the time to the first generated token
+    body = llm.get_request_body(modelId, {"temperature": 0}, PROMPT)
+    start = time.perf_counter()
+    response = client.invoke_model_with_response_stream(body=json.dumps(body), modelId=modelId, accept='application/json', contentType='application/json')
+    ttft = None
+    invocation_metrics = {}
+    for event in response["body"]:
+        if "chunk" not in event:
+            # e.g. {"throttlingException": {...}} in the middle of the stream
+            raise Exception(f"Stream error: {next(iter(event))}")
+        if ttft is None:
+            ttft = elapsed_ms(start)
+        chunk = json.loads(event["chunk"]["bytes"])
+        # the last chunk of every provider includes the invocation's token counts
+        invocation_metrics = chunk.get("amazon-bedrock-invocationMetrics", invocation_metrics)
+    return {"latency_ms": elapsed_ms(start), "ttft_ms": ttft, "output_tokens": invocation_metrics.get("outputTokenCount")}
+
+def invoke_llm(client, modelId):
+    # for models that don't support streaming - the first token arrives with the response
+    body = llm.get_request_body(modelId, {"temperature": 0}, PROMPT)
+    start = time.perf_counter()
+    response = client.invoke_model(body=json.dumps(body), modelId=modelId, accept='application/json', contentType='application/json')
+    response.get("body").read()
+    latency = elapsed_ms(start)
+    return {"latency_ms": latency, "ttft_ms": latency, "output_tokens": usage.get_token_counts(response)[1]}
+
+def run_call(call):
+    try:
+        return call()
+    except Exception as e:
+        code = getattr(e, "response", {}).get("Error", {}).get("Code") or type(e).__name__
+        return {"error": code, "throttled": code in THROTTLING_ERROR_CODES}
+
+def get_summary(results, concurrency, elapsed_seconds):
+    successes = [result for result in results if "error" not in result]
+    latencies = [result["latency_ms"] for result in successes]
+    ttfts = [result["ttft_ms"] for result in successes if result["ttft_ms"] is not None]
+    tokens_per_second = [result["output_tokens"] / (result["latency_ms"] / 1000) for result in successes if result["output_tokens"]]
+    throttled = sum(1 for result in results if result.get("throttled"))
+    return {
+        "calls": len(results),
+        "concurrency": concurrency,
+        "errors": len(results) - len(successes),
+        "throttle_rate": round(throttled / len(results), 3) if results else 0,
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "ttft_p50_ms": percentile(ttfts, 50),
+        "ttft_p95_ms": percentile(ttfts, 95),
+        "output_tokens_per_second": round(percentile(tokens_per_second, 50), 1) if tokens_per_second else None,
+        "requests_per_second": round(len(successes) / elapsed_seconds, 2) if elapsed_seconds else None
+    }
+
+def benchmark_model(invoke, modelId, calls, concurrency, warmup, deadline):
+    """
+    Checks that the model responds, then optionally warms up one connection per concurrent caller and
+    makes `calls` calls, `concurrency` at a time, until the deadline. Returns the latency summary.
+    """
+    start = time.perf_counter()
+    # the check uses the retrying client, and raises if the model isn't available
+    check = invoke(llm.get_client(), modelId)
+    if calls <= 0:
+        return get_summary([check], 1, time.perf_counter() - start)
+    client = get_benchmark_client()
+    call = lambda: invoke(client, modelId)
+    if warmup:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(lambda _: run_call(call), range(concurrency)))
+    def run(_):
+        if time.monotonic() > deadline:
+            return None
+        return run_call(call)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = [result for result in executor.map(run, range(calls)) if result is not None]
+    return get_summary(results, concurrency, time.perf_counter() - start)
+
+def invoke_llm_any(client, modelId):
+    # streaming is used when the model supports it
+    if modelId not in streaming_unsupported:
+        try:
+            return invoke_llm_stream(client, modelId)
+        except Exception as e:
+            if getattr(e, "response", {}).get("Error", {}).get("Code") != "ValidationException":
+                raise
+            log.info("Model does not support streaming - time to first token is the full latency", modelId=modelId)
+            streaming_unsupported.add(modelId)
+    return invoke_llm(client, modelId)
+
+def run_checks(properties, context):
+    """
+    Checks (and optionally benchmarks) the embeddings and LLM models in parallel, under a time budget.
+    Returns {"embeddings": summary, "llm": summary}, or raises with the model id that failed.
+    """
+    embeddingsBackend = properties.get('EmbeddingsBackend') or 'bedrock'
+    # the configured backend is checked - the onnx backend has its own model id, e.g. onnx:all-MiniLM-L6-v2
+    embeddingsModelId = embeddings.get_backend(embeddingsBackend, properties.get('EmbeddingsModelId', '') if embeddingsBackend == 'bedrock' else None).model_id
+    llmModelId = properties.get('LLMModelId', '')
+    calls = int(properties.get('BenchmarkCalls') or 0)
+    concurrency = max(1, min(int(properties.get('BenchmarkConcurrency') or 1), BENCHMARK_MAX_CONCURRENCY))
+    warmup = str(properties.get('BenchmarkWarmup', 'true')).lower() == 'true'
+    budget = BENCHMARK_TIME_BUDGET_SECONDS
+    if context is not None:
+        budget = min(budget, context.get_remaining_time_in_millis() / 1000 - 15)
+    deadline = time.monotonic() + budget
+    checks = {
+        "embeddings": (embeddingsModelId, invoke_embeddings),
+        "llm": (llmModelId, invoke_llm_any)
+    }
+    log.info("Testing models", embeddingsModelId=embeddingsModelId, llmModelId=llmModelId, calls=calls, concurrency=concurrency)
+    executor = ThreadPoolExecutor(max_workers=len(checks))
+    futures = {name: executor.submit(benchmark_model, invoke, modelId, calls, concurrency, warmup, deadline) for name, (modelId, invoke) in checks.items()}
+    # calls still in flight at the deadline are abandoned - the remaining time is left for responding to CloudFormation
+    wait(futures.values(), timeout=max(0, deadline - time.monotonic()) + 10)
+    executor.shutdown(wait=False, cancel_futures=True)
+    results = {}
+    for name, future in futures.items():
+        modelId = checks[name][0]
+        if not future.done():
+            raise Exception(f"Timed out testing ModelId='{modelId}'")
+        try:
+            results[name] = future.result()
+        except Exception as e:
+            raise Exception(f"Exception thrown testing ModelId='{modelId}' - {e}") from e
+    return results
+
+def get_response_data(results):
+    # flat attributes for stack outputs, and the full summary for the settings custom resource
+    responseData = {"BENCHMARK": json.dumps(results)}
+    for name, summary in results.items():
+        for key in ["p50_ms", "p95_ms", "ttft_p50_ms", "output_tokens_per_second", "throttle_rate"]:
+            value = summary.get(key)
+            responseData[f"{name.upper()}_{key.upper()}"] = "n/a" if value is None else str(value)
+    return responseData
 
 """
 Example Test Event:
@@ -10,38 +192,27 @@ Example Test Event:
   "RequestType": "Create",
   "ResourceProperties": {
     "EmbeddingsModelId": "amazon.titan-embed-text-v1",
-    "TextModelId": "amazon.titan-text-express-v1"
+    "EmbeddingsBackend": "bedrock",
+    "LLMModelId": "anthropic.claude-instant-v1",
+    "BenchmarkCalls": 20,
+    "BenchmarkConcurrency": 4
   }
 }
 """
+@profiling.profiled
 def lambda_handler(event, context):
-    print("Event: ", json.dumps(event))
-    global client
+    log.info("Event", event=event)
     status = cfnresponse.SUCCESS
     responseData = {}
     reason = "Success"
-    modelId = ""
     if event['RequestType'] != 'Delete':
-        prompt = "\n\nHuman: Why is the sky blue?\n\nAssistant:"
+        properties = event['ResourceProperties']
         try:
-            embeddingsModelId = event['ResourceProperties'].get('EmbeddingsModelId', '')
-            llmModelId = event['ResourceProperties'].get('LLMModelId', '')
-            client = llm.get_client()
-            # Test EmbeddingsModel
-            modelId = embeddingsModelId        
-            body = json.dumps({"inputText": prompt})
-            print(f"Testing {modelId} - {body}")
-            client.invoke_model(body=body, modelId=modelId, accept='application/json', contentType='application/json')
-            # Test LLMModel
-            modelId = llmModelId
-            parameters = {
-                "modelId": modelId,
-                "temperature": 0
-            }
-            print(f"Testing {modelId}")
-            llm.call_llm(parameters, prompt)            
+            results = run_checks(properties, context)
+            log.info("Model benchmark", **results)
+            responseData = get_response_data(results)
         except Exception as e:
             status = cfnresponse.FAILED
-            reason = f"Exception thrown testing ModelId='{modelId}'. Check that Amazon Bedrock is available in your region, and that models ('{embeddingsModelId}' and '{llmModelId}') are activated in your Amazon Bedrock account - {e}"
-    print(f"Status: {status}, Reason: {reason}")        
-    cfnresponse.send(event, context, status, responseData, reason=reason) 
\ No newline at end of file
+            reason = f"{e}. Check that Amazon Bedrock is available in your region, and that models ('{properties.get('EmbeddingsModelId', '')}' and '{properties.get('LLMModelId', '')}') are activated in your Amazon Bedrock account (with EmbeddingsBackend=onnx, that EmbeddingsModelLayerArn contains the model)"
+    log.info("Model test result", status=status, reason=reason)
+    cfnresponse.send(event, context, status, responseData, reason=reason)
@@ -0,0 +1,247 @@
+import contextlib
+import json
+import os
+import random
+import socket
+import time
+import zlib
+import log
+
+# Defaults
+TRACING_EXPORTER = (os.environ.get("TRACING_EXPORTER") or "xray").lower()  # xray | otel | memory | none
+# fraction of traces recorded - the decision is made per trace id, so spans of one request are kept together
+TRACING_SAMPLE_RATE = float(os.environ.get("TRACING_SAMPLE_RATE") or 1.0)
+XRAY_DAEMON_ADDRESS = os.environ.get("AWS_XRAY_DAEMON_ADDRESS") or "127.0.0.1:2000"
+XRAY_HEADER = '{"format": "json", "version": 1}\n'
+
+# global variables
+exporter = None
+# trace id used outside Lambda (no _X_AMZN_TRACE_ID), e.g. in benchmarks
+local_trace_id = None
+
+
+class Span:
+    """
+    A timed external call, with OpenTelemetry style attributes (e.g. gen_ai.request.model).
+    """
+    def __init__(self, name, trace_id, parent_id, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.parent_id = parent_id
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.attributes = {}
+        self.set_attributes(attributes or {})
+        self.start_time = time.time()
+        self.end_time = None
+        self.error = None
+
+    def set_attribute(self, key, value):
+        if value is not None:
+            self.attributes[key] = value
+
+    def set_attributes(self, attributes):
+        for key, value in attributes.items():
+            self.set_attribute(key, value)
+
+    def record_exception(self, exception):
+        self.error = exception
+
+    def end(self):
+        if self.end_time is None:
+            self.end_time = time.time()
+            get_exporter().export(self)
+
+
+class InMemoryExporter:
+    # keeps finished spans, for local runs and benchmarks
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span)
+
+    def clear(self):
+        self.spans = []
+
+
+class XRayExporter:
+    """
+    Sends spans as X-Ray subsegments of the Lambda function segment, over UDP to the X-Ray daemon.
+    """
+    def __init__(self, address=XRAY_DAEMON_ADDRESS):
+        host, port = address.split(" ")[0].split(":")
+        self.address = (host, int(port))
+        self.socket = None
+
+    def get_document(self, span):
+        document = {
+            "type": "subsegment",
+            "id": span.span_id,
+            "trace_id": span.trace_id,
+            "parent_id": span.parent_id,
+            "name": span.name,
+            "namespace": "aws" if "rpc.service" in span.attributes else "remote",
+            "start_time": span.start_time,
+            "end_time": span.end_time,
+            # annotations are indexed for filtering, and keys may only contain letters, numbers and underscores
+            "annotations": {key.replace(".", "_"): value for key, value in span.attributes.items() if isinstance(value, (str, int, float, bool))}
+        }
+        if "rpc.method" in span.attributes:
+            document["aws"] = {"operation": span.attributes["rpc.method"], "request_id": span.attributes.get("aws.request_id"), "retries": span.attributes.get("http.request.resend_count", 0)}
+        if span.error is not None:
+            document["fault"] = True
+            document["cause"] = {"exceptions": [{"id": "%016x" % random.getrandbits(64), "type": type(span.error).__name__, "message": str(span.error)}]}
+        return document
+
+    def export(self, span):
+        if span.parent_id is None:
+            # no Lambda function segment to attach to (active tracing is off)
+            return
+        if self.socket is None:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self.socket.sendto((XRAY_HEADER + json.dumps(self.get_document(span))).encode("utf-8"), self.address)
+        except OSError as e:
+            log.warning("Failed to send trace segment", error=e)
+
+
+class OpenTelemetryExporter:
+    """
+    Replays finished spans into the OpenTelemetry tracer, e.g. from the AWS Distro for OpenTelemetry Lambda layer.
+    """
+    def __init__(self):
+        from opentelemetry import trace
+        self.trace = trace
+        self.tracer = trace.get_tracer("qnabot-plugins")
+
+    def export(self, span):
+        otel_span = self.tracer.start_span(span.name, kind=self.trace.SpanKind.CLIENT, attributes=span.attributes, start_time=int(span.start_time * 1e9))
+        if span.error is not None:
+            otel_span.record_exception(span.error)
+            otel_span.set_status(self.trace.Status(self.trace.StatusCode.ERROR, str(span.error)))
+        otel_span.end(end_time=int(span.end_time * 1e9))
+
+
+class NoopExporter:
+    def export(self, span):
+        pass
+
+
+def get_exporter():
+    global exporter
+    if exporter is None:
+        if TRACING_EXPORTER == "xray":
+            exporter = XRayExporter()
+        elif TRACING_EXPORTER == "otel":
+            exporter = OpenTelemetryExporter()
+        elif TRACING_EXPORTER == "memory":
+            exporter = InMemoryExporter()
+        else:
+            exporter = NoopExporter()
+    return exporter
+
+def get_trace_context():
+    """
+    Returns (trace_id, parent_id, sampled) from the Lambda trace header, e.g.
+    Root=1-5759e988-bd862e3fe1be46a994272793;Parent=53995c3f42cd8ad8;Sampled=1
+    """
+    global local_trace_id
+    header = dict(part.split("=", 1) for part in (os.environ.get("_X_AMZN_TRACE_ID") or "").split(";") if "=" in part)
+    trace_id = header.get("Root")
+    if not trace_id:
+        if local_trace_id is None:
+            local_trace_id = "1-%08x-%024x" % (int(time.time()), random.getrandbits(96))
+        trace_id = local_trace_id
+    sampled = (zlib.crc32(trace_id.encode("utf-8")) % 10000) < TRACING_SAMPLE_RATE * 10000
+    if TRACING_EXPORTER == "xray":
+        # follow the Lambda sampling decision, since only sampled function segments are recorded
+        sampled = sampled and header.get("Sampled") == "1"
+    return trace_id, header.get("Parent"), sampled
+
+def start_span(name, attributes=None):
+    """
+    Starts a span for an external call, or returns None when tracing is off or the trace is not sampled.
+    """
+    if TRACING_EXPORTER == "none":
+        return None
+    trace_id, parent_id, sampled = get_trace_context()
+    if not sampled:
+        return None
+    return Span(name, trace_id, parent_id, attributes)
+
+@contextlib.contextmanager
+def span(name, attributes=None):
+    # e.g. with tracing.span("anthropic.complete", {"gen_ai.request.model": model}) as span: ...
+    current = start_span(name, attributes)
+    try:
+        yield current
+    except Exception as e:
+        if current is not None:
+            current.record_exception(e)
+        raise
+    finally:
+        if current is not None:
+            current.end()
+
+def get_request_attributes(params):
+    # model ids, resource names and request sizes - never secret values or attachment contents
+    attributes = {}
+    if "modelId" in params:
+        attributes["gen_ai.request.model"] = params["modelId"]
+        attributes["gen_ai.system"] = params["modelId"].split(".")[0]
+    if "EndpointName" in params:
+        attributes["gen_ai.request.model"] = params["EndpointName"]
+        attributes["gen_ai.system"] = "sagemaker"
+    if "body" in params or "Body" in params:
+        body = params.get("body", params.get("Body"))
+        attributes["gen_ai.prompt.size"] = len(body) if isinstance(body, (str, bytes)) else None
+    if "userMessage" in params:
+        attributes["gen_ai.system"] = "amazonq"
+        attributes["gen_ai.request.model"] = params.get("applicationId")
+        attributes["gen_ai.prompt.size"] = len(params["userMessage"])
+        attributes["aws.qbusiness.attachments"] = len(params.get("attachments") or [])
+    if "Bucket" in params:
+        attributes["aws.s3.bucket"] = params["Bucket"]
+        attributes["aws.s3.key"] = params.get("Key")
+    if "SecretId" in params:
+        attributes["aws.secretsmanager.secret_id"] = params["SecretId"]
+    return attributes
+
+def get_response_attributes(http_response, parsed):
+    headers = http_response.headers
+    metadata = parsed.get("ResponseMetadata", {})
+    return {
+        "http.response.status_code": http_response.status_code,
+        "http.response.body.size": int(headers["Content-Length"]) if "Content-Length" in headers else None,
+        "gen_ai.usage.input_tokens": int(headers["x-amzn-bedrock-input-token-count"]) if "x-amzn-bedrock-input-token-count" in headers else None,
+        "gen_ai.usage.output_tokens": int(headers["x-amzn-bedrock-output-token-count"]) if "x-amzn-bedrock-output-token-count" in headers else None,
+        "aws.request_id": metadata.get("RequestId"),
+        "http.request.resend_count": metadata.get("RetryAttempts")
+    }
+
+def instrument_client(client):
+    """
+    Wraps every API call of a boto3 client (invoke_model, invoke_endpoint, chat_sync, get_secret_value,
+    get_object, ...) in a span, using botocore's event hooks.
+    """
+    service = client.meta.service_model.service_name
+    def before_call(model, params, context, **kwargs):
+        attributes = {"rpc.system": "aws-api", "rpc.service": service, "rpc.method": model.name, "cloud.region": client.meta.region_name}
+        attributes.update(get_request_attributes(params))
+        context["tracing_span"] = start_span(f"{service}.{model.name}", attributes)
+    def after_call(http_response, parsed, context, **kwargs):
+        current = context.pop("tracing_span", None)
+        if current is not None:
+            current.set_attributes(get_response_attributes(http_response, parsed))
+            if http_response.status_code >= 300:
+                current.record_exception(Exception(parsed.get("Error", {}).get("Code", str(http_response.status_code))))
+            current.end()
+    def after_call_error(exception, context, **kwargs):
+        current = context.pop("tracing_span", None)
+        if current is not None:
+            current.record_exception(exception)
+            current.end()
+    client.meta.events.register("before-parameter-build.*.*", before_call)
+    client.meta.events.register("after-call.*.*", after_call)
+    client.meta.events.register("after-call-error.*.*", after_call_error)
+    return client
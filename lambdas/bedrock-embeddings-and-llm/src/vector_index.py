@@ -0,0 +1,262 @@
+"""
+Local vector index for retrieval in the LambdaHook: top-k cosine search over a memory-mapped embedding
+matrix, with an optional IVF (inverted file) index that only scores the partitions nearest to the query.
+
+The index is the output directory of bulk_embeddings.py, plus the files added by the build command:
+  passages.bin, passages.idx.npy   the text of each row, and its (offset, length) in passages.bin
+  inv_norms.npy                    1 / the norm of each row (0 for unused rows), for cosine scores
+  ivf_centroids.npy, ivf_order.npy, ivf_offsets.npy
+                                   with --partitions: unit length partition centroids, and the rows of
+                                   each partition - ivf_order[ivf_offsets[p]:ivf_offsets[p + 1]]
+  index.json                       the list of files to download
+Upload the directory to S3, and set VECTOR_INDEX_S3_URI to its location.
+
+Usage:
+  python vector_index.py output_dir corpus.jsonl [--partitions 256] [--text-field text]
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import sys
+import aio
+import clients
+import embeddings
+import log
+import metrics
+
+# Defaults
+# e.g. s3://bucket/prefix - unset to disable retrieval
+VECTOR_INDEX_S3_URI = os.environ.get("VECTOR_INDEX_S3_URI")
+VECTOR_INDEX_LOCAL_DIR = os.environ.get("VECTOR_INDEX_LOCAL_DIR") or "/tmp/vector_index"
+VECTOR_INDEX_TOP_K = int(os.environ.get("VECTOR_INDEX_TOP_K") or 3)
+# partitions searched per query, when the index has IVF partitions - more is slower, with better recall
+VECTOR_INDEX_NPROBE = int(os.environ.get("VECTOR_INDEX_NPROBE") or 8)
+VECTOR_INDEX_MIN_SCORE = float(os.environ.get("VECTOR_INDEX_MIN_SCORE") or 0)
+VECTOR_INDEX_SEPARATOR = "\n\n"
+# rows scored at a time by an exhaustive search, to bound the memory used for float16 matrices
+SEARCH_BLOCK_ROWS = 65536
+# k-means training sample per partition, and iterations
+IVF_SAMPLE_PER_PARTITION = 256
+IVF_ITERATIONS = 10
+DTYPES = {"float32": "f32", "float16": "f16"}
+
+# global variables - the index is downloaded and mapped once per Lambda sandbox
+index = None
+
+
+class VectorIndex:
+    """
+    A read-only, memory-mapped index - pages of the matrix and passages are read from disk as they are searched.
+    """
+    def __init__(self, local_dir):
+        import numpy as np
+        with open(os.path.join(local_dir, "manifest.json")) as f:
+            manifest = json.load(f)
+        self.model_id = manifest["model_id"]
+        self.rows = manifest["rows"]
+        self.vectors = np.memmap(os.path.join(local_dir, f"vectors.{DTYPES[manifest['dtype']]}"), dtype=manifest["dtype"], mode="r", shape=(self.rows, manifest["dimensions"]))
+        self.inv_norms = np.load(os.path.join(local_dir, "inv_norms.npy"), mmap_mode="r")
+        self.passage_index = np.load(os.path.join(local_dir, "passages.idx.npy"), mmap_mode="r")
+        passages_path = os.path.join(local_dir, "passages.bin")
+        self.passages = np.memmap(passages_path, dtype=np.uint8, mode="r") if os.path.getsize(passages_path) else np.zeros(0, dtype=np.uint8)
+        self.centroids = None
+        if os.path.exists(os.path.join(local_dir, "ivf_centroids.npy")):
+            self.centroids = np.load(os.path.join(local_dir, "ivf_centroids.npy"))
+            self.order = np.load(os.path.join(local_dir, "ivf_order.npy"), mmap_mode="r")
+            self.offsets = np.load(os.path.join(local_dir, "ivf_offsets.npy"))
+
+    def get_candidates(self, query, nprobe):
+        # rows of the nprobe partitions nearest to the query, in file order for sequential reads
+        import numpy as np
+        nprobe = min(nprobe, len(self.centroids))
+        probe = np.argpartition(self.centroids @ query, -nprobe)[-nprobe:]
+        return np.sort(np.concatenate([self.order[self.offsets[p]:self.offsets[p + 1]] for p in probe]))
+
+    def search(self, vector, top_k=VECTOR_INDEX_TOP_K, nprobe=VECTOR_INDEX_NPROBE):
+        """
+        Returns [(row, score)] of the top_k rows by cosine similarity to vector, best first. Searches
+        the nprobe nearest IVF partitions when the index has them (0 to search every row).
+        """
+        import numpy as np
+        query = np.asarray(vector, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1)
+        if self.centroids is not None and nprobe:
+            rows = self.get_candidates(query, nprobe)
+            scores = (self.vectors[rows].astype(np.float32, copy=False) @ query) * self.inv_norms[rows]
+        else:
+            rows = None
+            scores = np.empty(self.rows, dtype=np.float32)
+            for start in range(0, self.rows, SEARCH_BLOCK_ROWS):
+                end = min(start + SEARCH_BLOCK_ROWS, self.rows)
+                inv_norms = self.inv_norms[start:end]
+                scores[start:end] = (self.vectors[start:end].astype(np.float32, copy=False) @ query) * inv_norms
+                # unused rows are never returned
+                scores[start:end][inv_norms == 0] = -np.inf
+        top_k = min(top_k, len(scores))
+        if not top_k:
+            return []
+        top = np.argpartition(scores, -top_k)[-top_k:]
+        top = top[np.argsort(-scores[top])]
+        return [(int(rows[i] if rows is not None else i), float(scores[i])) for i in top if scores[i] > -np.inf]
+
+    def get_passage(self, row):
+        offset, length = self.passage_index[row]
+        return bytes(self.passages[offset:offset + length]).decode("utf-8")
+
+
+def parse_s3_uri(s3_uri):
+    bucket, _, prefix = s3_uri[len("s3://"):].partition("/")
+    return bucket, prefix.strip("/")
+
+def download_index(s3_uri, local_dir):
+    bucket, prefix = parse_s3_uri(s3_uri)
+    s3 = clients.get_client("s3")
+    os.makedirs(local_dir, exist_ok=True)
+    def download(name):
+        path = os.path.join(local_dir, name)
+        if not os.path.exists(path):
+            # downloaded to a temporary name first, so that an interrupted download is never used
+            s3.download_file(bucket, f"{prefix}/{name}" if prefix else name, path + ".tmp")
+            os.replace(path + ".tmp", path)
+    download("index.json")
+    with open(os.path.join(local_dir, "index.json")) as f:
+        files = json.load(f)["files"]
+    async def download_all():
+        # files are downloaded concurrently
+        await asyncio.gather(*[aio.call(download, name) for name in files])
+    aio.run(download_all())
+
+def get_index():
+    global index
+    if index is None:
+        with metrics.timer("IndexLoad"):
+            download_index(VECTOR_INDEX_S3_URI, VECTOR_INDEX_LOCAL_DIR)
+            index = VectorIndex(VECTOR_INDEX_LOCAL_DIR)
+        log.info("Loaded vector index", s3_uri=VECTOR_INDEX_S3_URI, rows=index.rows, ivf=index.centroids is not None)
+    return index
+
+def get_query_vector(modelId, text):
+    # the query is embedded with the model that embedded the corpus
+    text = embeddings.truncate_text(text.strip(), int(embeddings.EMBEDDING_MAX_WORDS))
+    return aio.run(embeddings.get_backend(modelId=modelId).embed_async([text], "query"))[0]
+
+def get_context(query, top_k=VECTOR_INDEX_TOP_K):
+    """
+    Returns the passages most similar to the query, for the {context} prompt placeholder.
+    """
+    current = get_index()
+    with metrics.timer("QueryEmbedding"):
+        vector = get_query_vector(current.model_id, query)
+    with metrics.timer("Retrieval"):
+        results = [(row, score) for row, score in current.search(vector, top_k) if score >= VECTOR_INDEX_MIN_SCORE]
+    metrics.emit_metric("RetrievedPassages", len(results))
+    if results:
+        metrics.emit_metric("RetrievalTopScore", round(results[0][1], 4), "None")
+    log.debug("Retrieved passages", results=[{"row": row, "score": round(score, 4)} for row, score in results])
+    return VECTOR_INDEX_SEPARATOR.join(current.get_passage(row) for row, _ in results)
+
+
+def write_passages(output_dir, corpus, rows, items):
+    # the text of each row, from the corpus - rows that aren't in the corpus get an empty passage
+    import numpy as np
+    passage_index = np.zeros((rows, 2), dtype=np.int64)
+    offset = 0
+    with open(os.path.join(output_dir, "passages.bin"), "wb") as f:
+        for id, text in corpus:
+            if id not in items:
+                continue
+            data = text.encode("utf-8")
+            f.write(data)
+            passage_index[items[id][0]] = (offset, len(data))
+            offset += len(data)
+    np.save(os.path.join(output_dir, "passages.idx.npy"), passage_index)
+
+def get_inv_norms(vectors, used):
+    import numpy as np
+    inv_norms = np.zeros(len(vectors), dtype=np.float32)
+    for start in range(0, len(vectors), SEARCH_BLOCK_ROWS):
+        norms = np.linalg.norm(vectors[start:start + SEARCH_BLOCK_ROWS].astype(np.float32, copy=False), axis=1)
+        inv_norms[start:start + len(norms)] = np.divide(1, norms, out=np.zeros_like(norms), where=norms > 0)
+    inv_norms[~used] = 0
+    return inv_norms
+
+def train_partitions(vectors, inv_norms, rows, partitions, seed=0):
+    """
+    Spherical k-means on a sample of the rows. Returns (centroids, assignments) for the given rows.
+    """
+    import numpy as np
+    random = np.random.default_rng(seed)
+    sample_rows = np.sort(random.choice(rows, min(len(rows), partitions * IVF_SAMPLE_PER_PARTITION), replace=False))
+    sample = vectors[sample_rows].astype(np.float32, copy=False) * inv_norms[sample_rows, None]
+    centroids = sample[random.choice(len(sample), partitions, replace=False)]
+    for _ in range(IVF_ITERATIONS):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        for p in range(partitions):
+            total = sample[assignments == p].sum(axis=0)
+            norm = np.linalg.norm(total)
+            if norm > 0:
+                centroids[p] = total / norm
+    assignments = np.empty(len(rows), dtype=np.int32)
+    for start in range(0, len(rows), SEARCH_BLOCK_ROWS):
+        block = rows[start:start + SEARCH_BLOCK_ROWS]
+        assignments[start:start + len(block)] = np.argmax((vectors[block].astype(np.float32, copy=False) * inv_norms[block, None]) @ centroids.T, axis=1)
+    return centroids, assignments
+
+def build_index(output_dir, corpus=None, partitions=0):
+    """
+    Adds the passage store (from the corpus), norms and optional IVF partitions to the output of a
+    bulk embedding job, and writes index.json.
+    """
+    import numpy as np
+    with open(os.path.join(output_dir, "manifest.json")) as f:
+        manifest = json.load(f)
+    rows = manifest["rows"]
+    vectors = np.memmap(os.path.join(output_dir, f"vectors.{DTYPES[manifest['dtype']]}"), dtype=manifest["dtype"], mode="r", shape=(rows, manifest["dimensions"]))
+    used = np.zeros(rows, dtype=bool)
+    used[[row for row, _ in manifest["items"].values()]] = True
+    files = ["manifest.json", f"vectors.{DTYPES[manifest['dtype']]}", "inv_norms.npy", "passages.bin", "passages.idx.npy"]
+    write_passages(output_dir, corpus or [], rows, manifest["items"])
+    inv_norms = get_inv_norms(vectors, used)
+    np.save(os.path.join(output_dir, "inv_norms.npy"), inv_norms)
+    partitions = min(partitions, int(used.sum()))
+    if partitions > 1:
+        used_rows = np.flatnonzero(used)
+        centroids, assignments = train_partitions(vectors, inv_norms, used_rows, partitions)
+        # empty partitions are dropped, so that every probed partition has rows
+        counts = np.bincount(assignments, minlength=partitions)
+        centroids = centroids[counts > 0]
+        assignments = (np.cumsum(counts > 0) - 1)[assignments]
+        partitions = len(centroids)
+        order = used_rows[np.argsort(assignments, kind="stable")]
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=partitions))])
+        np.save(os.path.join(output_dir, "ivf_centroids.npy"), centroids.astype(np.float32, copy=False))
+        np.save(os.path.join(output_dir, "ivf_order.npy"), order.astype(np.int64))
+        np.save(os.path.join(output_dir, "ivf_offsets.npy"), offsets.astype(np.int64))
+        files += ["ivf_centroids.npy", "ivf_order.npy", "ivf_offsets.npy"]
+    else:
+        for name in ["ivf_centroids.npy", "ivf_order.npy", "ivf_offsets.npy"]:
+            if os.path.exists(os.path.join(output_dir, name)):
+                os.remove(os.path.join(output_dir, name))
+    with open(os.path.join(output_dir, "index.json"), "w") as f:
+        json.dump({"files": files, "rows": rows, "partitions": partitions if partitions > 1 else 0}, f)
+    return {"rows": rows, "items": int(used.sum()), "partitions": partitions if partitions > 1 else 0}
+
+def main(argv=None):
+    import bulk_embeddings
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("output_dir", help="output directory of bulk_embeddings.py")
+    parser.add_argument("corpus", help="the JSONL corpus that was embedded - the passage text of each item")
+    parser.add_argument("--id-field", default="id")
+    parser.add_argument("--text-field", default="text")
+    parser.add_argument("--partitions", type=int, default=0, help="IVF partitions, e.g. about the square root of the number of items (0 for exhaustive search only)")
+    args = parser.parse_args(argv)
+    stats = build_index(args.output_dir, bulk_embeddings.read_corpus(args.corpus, args.id_field, args.text_field), args.partitions)
+    log.info("Built vector index", **stats, suggested_partitions=int(math.sqrt(stats["items"])))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,293 @@
+import asyncio
+import contextlib
+import math
+import os
+import random
+import threading
+import time
+import uuid
+import aio
+import log
+import metrics
+
+# Defaults
+# endpoints to spread requests over, comma separated, as name or name:variant - otherwise SAGEMAKER_ENDPOINT_NAME
+SAGEMAKER_ENDPOINT_NAMES = os.environ.get("SAGEMAKER_ENDPOINT_NAMES") or os.environ.get("SAGEMAKER_ENDPOINT_NAME", "")
+# "local" (per Lambda sandbox) or "dynamodb" (shared by all sandboxes, in LIMITER_TABLE_NAME) - empty for no limit
+LIMITER_STORE = os.environ.get("LIMITER_STORE") or ""
+LIMITER_TABLE_NAME = os.environ.get("LIMITER_TABLE_NAME") or ""
+LIMITER_INITIAL_LIMIT = float(os.environ.get("LIMITER_INITIAL_LIMIT") or 4)
+LIMITER_MIN_LIMIT = float(os.environ.get("LIMITER_MIN_LIMIT") or 1)
+LIMITER_MAX_LIMIT = float(os.environ.get("LIMITER_MAX_LIMIT") or 64)
+# latency may grow to LIMITER_TOLERANCE times the lowest latency seen before the limit is reduced
+LIMITER_TOLERANCE = float(os.environ.get("LIMITER_TOLERANCE") or 1.5)
+# requests wait up to LIMITER_QUEUE_TIMEOUT_MS for a free slot, then fail fast with EndpointOverloadedError
+LIMITER_QUEUE_TIMEOUT_MS = int(os.environ.get("LIMITER_QUEUE_TIMEOUT_MS") or 2000)
+# waiting requests check for a free slot after LIMITER_POLL_MS, then at doubling intervals of up to LIMITER_MAX_POLL_MS
+LIMITER_POLL_MS = 50
+LIMITER_MAX_POLL_MS = 400
+# weight of each new latency sample in the limit, and in the slow drift of the lowest latency towards recent ones
+LIMITER_SMOOTHING = 0.2
+LIMITER_MIN_LATENCY_DRIFT = 0.01
+# slots that are not released (e.g. by a Lambda that timed out) expire after this long - the function timeout
+LIMITER_LEASE_SECONDS = float(os.environ.get("LIMITER_LEASE_SECONDS") or 900)
+# concurrent releases that change an endpoint's limit are retried on the latest limit this many times
+LIMITER_UPDATE_ATTEMPTS = 3
+# errors that mean the endpoint is overloaded - the limit is halved
+OVERLOAD_ERROR_CODES = ["ThrottlingException", "TooManyRequestsException", "ServiceUnavailable", "ModelNotReadyException", "InternalDependencyException"]
+OVERLOAD_STATUS_CODES = [429, 503]
+
+# global variables - the store is created once per sandbox
+store = None
+
+
+class EndpointOverloadedError(Exception):
+    """
+    Every endpoint was at its concurrency limit for LIMITER_QUEUE_TIMEOUT_MS. The request was not sent -
+    retry later, or fall back to another answer source.
+    """
+
+
+class Endpoint:
+    def __init__(self, spec):
+        self.name, _, self.variant = spec.strip().partition(":")
+        self.key = spec.strip()
+        # decoding steps of the request, set by the caller - latency is compared per step
+        self.steps = 1
+
+def get_endpoints():
+    return [Endpoint(spec) for spec in SAGEMAKER_ENDPOINT_NAMES.split(",") if spec.strip()]
+
+def get_default_state():
+    return {"limit": LIMITER_INITIAL_LIMIT, "inflight": 0, "min_latency": 0}
+
+def get_new_limit(state, latency, overloaded):
+    """
+    Returns (limit, min_latency) after a request. Overload halves the limit (AIMD). Otherwise the limit
+    follows the latency gradient (Vegas / gradient style): it grows by about sqrt(limit) while latency stays
+    within LIMITER_TOLERANCE of the lowest latency seen, and shrinks in proportion as requests queue up
+    in the endpoint and latency rises.
+    """
+    limit, min_latency = state["limit"], state["min_latency"]
+    if overloaded:
+        return max(LIMITER_MIN_LIMIT, limit / 2), min_latency
+    if not min_latency or latency < min_latency:
+        min_latency = latency
+    else:
+        # forgets the lowest latency slowly, in case the endpoint was replaced by a slower one
+        min_latency += (latency - min_latency) * LIMITER_MIN_LATENCY_DRIFT
+    gradient = max(0.5, min(1.0, LIMITER_TOLERANCE * min_latency / latency))
+    new_limit = limit * gradient + math.sqrt(limit)
+    if gradient == 1.0 and state["inflight"] < limit / 2:
+        # the limit isn't raised while it isn't used
+        new_limit = limit
+    limit = limit * (1 - LIMITER_SMOOTHING) + new_limit * LIMITER_SMOOTHING
+    return max(LIMITER_MIN_LIMIT, min(LIMITER_MAX_LIMIT, limit)), min_latency
+
+def is_overload(error):
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError)) or type(error).__name__ in ["ReadTimeoutError", "ConnectTimeoutError"]:
+        return True
+    response = getattr(error, "response", None) or {}
+    code = response.get("Error", {}).get("Code")
+    return code in OVERLOAD_ERROR_CODES or response.get("OriginalStatusCode") in OVERLOAD_STATUS_CODES
+
+
+class LocalStore:
+    """
+    Limiter state in this sandbox's memory - a stand-in for the shared store, and a limit on the
+    concurrent requests of one sandbox (e.g. in batch mode).
+    """
+    def __init__(self):
+        self.states = {}
+        self.lock = threading.Lock()
+
+    def get_state(self, key):
+        return self.states.setdefault(key, get_default_state())
+
+    async def get_states(self, keys):
+        with self.lock:
+            return {key: dict(self.get_state(key)) for key in keys}
+
+    async def try_acquire(self, key, state):
+        with self.lock:
+            state = self.get_state(key)
+            if state["inflight"] >= state["limit"]:
+                return None
+            state["inflight"] += 1
+            return dict(state)
+
+    async def release(self, key, acquired_state, latency, overloaded):
+        with self.lock:
+            state = self.get_state(key)
+            if latency is not None:
+                state["limit"], state["min_latency"] = get_new_limit(state, latency, overloaded)
+            state["inflight"] = max(0, state["inflight"] - 1)
+            return dict(state)
+
+
+class DynamoDBStore:
+    """
+    Limiter state shared by all sandboxes, one item per endpoint. Each request in flight holds a lease in
+    the item's leases map, until it is released or LIMITER_LEASE_SECONDS have passed, so that slots that
+    are never released are freed by the next request. A lease is only added while the item has fewer leases
+    than its limit. The limit is only changed if its version is the one read, so that concurrent releases
+    each apply their change to the latest limit.
+    """
+    def __init__(self, table_name):
+        self.table_name = table_name
+
+    def get_client(self):
+        return aio.get_client("dynamodb")
+
+    @staticmethod
+    def to_state(item):
+        state = get_default_state()
+        for name in ["limit", "min_latency"]:
+            if name in item:
+                state[name] = float(item[name]["N"])
+        state["version"] = int(item["version"]["N"]) if "version" in item else 0
+        now = time.time()
+        leases = {lease: float(value["N"]) for lease, value in item.get("leases", {}).get("M", {}).items()}
+        state["inflight"] = len([expires for expires in leases.values() if expires > now])
+        state["expired"] = [lease for lease, expires in leases.items() if expires <= now]
+        return state
+
+    async def update(self, key, expression, condition=None, names=None, values=None):
+        # the item after the update, or None if the condition failed
+        from botocore.exceptions import ClientError
+        kwargs = {"ConditionExpression": condition} if condition else {}
+        if names:
+            kwargs["ExpressionAttributeNames"] = names
+        if values:
+            kwargs["ExpressionAttributeValues"] = values
+        try:
+            response = await self.get_client().update_item(TableName=self.table_name, Key={"endpoint": {"S": key}}, UpdateExpression=expression, ReturnValues="ALL_NEW", **kwargs)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") != "ConditionalCheckFailedException":
+                raise
+            return None
+        return self.to_state(response["Attributes"])
+
+    async def create(self, key):
+        from botocore.exceptions import ClientError
+        item = {"endpoint": {"S": key}, "limit": {"N": str(LIMITER_INITIAL_LIMIT)}, "min_latency": {"N": "0"}, "version": {"N": "0"}, "leases": {"M": {}}}
+        try:
+            await self.get_client().put_item(TableName=self.table_name, Item=item, ConditionExpression="attribute_not_exists(endpoint)")
+        except ClientError as e:
+            # created by another sandbox
+            if e.response.get("Error", {}).get("Code") != "ConditionalCheckFailedException":
+                raise
+        return self.to_state(item)
+
+    async def get_state(self, key):
+        response = await self.get_client().get_item(TableName=self.table_name, Key={"endpoint": {"S": key}}, ConsistentRead=True)
+        return self.to_state(response.get("Item", {}))
+
+    async def get_states(self, keys):
+        response = await self.get_client().batch_get_item(RequestItems={self.table_name: {"Keys": [{"endpoint": {"S": key}} for key in keys], "ConsistentRead": False}})
+        items = {item["endpoint"]["S"]: item for item in response.get("Responses", {}).get(self.table_name, [])}
+        missing = [key for key in keys if key not in items]
+        created = dict(zip(missing, await asyncio.gather(*[self.create(key) for key in missing])))
+        return {key: self.to_state(items[key]) if key in items else created[key] for key in keys}
+
+    async def try_acquire(self, key, state):
+        if state.get("expired"):
+            # leases of requests that never released them - lease ids are unique, so they can be removed without a condition
+            names = {f"#expired{i}": lease for i, lease in enumerate(state["expired"])}
+            await self.update(key, "REMOVE " + ", ".join(f"leases.{name}" for name in names), names=names)
+        lease = uuid.uuid4().hex
+        new_state = await self.update(key, "SET leases.#lease = :expires", "size(leases) < #limit",
+                                      names={"#lease": lease, "#limit": "limit"},
+                                      values={":expires": {"N": str(time.time() + LIMITER_LEASE_SECONDS)}})
+        if new_state is not None:
+            new_state["lease"] = lease
+        return new_state
+
+    async def release(self, key, acquired_state, latency, overloaded):
+        names = {"#lease": acquired_state["lease"]}
+        state = acquired_state
+        if latency is not None:
+            names["#limit"] = "limit"
+            for attempt in range(LIMITER_UPDATE_ATTEMPTS):
+                limit, min_latency = get_new_limit(state, latency, overloaded)
+                new_state = await self.update(key, "SET #limit = :limit, min_latency = :min_latency, version = :next REMOVE leases.#lease", "version = :version",
+                                              names=names,
+                                              values={":limit": {"N": str(limit)}, ":min_latency": {"N": str(min_latency)},
+                                                      ":version": {"N": str(state["version"])}, ":next": {"N": str(state["version"] + 1)}})
+                if new_state is not None:
+                    return new_state
+                # another release changed the limit since it was read - this change is applied to the latest limit
+                state = await self.get_state(key)
+            log.warning("Concurrency limit not updated - too many concurrent updates", endpoint=key)
+            del names["#limit"]
+        return await self.update(key, "REMOVE leases.#lease", names=names)
+
+
+def get_store():
+    global store
+    if store is None:
+        if LIMITER_STORE == "dynamodb":
+            store = DynamoDBStore(LIMITER_TABLE_NAME)
+        elif LIMITER_STORE == "local" or len(get_endpoints()) > 1:
+            # several endpoints are balanced by their outstanding requests, even without a configured store
+            store = LocalStore()
+    return store
+
+@contextlib.asynccontextmanager
+async def acquire():
+    """
+    Waits for a free slot on the endpoint with the fewest outstanding requests relative to its limit, and
+    yields that Endpoint for the request:
+    async with concurrency_limit.acquire() as endpoint: ...
+    Raises EndpointOverloadedError when no endpoint has a free slot within LIMITER_QUEUE_TIMEOUT_MS. The
+    request's latency (per endpoint.steps) and errors adjust the endpoint's limit.
+    """
+    endpoints = get_endpoints()
+    current = get_store()
+    if current is None:
+        yield endpoints[0]
+        return
+    start = time.monotonic()
+    delay_ms = LIMITER_POLL_MS
+    endpoint, state = None, None
+    while state is None:
+        states = await current.get_states([endpoint.key for endpoint in endpoints])
+        # least outstanding requests first, relative to each endpoint's limit - ties are broken at random
+        candidates = sorted([endpoint for endpoint in endpoints if states[endpoint.key]["inflight"] < states[endpoint.key]["limit"]],
+                            key=lambda endpoint: (states[endpoint.key]["inflight"] / states[endpoint.key]["limit"], random.random()))
+        for endpoint in candidates:
+            state = await current.try_acquire(endpoint.key, states[endpoint.key])
+            if state is not None:
+                break
+        if state is None:
+            waited_ms = (time.monotonic() - start) * 1000
+            if waited_ms >= LIMITER_QUEUE_TIMEOUT_MS:
+                metrics.emit_metric("LimiterRejections", 1)
+                log.warning("Endpoints overloaded - request rejected", endpoints=[endpoint.key for endpoint in endpoints], waited_ms=round(waited_ms))
+                limits = ", ".join(f"{key}: {round(value['limit'], 1)}" for key, value in states.items())
+                raise EndpointOverloadedError(f"All endpoints are at their concurrency limit ({limits})")
+            # backoff, so that queued requests don't read the store at a fixed rate - jittered, so that they don't retry in step
+            await asyncio.sleep(min(delay_ms * (0.5 + random.random()), LIMITER_QUEUE_TIMEOUT_MS - waited_ms) / 1000)
+            delay_ms = min(delay_ms * 2, LIMITER_MAX_POLL_MS)
+    metrics.emit_metric("LimiterQueueTime", round((time.monotonic() - start) * 1000, 3), "Milliseconds")
+    metrics.emit_metric("InFlight", state["inflight"])
+    request_start = time.perf_counter()
+    latency, overloaded = None, False
+    try:
+        yield endpoint
+        latency = (time.perf_counter() - request_start) * 1000 / max(1, endpoint.steps)
+    except Exception as e:
+        overloaded = is_overload(e)
+        # other errors (e.g. an invalid request) say nothing about the endpoint's load
+        latency = (time.perf_counter() - request_start) * 1000 if overloaded else None
+        raise
+    finally:
+        try:
+            new_state = await current.release(endpoint.key, state, latency, overloaded)
+        except Exception as e:
+            # the request's own result or error is returned - a lost release expires after LIMITER_LEASE_SECONDS
+            log.warning("Failed to release concurrency limiter slot", endpoint=endpoint.key, error=e)
+            new_state = state
+        metrics.emit_metric("ConcurrencyLimit", round(new_state["limit"], 2))
+        if overloaded:
+            log.warning("Endpoint overloaded - concurrency limit reduced", endpoint=endpoint.key, limit=round(new_state["limit"], 2))
@@ -0,0 +1,83 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import clients
+import log
+import metrics
+
+# Defaults
+# number of sandboxes each scheduled warm-up ping keeps warm - the sandbox that receives the ping invokes the function for the rest
+WARMUP_CONCURRENCY = int(os.environ.get("WARMUP_CONCURRENCY") or 1)
+# how long each fanned out warm-up invocation keeps its sandbox busy, so that concurrent pings land on different sandboxes
+WARMUP_HOLD_MS = int(os.environ.get("WARMUP_HOLD_MS") or 100)
+
+# global variables - a sandbox is cold until its first invocation
+cold = True
+
+"""
+Example Warm-up Event (EventBridge schedule rule input):
+{
+  "warmup": {"concurrency": 2}
+}
+A plain EventBridge "Scheduled Event" is also recognized.
+"""
+def is_warmup_event(event):
+    """
+    Every lambda_handler calls this first. Real requests mark the sandbox as no longer cold.
+    """
+    global cold
+    if isinstance(event, dict) and ("warmup" in event or (event.get("source") == "aws.events" and event.get("detail-type") == "Scheduled Event")):
+        return True
+    cold = False
+    return False
+
+def get_warmup_args(event):
+    args = event.get("warmup")
+    return args if isinstance(args, dict) else {}
+
+def invoke_concurrently(context, concurrency, hold_ms):
+    # RequestResponse invocations - each keeps one more sandbox busy while this one waits for them all
+    lambda_client = clients.get_client("lambda")
+    payload = json.dumps({"warmup": {"fanout": False, "hold_ms": hold_ms}})
+    def invoke(_):
+        try:
+            lambda_client.invoke(FunctionName=context.invoked_function_arn, InvocationType="RequestResponse", Payload=payload)
+            return True
+        except Exception as e:
+            log.warning("Warm-up invocation failed", error=e)
+            return False
+    with ThreadPoolExecutor(max_workers=concurrency - 1) as executor:
+        return sum(executor.map(invoke, range(concurrency - 1)))
+
+def handle(event, context, *steps):
+    """
+    Runs the handler's warm-up steps - create clients, open pooled connections, prefetch secrets,
+    compile templates - and returns without calling a model. Failed steps are logged and skipped.
+    """
+    global cold
+    was_cold = cold
+    cold = False
+    args = get_warmup_args(event)
+    start = time.perf_counter()
+    errors = []
+    for step in steps:
+        try:
+            step()
+        except Exception as e:
+            log.warning("Warm-up step failed", step=step.__name__, error=e)
+            errors.append(f"{step.__name__}: {e}")
+    warmup_ms = (time.perf_counter() - start) * 1000
+    concurrency = int(args.get("concurrency") or WARMUP_CONCURRENCY)
+    warmed = 1
+    if args.get("fanout", True) and concurrency > 1 and context is not None:
+        warmed += invoke_concurrently(context, concurrency, int(args.get("hold_ms") or WARMUP_HOLD_MS))
+    else:
+        time.sleep(int(args.get("hold_ms") or 0) / 1000.0)
+    metrics.emit_metric("WarmupDuration", round(warmup_ms, 2), "Milliseconds")
+    if was_cold:
+        # warm-up cost paid by a new sandbox, instead of by its first real request
+        metrics.emit_metric("ColdStartWarmupDuration", round(warmup_ms, 2), "Milliseconds")
+    result = {"warmup": True, "cold": was_cold, "warmup_ms": round(warmup_ms, 2), "sandboxes": warmed, "errors": errors}
+    log.info("Warm-up", **result)
+    return result
@@ -0,0 +1,98 @@
+import os
+import threading
+import time
+import log
+import metrics
+import tracing
+
+# Defaults - client settings shared by every AWS and HTTP client in this Lambda
+CLIENT_MAX_POOL_CONNECTIONS = int(os.environ.get("CLIENT_MAX_POOL_CONNECTIONS") or 50)
+CLIENT_CONNECT_TIMEOUT = float(os.environ.get("CLIENT_CONNECT_TIMEOUT") or 5)
+CLIENT_READ_TIMEOUT = float(os.environ.get("CLIENT_READ_TIMEOUT") or 55)
+CLIENT_RETRY_MODE = os.environ.get("CLIENT_RETRY_MODE") or "standard"  # legacy | standard | adaptive
+CLIENT_MAX_ATTEMPTS = int(os.environ.get("CLIENT_MAX_ATTEMPTS") or 3)
+CLIENT_TCP_KEEPALIVE = (os.environ.get("CLIENT_TCP_KEEPALIVE") or "true").lower() == "true"
+DEFAULT_REGION = os.environ.get("AWS_REGION_OVERRIDE") or os.environ.get("AWS_REGION")
+# cached API keys are refetched after this long, so that rotated keys are picked up
+SECRET_CACHE_TTL_SECONDS = int(os.environ.get("SECRET_CACHE_TTL_SECONDS") or 300)
+
+# global variables - clients are created on first use and reused for the lifetime of the sandbox,
+# and boto3 / urllib3 are only imported when a client is first needed, to keep cold starts short
+clients = {}
+secrets = {}
+http = None
+# clients are also created from executor threads (aio.call), and botocore's default session isn't thread-safe
+# for client creation - creation is serialized, cached clients are returned without the lock
+clients_lock = threading.Lock()
+
+
+def get_client_config():
+    from botocore.config import Config
+    return Config(
+        max_pool_connections=CLIENT_MAX_POOL_CONNECTIONS,
+        connect_timeout=CLIENT_CONNECT_TIMEOUT,
+        read_timeout=CLIENT_READ_TIMEOUT,
+        retries={"mode": CLIENT_RETRY_MODE, "total_max_attempts": CLIENT_MAX_ATTEMPTS},
+        tcp_keepalive=CLIENT_TCP_KEEPALIVE
+    )
+
+def get_client(service_name, region_name=None, endpoint_url=None):
+    """
+    Returns the cached client for (service, region, endpoint), creating it with the tuned config on first use.
+    """
+    region_name = region_name or DEFAULT_REGION
+    key = (service_name, region_name, endpoint_url or None)
+    client = clients.get(key)
+    if client is None:
+        with clients_lock:
+            if key not in clients:
+                import boto3
+                client = boto3.client(service_name=service_name, region_name=region_name, endpoint_url=endpoint_url or None, config=get_client_config())
+                tracing.instrument_client(client)
+                # the endpoint is resolved once, when the client is created
+                log.info("Created client", service=service_name, region=region_name, endpoint=client.meta.endpoint_url)
+                clients[key] = client
+            client = clients[key]
+    return client
+
+def open_connection(client):
+    """
+    Opens a keep-alive connection to the client's endpoint in the client's own connection pool, without calling an API.
+    """
+    endpoint_url = client.meta.endpoint_url
+    pool = client._endpoint.http_session._get_connection_manager(endpoint_url).connection_from_url(endpoint_url)
+    # any response will do - the connection is returned to the pool once the response is read
+    pool.urlopen("HEAD", "/", retries=False, redirect=False)
+
+def open_http_connection(url):
+    # same as open_connection, for the urllib3 pool used for third-party APIs
+    get_http().connection_from_url(url).urlopen("HEAD", "/", retries=False, redirect=False)
+
+def get_secret(secret_name):
+    cached = secrets.get(secret_name)
+    if cached and time.monotonic() - cached["time"] < SECRET_CACHE_TTL_SECONDS:
+        return cached["value"]
+    log.info("Getting API key from Secrets Manager", secret_id=secret_name)
+    with metrics.timer("SecretFetch"):
+        response = get_client("secretsmanager").get_secret_value(SecretId=secret_name)
+    secrets[secret_name] = {"value": response['SecretString'], "time": time.monotonic()}
+    return response['SecretString']
+
+def get_http():
+    # the same pool size, timeouts, retries and keep-alive as the AWS clients
+    global http
+    if http is None:
+        with clients_lock:
+            if http is None:
+                import socket
+                import urllib3
+                socket_options = urllib3.connection.HTTPConnection.default_socket_options
+                if CLIENT_TCP_KEEPALIVE:
+                    socket_options = socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+                http = urllib3.PoolManager(
+                    maxsize=CLIENT_MAX_POOL_CONNECTIONS,
+                    timeout=urllib3.Timeout(connect=CLIENT_CONNECT_TIMEOUT, read=CLIENT_READ_TIMEOUT),
+                    retries=urllib3.Retry(total=CLIENT_MAX_ATTEMPTS - 1, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=None, raise_on_status=False),
+                    socket_options=socket_options
+                )
+    return http
@@ -1,12 +1,34 @@
-import boto3
 import json
 import os
 import io
-from typing import Dict
+from typing import Dict, List
+import aio
+import batch
+import clients
+import concurrency_limit
+import log
+import metrics
+import profiling
+import prompt_template
+import sagemaker_async
+import usage
+import warmup
 
 # grab environment variables
 SAGEMAKER_ENDPOINT_NAME = os.environ['SAGEMAKER_ENDPOINT_NAME']
-runtime= boto3.client('runtime.sagemaker')
+
+def get_runtime():
+    return clients.get_client('sagemaker-runtime')
+
+def get_async_runtime():
+    return aio.get_client('sagemaker-runtime')
+
+def warm_up():
+    clients.open_connection(get_runtime())
+    if sagemaker_async.is_enabled():
+        clients.open_connection(clients.get_client("s3"))
+    if concurrency_limit.LIMITER_STORE == "dynamodb":
+        clients.open_connection(clients.get_client("dynamodb"))
 
 def transform_input(prompt: Dict, model_kwargs: Dict) -> bytes:
     input_str = json.dumps(
@@ -17,22 +39,91 @@ def transform_input(prompt: Dict, model_kwargs: Dict) -> bytes:
     )
     return input_str.encode("utf-8")
 
+def transform_inputs(prompts: List, model_kwargs: Dict) -> bytes:
+    # a list of prompts - the endpoint generates them as one batch
+    input_str = json.dumps(
+        {
+            "inputs": prompts,
+            "parameters": model_kwargs,
+        }
+    )
+    return input_str.encode("utf-8")
+
+def transform_outputs(body: bytes) -> List:
+    return [output["generated_text"] for output in json.loads(body.decode("utf-8"))]
+
+
+def get_model_id(parameters):
+    # one endpoint per Lambda
+    return SAGEMAKER_ENDPOINT_NAME
+
+
+async def invoke_endpoint_async(endpoint, data):
+    if sagemaker_async.is_enabled():
+        # asynchronous inference endpoint - the payload is staged in S3, and the output awaited
+        return await sagemaker_async.invoke_endpoint(endpoint.name, data)
+    # a production variant, when the endpoint is configured as name:variant
+    variant = {"TargetVariant": endpoint.variant} if endpoint.variant else {}
+    return await get_async_runtime().invoke_endpoint(EndpointName=endpoint.name,
+                                           ContentType='application/json',
+                                           Body=data,
+                                           **variant)
+
+async def call_llm_packed_async(parameters, prompts):
+    """
+    Generates several prompts with the same parameters in one endpoint request, e.g. for batch mode.
+    Returns one generated text per prompt, in order.
+    """
+    metrics.set_dimensions(ModelId=SAGEMAKER_ENDPOINT_NAME, Provider="sagemaker", StreamMode="false")
+    with metrics.timer("PromptFormat"):
+        data = transform_input(prompts[0], parameters) if len(prompts) == 1 else transform_inputs(prompts, parameters)
+    # the endpoint with the fewest outstanding requests, within its adaptive concurrency limit
+    async with concurrency_limit.acquire() as endpoint:
+        metrics.set_dimensions(ModelId=endpoint.name)
+        with metrics.timer("ModelInvoke"):
+            response = await invoke_endpoint_async(endpoint, data)
+        # responses are not streamed - the first token arrives with the response
+        metrics.first_token()
+        with metrics.timer("ResponseDecode"):
+            generated_texts = transform_outputs(response['Body'].read())
+        # the limiter compares latency per decoding step of the longest generation
+        endpoint.steps = max([usage.estimate_tokens(text) for text in generated_texts], default=1)
+    if len(generated_texts) != len(prompts):
+        raise Exception(f"Endpoint returned {len(generated_texts)} generations for {len(prompts)} prompts")
+    metrics.emit_metric("PackedPrompts", len(prompts))
+    # SageMaker endpoints don't report token counts - they are estimated, and priced only when MODEL_PRICES lists the endpoint
+    for prompt, generated_text in zip(prompts, generated_texts):
+        usage.record_usage(endpoint.name, prompt, generated_text, max_tokens=parameters.get("max_new_tokens"))
+    return generated_texts
+
+async def call_llm_async(parameters, prompt):
+    return (await call_llm_packed_async(parameters, [prompt]))[0]
 
 def call_llm(parameters, prompt):
-    data = transform_input(prompt, parameters)
-    response = runtime.invoke_endpoint(EndpointName=SAGEMAKER_ENDPOINT_NAME,
-                                       ContentType='application/json',
-                                       Body=data)
-    generated_text = json.loads(response['Body'].read().decode("utf-8"))
-    return generated_text[0]["generated_text"]
+    return aio.run(call_llm_async(parameters, prompt))
 
     
+@metrics.invocation
+@profiling.profiled
 def lambda_handler(event, context):
-    print("Event: ", json.dumps(event))
-    prompt = event["prompt"]
-    parameters = event["parameters"] 
+    if warmup.is_warmup_event(event):
+        return warmup.handle(event, context, warm_up)
+    usage.reset()
+    sagemaker_async.set_deadline(context)
+    with profiling.track_memory("event_dump"):
+        log.debug("Event", event=event)
+    if "prompts" in event:
+        # prompts are packed into as few endpoint requests as the token budget allows
+        return batch.handle(event, context, call_llm_async, get_model_id, call_llm_packed_async)
+    with metrics.timer("Parse"):
+        # QnABot fills in the prompt template placeholders - only expand any remaining <br> markup
+        prompt = prompt_template.expand_markup(event["prompt"])
+        parameters = event["parameters"] 
     generated_text = call_llm(parameters, prompt)
-    print("Result:", json.dumps(generated_text))
-    return {
+    log.info("Result", generated_text=generated_text)
+    response = {
         'generated_text': generated_text
     }
+    if usage.RETURN_USAGE:
+        response['usage'] = usage.get_totals()
+    return response
@@ -0,0 +1,103 @@
+import functools
+import json
+import os
+import re
+
+# Defaults
+TEMPLATE_CACHE_SIZE = int(os.environ.get("TEMPLATE_CACHE_SIZE") or 32)
+
+# {{name}} renders a literal {name}, {name} or {name.path} is a placeholder, and QnABot's <br> markup is a newline.
+# Anything else - including braces in JSON or code - is left untouched.
+TOKEN_PATTERN = re.compile(r"\{\{([A-Za-z_][\w.]*)\}\}|\{([A-Za-z_][\w.]*)\}|<br\s*/?>", re.IGNORECASE)
+
+
+class CompiledTemplate:
+    """
+    A prompt template parsed into literal text segments and placeholder names.
+    Rendering is a single pass over the segments, so placeholder values are never re-scanned -
+    a user utterance containing '{history}' is inserted verbatim rather than expanded.
+    """
+    def __init__(self, template, escapes=True):
+        self.segments = []
+        self.placeholders = set()
+        text = []
+        pos = 0
+        for match in TOKEN_PATTERN.finditer(template):
+            text.append(template[pos:match.start()])
+            pos = match.end()
+            if match.group(1):
+                text.append("{" + match.group(1) + "}" if escapes else match.group(0))
+            elif match.group(2):
+                self.segments.append("".join(text))
+                text = []
+                self.segments.append((match.group(2), match.group(0)))
+                self.placeholders.add(match.group(2))
+            else:
+                text.append("\n")
+        text.append(template[pos:])
+        self.segments.append("".join(text))
+
+    def render(self, values):
+        resolved = {}
+        output = []
+        for segment in self.segments:
+            if isinstance(segment, str):
+                output.append(segment)
+                continue
+            name, original = segment
+            if name not in resolved:
+                resolved[name] = resolve_value(values, name)
+            value = resolved[name]
+            # unknown placeholders are left as they are
+            output.append(original if value is None else value)
+        return "".join(output)
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def compile_template(template):
+    return CompiledTemplate(template)
+
+def resolve_value(values, name):
+    # dotted names walk nested dicts, e.g. {session.topic} or {userInfo.Email}
+    value = values
+    for part in name.split("."):
+        if callable(value):
+            value = value()
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    # callables are evaluated lazily, only when the template uses them
+    if callable(value):
+        value = value()
+    if value is None:
+        return None
+    if not isinstance(value, str):
+        value = json.dumps(value)
+    return value
+
+def render(template, values):
+    return compile_template(template).render(values)
+
+# for prompts that QnABot has already filled in - each one is unique, so compile without caching
+def expand_markup(prompt):
+    return CompiledTemplate(prompt, escapes=False).render({})
+
+def get_chat_history(event):
+    history_array = json.loads(event["req"]["_userInfo"].get("chatMessageHistory") or "[]")
+    return '\n'.join(f"{key}: {value}" for item in history_array for key, value in item.items())
+
+def get_lambdahook_values(event, history=None):
+    """
+    Values for the placeholders supported in LambdaHook prompts:
+    {query}, {question}, {input}, {history}, {session.<attribute>} and {userInfo.<attribute>}
+    """
+    req = event["req"]
+    question = req.get("question", "")
+    return {
+        "query": question,
+        "question": question,
+        "input": (req.get("_event") or {}).get("inputTranscript") or question,
+        "history": history or (lambda: get_chat_history(event)),
+        "session": req.get("session") or {},
+        "userInfo": req.get("_userInfo") or {}
+    }
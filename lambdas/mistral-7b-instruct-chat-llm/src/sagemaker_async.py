@@ -0,0 +1,94 @@
+import asyncio
+import io
+import os
+import time
+import uuid
+import aio
+import log
+import metrics
+
+# Defaults
+# s3://bucket/prefix where request payloads are staged - set it to call an asynchronous inference endpoint
+SAGEMAKER_ASYNC_S3_URI = os.environ.get("SAGEMAKER_ASYNC_S3_URI") or ""
+# the output location is polled after SAGEMAKER_ASYNC_POLL_SECONDS, then at doubling intervals of up to SAGEMAKER_ASYNC_MAX_POLL_SECONDS
+SAGEMAKER_ASYNC_POLL_SECONDS = float(os.environ.get("SAGEMAKER_ASYNC_POLL_SECONDS") or 0.5)
+SAGEMAKER_ASYNC_MAX_POLL_SECONDS = float(os.environ.get("SAGEMAKER_ASYNC_MAX_POLL_SECONDS") or 5)
+# time left to return a response after giving up on the output
+SAGEMAKER_ASYNC_DEADLINE_MARGIN_SECONDS = 2
+
+# global variables - the deadline of the current invocation
+deadline = None
+
+
+def is_enabled():
+    return bool(SAGEMAKER_ASYNC_S3_URI)
+
+def set_deadline(context):
+    # called at the start of each invocation - requests give up polling before the Lambda times out
+    global deadline
+    deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - SAGEMAKER_ASYNC_DEADLINE_MARGIN_SECONDS if context is not None else None
+
+def parse_s3_uri(uri):
+    # s3://bucket/prefix -> (bucket, prefix)
+    if not uri.startswith("s3://"):
+        raise Exception(f"Not an S3 URI: {uri}")
+    bucket, _, key = uri[len("s3://"):].partition("/")
+    return bucket, key
+
+def get_input_location(endpoint_name):
+    bucket, prefix = parse_s3_uri(SAGEMAKER_ASYNC_S3_URI)
+    key = "/".join(part for part in [prefix.strip("/"), endpoint_name, f"{uuid.uuid4()}.json"] if part)
+    return bucket, key
+
+async def read_object(uri):
+    # the object's bytes, or None until it has been written
+    from botocore.exceptions import ClientError
+    bucket, key = parse_s3_uri(uri)
+    try:
+        response = await aio.get_client("s3").get_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ["NoSuchKey", "404"]:
+            return None
+        raise
+    return response["Body"].read()
+
+async def wait_for_output(response):
+    """
+    Polls the output and failure locations of an async inference request, with backoff, until one of them
+    is written or the invocation's deadline. Returns the output bytes.
+    """
+    delay = SAGEMAKER_ASYNC_POLL_SECONDS
+    polls = 0
+    try:
+        while True:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                raise TimeoutError(f"Async inference {response.get('InferenceId')} did not finish before the Lambda deadline - its output will be written to {response['OutputLocation']}")
+            await asyncio.sleep(delay if remaining is None else min(delay, remaining))
+            polls += 1
+            locations = [response["OutputLocation"]] + ([response["FailureLocation"]] if response.get("FailureLocation") else [])
+            output, failure = (await asyncio.gather(*[read_object(location) for location in locations]) + [None])[:2]
+            if output is not None:
+                return output
+            if failure is not None:
+                raise Exception(f"Async inference {response.get('InferenceId')} failed: {failure.decode('utf-8', 'replace')[:1000]}")
+            delay = min(delay * 2, SAGEMAKER_ASYNC_MAX_POLL_SECONDS)
+    finally:
+        metrics.emit_metric("AsyncInferencePolls", polls)
+
+async def invoke_endpoint(endpoint_name, data, **kwargs):
+    """
+    Calls an asynchronous inference endpoint: the payload is staged in S3 and submitted with
+    invoke_endpoint_async, then the output is awaited. Returns a response like invoke_endpoint's,
+    so that the caller reads response['Body'] either way.
+    """
+    bucket, key = get_input_location(endpoint_name)
+    with metrics.timer("PayloadUpload"):
+        await aio.get_client("s3").put_object(Bucket=bucket, Key=key, Body=data, ContentType="application/json")
+    response = await aio.get_client("sagemaker-runtime").invoke_endpoint_async(EndpointName=endpoint_name,
+                                                                               ContentType="application/json",
+                                                                               InputLocation=f"s3://{bucket}/{key}",
+                                                                               **kwargs)
+    log.info("Submitted async inference", inference_id=response.get("InferenceId"), output_location=response.get("OutputLocation"))
+    output = await wait_for_output(response)
+    return {"Body": io.BytesIO(output), "InferenceId": response.get("InferenceId")}
@@ -1,5 +1,7 @@
 import cfnresponse
 import json
+import log
+import profiling
 
 # Default prompt temnplates
 MISTRAL_GENERATE_QUERY_PROMPT_TEMPLATE = """<s>[INST] You are a helpful assistant. <br>Here is a chat history in <chatHistory> tags:<br><chatHistory><br>{history}<br></chatHistory><br><br>And here is a follow up question or statement from the human in <followUpMessage> tags:<br><followUpMessage><br>{input}<br></followUpMessage>[/INST]<br><br>[INST]Rephrase the follow up question or statement as a standalone question or statement that makes sense without reading the chat history.[/INST]"""
@@ -23,8 +25,9 @@ def getModelSettings(model):
     
     return settings
 
+@profiling.profiled
 def lambda_handler(event, context): 
-    print("Event: ", json.dumps(event))
+    log.info("Event", event=event)
     status = cfnresponse.SUCCESS
     responseData = {}
     reason = ""
@@ -33,7 +36,7 @@ def lambda_handler(event, context):
             model = event['ResourceProperties'].get('Model', '')
             responseData = getModelSettings(model) 
         except Exception as e:
-            print(e)
+            log.error("Failed to get model settings", error=e)
             status = cfnresponse.FAILED
             reason = f"Exception thrown: {e}"              
     cfnresponse.send(event, context, status, responseData, reason=reason) 
\ No newline at end of file
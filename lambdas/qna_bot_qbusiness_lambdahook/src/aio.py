@@ -0,0 +1,119 @@
+import asyncio
+import contextvars
+import functools
+import threading
+import clients
+
+# Defaults
+# blocking client calls run on a shared executor - one thread per pooled connection
+AIO_MAX_WORKERS = clients.CLIENT_MAX_POOL_CONNECTIONS
+
+# global variables - one event loop per thread (the handler's), and one executor, for the lifetime of the sandbox
+local = threading.local()
+executor = None
+
+
+def get_executor():
+    global executor
+    if executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(max_workers=AIO_MAX_WORKERS, thread_name_prefix="aio")
+    return executor
+
+def get_loop():
+    loop = getattr(local, "loop", None)
+    if loop is None or loop.is_closed():
+        loop = asyncio.new_event_loop()
+        local.loop = loop
+    return loop
+
+def run(coroutine):
+    """
+    Runs a coroutine to completion from synchronous code, e.g. a lambda_handler:
+    generated_text = aio.run(call_llm_async(parameters, prompt))
+    The event loop is reused by later invocations, so it isn't created on every call.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return get_loop().run_until_complete(coroutine)
+    coroutine.close()
+    raise RuntimeError("aio.run() called from a coroutine - await the coroutine instead")
+
+async def call(function, *args, **kwargs):
+    """
+    Runs a blocking call (a boto3 or urllib3 request) on the shared executor, with the calling task's
+    context, so that its trace, stage timings and usage records are kept. A cancelled call stops being
+    awaited, but the request itself runs to completion in its thread.
+    """
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(get_executor(), functools.partial(context.run, function, *args, **kwargs))
+
+
+class AsyncClient:
+    """
+    Async facade of a cached boto3 client - every API method is a coroutine, e.g.
+    response = await aio.get_client("bedrock-runtime").invoke_model(...)
+    Streamed response bodies are read in the executor too, so the event loop never waits on a socket.
+    """
+    def __init__(self, client):
+        self.client = client
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+        @functools.wraps(method)
+        async def call_method(**kwargs):
+            return await call(read_response, method, kwargs)
+        return call_method
+
+def read_response(method, kwargs):
+    import io
+    from botocore.response import StreamingBody
+    response = method(**kwargs)
+    for key in ["body", "Body"]:
+        if isinstance(response.get(key), StreamingBody):
+            response[key] = io.BytesIO(response[key].read())
+    return response
+
+def get_client(service_name, region_name=None, endpoint_url=None):
+    # same cache, config and tracing as clients.get_client
+    return AsyncClient(clients.get_client(service_name, region_name, endpoint_url))
+
+async def request(method, url, **kwargs):
+    # a request on the pooled urllib3 client used for third-party APIs - the response body is preloaded
+    return await call(clients.get_http().request, method, url, **kwargs)
+
+async def get_secret(secret_name):
+    return await call(clients.get_secret, secret_name)
+
+async def race(*awaitables):
+    """
+    Returns the result of the first awaitable to succeed, and cancels the others.
+    Raises the last error if they all fail.
+    """
+    tasks = [asyncio.ensure_future(awaitable) for awaitable in awaitables]
+    error = None
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            try:
+                return await next_done
+            except Exception as e:
+                error = e
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def hedge(make_call, delay_seconds, attempts=2):
+    """
+    Starts make_call(), and starts it again if no attempt has finished after delay_seconds, up to
+    `attempts` in parallel. Returns the first successful result - a hedged call trades extra model
+    calls for a shorter tail latency.
+    """
+    async def attempt(number):
+        if number:
+            await asyncio.sleep(delay_seconds * number)
+        return await make_call()
+    if not delay_seconds or attempts <= 1:
+        return await make_call()
+    return await race(*[attempt(number) for number in range(attempts)])
@@ -1,24 +1,36 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
+import asyncio
 import json
 import os
 import uuid
-import boto3
+import aio
+import capture
+import clients
+import log
+import metrics
+import profiling
+import warmup
 
 AMAZONQ_APP_ID = os.environ.get("AMAZONQ_APP_ID")
 AMAZONQ_REGION = os.environ.get("AMAZONQ_REGION") or os.environ["AWS_REGION"]
 AMAZONQ_ENDPOINT_URL = os.environ.get("AMAZONQ_ENDPOINT_URL") or f'https://qbusiness.{AMAZONQ_REGION}.api.aws'  
-print("AMAZONQ_ENDPOINT_URL:", AMAZONQ_ENDPOINT_URL)
+log.info("AMAZONQ_ENDPOINT_URL", url=AMAZONQ_ENDPOINT_URL)
 
-qbusiness_client = boto3.client(
-    service_name="qbusiness", 
-    region_name=AMAZONQ_REGION,
-    endpoint_url=AMAZONQ_ENDPOINT_URL
-)
+def get_qbusiness_client():
+    return clients.get_client("qbusiness", AMAZONQ_REGION, AMAZONQ_ENDPOINT_URL)
 
-def get_amazonq_response(prompt, context, amazonq_userid, attachments):
-    print(f"get_amazonq_response: prompt={prompt}, app_id={AMAZONQ_APP_ID}, context={context}")
+def get_async_qbusiness_client():
+    return aio.get_client("qbusiness", AMAZONQ_REGION, AMAZONQ_ENDPOINT_URL)
+
+def warm_up():
+    # Amazon Q Business client, and the S3 client used for file attachments
+    clients.open_connection(get_qbusiness_client())
+    clients.open_connection(clients.get_client("s3"))
+
+async def get_amazonq_response_async(prompt, context, amazonq_userid, attachments):
+    log.debug("get_amazonq_response", prompt=prompt, app_id=AMAZONQ_APP_ID, context=context)
     input = {
         "applicationId": AMAZONQ_APP_ID,
         "userMessage": prompt,
@@ -35,71 +47,80 @@ def get_amazonq_response(prompt, context, amazonq_userid, attachments):
     if attachments:
         input["attachments"] = attachments
 
-    print("Amazon Q Input: ", input)
+    # attachment bytes are logged as their size
+    log.debug("Amazon Q Input", input=input)
     try:
-        resp = qbusiness_client.chat_sync(**input)
+        with metrics.timer("ModelInvoke"):
+            resp = await get_async_qbusiness_client().chat_sync(**input)
+        # chat_sync is not streamed - the first token arrives with the response
+        metrics.first_token()
     except Exception as e:
-        print("Amazon Q Exception: ", e)
+        log.error("Amazon Q Exception", error=e)
         resp = {
             "systemMessage": "Amazon Q Error: " + str(e)
         }
-    print("Amazon Q Response: ", json.dumps(resp))
+    log.debug("Amazon Q Response", response=resp)
     return resp
 
+def get_amazonq_response(prompt, context, amazonq_userid, attachments):
+    return aio.run(get_amazonq_response_async(prompt, context, amazonq_userid, attachments))
+
 def get_settings_from_lambdahook_args(event):
     lambdahook_settings = {}
     lambdahook_args_list = event["res"]["result"].get("args",[])
-    print("LambdaHook args: ", lambdahook_args_list)
+    log.debug("LambdaHook args", args=lambdahook_args_list)
     if len(lambdahook_args_list):
         try:
             lambdahook_settings = json.loads(lambdahook_args_list[0])
         except Exception as e:
-            print(f"Failed to parse JSON:", lambdahook_args_list[0], e)
-            print("..continuing")
+            log.warning("Failed to parse JSON - continuing", args=lambdahook_args_list[0], error=e)
     return lambdahook_settings
 
 def get_user_email(event):
     isVerifiedIdentity = event["req"]["_userInfo"].get("isVerifiedIdentity")
     if not isVerifiedIdentity:
-        print("User is not verified identity")
+        log.info("User is not verified identity")
         return "Bot_user_not_verified"
     user_email = event["req"]["_userInfo"].get("Email")
-    print(f"using verified bot user email as user id: {user_email}")
+    log.debug("using verified bot user email as user id", user_id=user_email)
     return user_email
 
 def get_args_from_lambdahook_args(event):
     parameters = {}
     lambdahook_args_list = event["res"]["result"].get("args",[])
-    print("LambdaHook args: ", lambdahook_args_list)
+    log.debug("LambdaHook args", args=lambdahook_args_list)
     if len(lambdahook_args_list):
         try:
             parameters = json.loads(lambdahook_args_list[0])
         except Exception as e:
-            print(f"Failed to parse JSON:", lambdahook_args_list[0], e)
-            print("..continuing")
+            log.warning("Failed to parse JSON - continuing", args=lambdahook_args_list[0], error=e)
     return parameters
 
-def getS3File(s3Path):
+async def getS3FileAsync(s3Path):
     if s3Path.startswith("s3://"):
         s3Path = s3Path[5:]
-    s3 = boto3.resource('s3')
     bucket, key = s3Path.split("/", 1)
-    obj = s3.Object(bucket, key)
-    return obj.get()['Body'].read()
+    with metrics.timer("S3Download"), profiling.track_memory("attachment_read"):
+        response = await aio.get_client("s3").get_object(Bucket=bucket, Key=key)
+        return response['Body'].read()
 
-def getAttachments(event):
+def getS3File(s3Path):
+    return aio.run(getS3FileAsync(s3Path))
+
+async def getAttachmentsAsync(event):
     userFilesUploaded = event["req"]["session"].get("userFilesUploaded",[])
-    attachments = []
     for userFile in userFilesUploaded:
-        print(f"getAttachments: userFile={userFile}")
-        attachments.append({
-            "data": getS3File(userFile["s3Path"]),
-            "name": userFile["fileName"]
-        })
+        log.info("getAttachments", userFile=userFile)
+    # files are downloaded concurrently
+    files = await asyncio.gather(*[getS3FileAsync(userFile["s3Path"]) for userFile in userFilesUploaded])
+    attachments = [{"data": data, "name": userFile["fileName"]} for userFile, data in zip(userFilesUploaded, files)]
     # delete userFilesUploaded from session
     event["res"]["session"].pop("userFilesUploaded",None)
     return attachments
 
+def getAttachments(event):
+    return aio.run(getAttachmentsAsync(event))
+
 def format_response(event, amazonq_response):
     # get settings, if any, from lambda hook args
     # e.g: {"Prefix":"<custom prefix heading>", "ShowContext": False}
@@ -159,20 +180,32 @@ def format_response(event, amazonq_response):
     event["res"]["got_hits"] = 1
     return event
 
+@metrics.invocation
+@capture.invocation
+@profiling.profiled
 def lambda_handler(event, context):
-    print("Received event: %s" % json.dumps(event))
-    args = get_args_from_lambdahook_args(event)
-    # prompt set from args, or from req.question if not specified in args.
-    userInput = args.get("Prompt", event["req"]["question"])
-    qnabotcontext = event["req"]["session"].get("qnabotcontext",{})
-    amazonq_context = qnabotcontext.get("amazonq_context",{})
+    if warmup.is_warmup_event(event):
+        return warmup.handle(event, context, warm_up)
+    with profiling.track_memory("event_dump"):
+        log.debug("Received event", event=event)
+    # a sample of events, redacted, for load test replay
+    capture.record(event, context, "qbusiness-lambdahook")
+    metrics.set_dimensions(ModelId="qbusiness", Provider="amazonq", StreamMode="false")
+    with metrics.timer("Parse"):
+        args = get_args_from_lambdahook_args(event)
+        # prompt set from args, or from req.question if not specified in args.
+        userInput = args.get("Prompt", event["req"]["question"])
+        qnabotcontext = event["req"]["session"].get("qnabotcontext",{})
+        amazonq_context = qnabotcontext.get("amazonq_context",{})
     attachments = getAttachments(event)
     amazonq_userid = os.environ.get("AMAZONQ_USER_ID")
     if not amazonq_userid:
         amazonq_userid = get_user_email(event)
     else:
-        print(f"using configured default user id: {amazonq_userid}")
+        log.debug("using configured default user id", user_id=amazonq_userid)
     amazonq_response = get_amazonq_response(userInput, amazonq_context, amazonq_userid, attachments)
-    event = format_response(event, amazonq_response)
-    print("Returning response: %s" % json.dumps(event))
+    with metrics.timer("ResponseFormat"):
+        event = format_response(event, amazonq_response)
+    with profiling.track_memory("response_dump"):
+        log.debug("Returning response", event=event)
     return event
@@ -0,0 +1,44 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Shared fixtures. Each Lambda has its own src directory with modules of the same name (llm, settings, ...),
+so tests load them in isolation with the benchmarks' handler loader, against the local stub backend.
+"""
+
+import os
+import sys
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, "benchmarks"))
+
+from handlers import load_handler  # noqa: E402
+from stub_backend import StubBackend, stub_environment  # noqa: E402
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+@pytest.fixture
+def load_lambda(monkeypatch):
+    """
+    Returns load(lambda_dir, module_name, **env), which imports a module from lambdas/<lambda_dir>/src with
+    the given environment variables. Call functions that import other modules lazily inside
+    `with loaded.activate():`, so that the imports resolve to the same Lambda.
+    """
+    def load(lambda_dir, module_name, **env):
+        # set in every Lambda runtime
+        monkeypatch.setenv("AWS_REGION", os.environ.get("AWS_REGION", "us-east-1"))
+        for name, value in env.items():
+            monkeypatch.setenv(name, str(value))
+        return load_handler(lambda_dir, module_name)
+    return load
+
+@pytest.fixture
+def stub(monkeypatch):
+    # the local stub backend, with every client pointed at it
+    with StubBackend() as backend:
+        for name, value in stub_environment(backend.url).items():
+            monkeypatch.setenv(name, value)
+        yield backend
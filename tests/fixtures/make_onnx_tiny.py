@@ -0,0 +1,51 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Writes onnx-tiny/, the embeddings model used by the ONNX backend tests: a word-level tokenizer over a
+15 word vocabulary, and a model that looks up an 8 dimensional vector per token (last_hidden_state), so
+that the backend's mean pooling and normalization are exercised. Requires onnx and numpy.
+
+Usage:
+  python tests/fixtures/make_onnx_tiny.py
+"""
+
+import json
+import os
+
+import numpy as np
+import onnx
+from onnx import TensorProto, helper, numpy_helper
+
+VOCAB = ["[UNK]", "[PAD]", "why", "is", "the", "sky", "blue", "sea", "salty", "warm", "up", "dimensions", "a", "b", "c"]
+DIMENSIONS = 8
+OUTPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "onnx-tiny")
+
+
+def main():
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    embeddings = np.random.default_rng(0).standard_normal((len(VOCAB), DIMENSIONS)).astype(np.float32)
+    graph = helper.make_graph(
+        [helper.make_node("Gather", ["E", "input_ids"], ["last_hidden_state"])],
+        "g",
+        [helper.make_tensor_value_info("input_ids", TensorProto.INT64, ["b", "s"]),
+         helper.make_tensor_value_info("attention_mask", TensorProto.INT64, ["b", "s"])],
+        [helper.make_tensor_value_info("last_hidden_state", TensorProto.FLOAT, ["b", "s", DIMENSIONS])],
+        [numpy_helper.from_array(embeddings, "E")])
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+    model.ir_version = 8
+    onnx.checker.check_model(model)
+    onnx.save(model, os.path.join(OUTPUT_DIR, "model.onnx"))
+    tokenizer = {
+        "version": "1.0", "truncation": None, "padding": None, "added_tokens": [], "normalizer": {"type": "Lowercase"},
+        "pre_tokenizer": {"type": "Whitespace"}, "post_processor": None, "decoder": None,
+        "model": {"type": "WordLevel", "vocab": {word: i for i, word in enumerate(VOCAB)}, "unk_token": "[UNK]"}
+    }
+    with open(os.path.join(OUTPUT_DIR, "tokenizer.json"), "w") as f:
+        json.dump(tokenizer, f, indent=2)
+    with open(os.path.join(OUTPUT_DIR, "config.json"), "w") as f:
+        json.dump({"hidden_size": DIMENSIONS}, f)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,24 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import asyncio
+
+import pytest
+
+pytest.importorskip("numpy")
+
+MODEL_ID = "amazon.titan-embed-text-v1"
+
+
+def test_repeated_id_keeps_its_last_text(load_lambda, stub, tmp_path):
+    bulk = load_lambda("bedrock-embeddings-and-llm", "bulk_embeddings", ENDPOINT_URL=stub.url, DEFAULT_MODEL_ID=MODEL_ID)
+    corpus = [("a", "Why is the sky blue?"), ("b", "Why is the sea salty?"), ("a", "Why is the sky dark at night?")]
+    with bulk.activate():
+        store = bulk.VectorStore(str(tmp_path), MODEL_ID, "float32")
+        stats = asyncio.run(bulk.run_job(corpus, store, MODEL_ID, batch_size=1, concurrency=4))
+        ids, vectors = bulk.load_vectors(str(tmp_path))
+    assert stats["embedded"] == 2 and stats["superseded"] == 1 and stats["failed"] == 0
+    # one row per id - no unused rows
+    assert sorted(ids) == ["a", "b"]
+    assert vectors.shape == (2, 1536)
+    assert store.manifest["items"]["a"][1] == bulk.content_hash("Why is the sky dark at night?")
@@ -0,0 +1,67 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import gzip
+import json
+import time
+
+import pytest
+
+import events
+
+LAMBDA_DIRS = ["bedrock-embeddings-and-llm", "qna_bot_qbusiness_lambdahook"]
+
+
+def read_captures(directory):
+    return [json.loads(line) for path in sorted(directory.iterdir()) for line in gzip.open(path, "rt")]
+
+@pytest.fixture(params=LAMBDA_DIRS)
+def load_capture(request, load_lambda, tmp_path):
+    def load(**env):
+        return load_lambda(request.param, "capture", **{"CAPTURE_SAMPLE_RATE": 1, "CAPTURE_OUTPUT_DIR": tmp_path, **env})
+    return load
+
+def make_handler(capture):
+    @capture.invocation
+    def lambda_handler(event, context):
+        capture.record(event, context, "test-lambdahook")
+        return event
+    return lambda_handler
+
+def test_written_when_full(load_capture, tmp_path):
+    capture = load_capture(CAPTURE_FLUSH_EVENTS=2)
+    lambda_handler = make_handler(capture)
+    lambda_handler(events.lambdahook_event(), events.LambdaContext())
+    assert not list(tmp_path.iterdir())
+    lambda_handler(events.lambdahook_event(), events.LambdaContext())
+    assert len(read_captures(tmp_path)) == 2
+
+def test_written_when_old_without_another_capture(load_capture, tmp_path):
+    capture = load_capture(CAPTURE_FLUSH_SECONDS=0.1)
+    lambda_handler = make_handler(capture)
+    lambda_handler(events.lambdahook_event(), events.LambdaContext())
+    assert not list(tmp_path.iterdir())
+    time.sleep(0.2)
+    # a warm-up ping is not captured, but writes the events that are due
+    lambda_handler(events.warmup_event(), events.LambdaContext())
+    captures = read_captures(tmp_path)
+    assert len(captures) == 1
+    assert captures[0]["handler"] == "test-lambdahook"
+
+def test_written_when_the_handler_fails(load_capture, tmp_path):
+    capture = load_capture(CAPTURE_FLUSH_EVENTS=1)
+
+    @capture.invocation
+    def lambda_handler(event, context):
+        capture.record(event, context, "test-lambdahook")
+        raise ValueError("bad request")
+    with pytest.raises(ValueError):
+        lambda_handler(events.lambdahook_event(), events.LambdaContext())
+    assert len(read_captures(tmp_path)) == 1
+
+def test_write_errors_do_not_fail_the_invocation(load_capture, tmp_path):
+    blocked = tmp_path / "blocked"
+    blocked.write_text("not a directory")
+    capture = load_capture(CAPTURE_FLUSH_EVENTS=1, CAPTURE_OUTPUT_DIR=blocked)
+    event = events.lambdahook_event()
+    assert make_handler(capture)(event, events.LambdaContext()) is event
@@ -0,0 +1,31 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+
+
+def test_client_created_once_across_threads(load_lambda, stub, monkeypatch):
+    clients = load_lambda("bedrock-embeddings-and-llm", "clients")
+    created = []
+    create = boto3.client
+
+    def slow_client(*args, **kwargs):
+        # widens the window in which concurrent callers would each create a client
+        created.append(threading.get_ident())
+        time.sleep(0.05)
+        return create(*args, **kwargs)
+    monkeypatch.setattr(boto3, "client", slow_client)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda _: clients.get_client("secretsmanager", endpoint_url=stub.url), range(8)))
+    assert len(created) == 1
+    assert all(client is results[0] for client in results)
+
+def test_http_pool_created_once_across_threads(load_lambda):
+    clients = load_lambda("bedrock-embeddings-and-llm", "clients")
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        pools = list(executor.map(lambda _: clients.get_http(), range(8)))
+    assert all(pool is pools[0] for pool in pools)
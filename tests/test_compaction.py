@@ -0,0 +1,62 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+
+import pytest
+
+import events
+
+PASSAGES = [
+    "Rayleigh scattering causes the sky to appear blue, as shorter wavelengths are scattered more by the air.",
+    "Sunsets are <b>red</b> because sunlight crosses more air at a low angle, and the blue light is scattered away.",
+    "Rayleigh scattering causes the sky to appear blue, as shorter wavelengths are scattered more by the air."
+]
+
+
+@pytest.fixture
+def bedrock(load_lambda):
+    settings = load_lambda("bedrock-embeddings-and-llm", "settings")
+    with settings.activate():
+        import compaction
+        import prompt_template
+    return settings.module, compaction, prompt_template
+
+def qa_templates(settings):
+    return {name: value for name, value in vars(settings).items() if name.endswith("_QA_PROMPT_TEMPLATE")}
+
+def test_shipped_qa_templates_are_compacted(bedrock):
+    settings, compaction, prompt_template = bedrock
+    templates = qa_templates(settings)
+    assert templates
+    for name, template in templates.items():
+        prompt = prompt_template.expand_markup(template.replace("{context}", "\n\n".join(PASSAGES)).replace("{query}", "Why is the sky blue?"))
+        compacted, stats = compaction.compact_prompt("anthropic.claude-v2", prompt, 256)
+        # the exact duplicate is removed, and everything outside the passages is unchanged
+        assert stats["passages_removed"] == 1, name
+        head, _, rest = prompt.partition(PASSAGES[0])
+        tail = rest.rpartition(PASSAGES[2])[2]
+        assert compacted.startswith(head.rstrip()), name
+        assert compacted.endswith(tail.lstrip()), name
+        assert compacted.count(PASSAGES[0]) == 1, name
+        assert "Sunsets are red because" in compacted, name
+
+def test_context_block_starts_at_the_opening_tag(bedrock):
+    _, compaction, _ = bedrock
+    prompt = "Here are reference passages in <references> tags:\n<references>\nfirst passage\n\nfirst passage\n</references>\nQuestion"
+    compacted, stats = compaction.compact_prompt("anthropic.claude-v2", prompt, 256)
+    assert stats["passages_removed"] == 1
+    assert compacted.startswith("Here are reference passages in <references> tags:\n<references>\nfirst passage\n</references>")
+
+def test_only_html_markup_is_removed(bedrock):
+    _, compaction, _ = bedrock
+    assert compaction.normalize_passage("a <p>b</p> <span class='x'>c</span>") == "a b c"
+    assert compaction.normalize_passage("if x <y> z, see <references>") == "if x <y> z, see <references>"
+
+def test_savings_are_emitted_as_metrics(load_lambda, stub, capsys):
+    llm = load_lambda("bedrock-embeddings-and-llm", "llm", ENDPOINT_URL=stub.url, PROMPT_COMPACTION_ENABLED="true")
+    prompt = "Here are reference passages in <references> tags:\n<references>\n" + "\n\n".join(PASSAGES) + "\n</references>\nWhy is the sky blue?"
+    llm.lambda_handler({"prompt": prompt, "parameters": {"modelId": "anthropic.claude-v2"}}, events.LambdaContext())
+    metric_lines = [json.loads(line) for line in capsys.readouterr().out.splitlines() if '"TotalTime"' in line]
+    assert metric_lines[-1]["PromptTokensSaved"] > 0
+    assert 0 < metric_lines[-1]["PromptCompactionRatio"] < 1
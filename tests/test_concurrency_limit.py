@@ -0,0 +1,192 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import asyncio
+import contextlib
+import copy
+import re
+import time
+
+import pytest
+from botocore.exceptions import ClientError
+
+LAMBDA_DIRS = ["llama-2-13b-chat-llm", "mistral-7b-instruct-chat-llm"]
+
+
+class FakeDynamoDB:
+    """
+    An in-memory DynamoDB table for the expressions used by the limiter: SET and REMOVE of attributes and
+    map entries, and size(), = and attribute_not_exists() conditions.
+    """
+    def __init__(self):
+        self.items = {}
+        self.calls = []
+
+    @staticmethod
+    def fail():
+        raise ClientError({"Error": {"Code": "ConditionalCheckFailedException"}}, "UpdateItem")
+
+    @staticmethod
+    def resolve(path, names):
+        return [names.get(part, part) for part in path.strip().split(".")]
+
+    def check(self, item, condition, names, values):
+        for clause in (condition or "").split(" AND "):
+            if not clause:
+                continue
+            match = re.fullmatch(r"attribute_not_exists\((\w+)\)", clause.strip())
+            if match:
+                if match.group(1) in item:
+                    self.fail()
+                continue
+            match = re.fullmatch(r"size\((\w+)\) < (#?\w+)", clause.strip())
+            if match:
+                if len(item[match.group(1)]["M"]) >= float(item[names.get(match.group(2), match.group(2))]["N"]):
+                    self.fail()
+                continue
+            name, value = [part.strip() for part in clause.split("=")]
+            if item.get(names.get(name, name)) != values[value]:
+                self.fail()
+
+    async def batch_get_item(self, RequestItems):
+        self.calls.append("batch_get_item")
+        (table, request), = RequestItems.items()
+        return {"Responses": {table: [copy.deepcopy(self.items[key["endpoint"]["S"]]) for key in request["Keys"] if key["endpoint"]["S"] in self.items]}}
+
+    async def get_item(self, TableName, Key, ConsistentRead=False):
+        self.calls.append("get_item")
+        item = self.items.get(Key["endpoint"]["S"])
+        return {"Item": copy.deepcopy(item)} if item else {}
+
+    async def put_item(self, TableName, Item, ConditionExpression=None):
+        self.calls.append("put_item")
+        self.check(self.items.get(Item["endpoint"]["S"], {}), ConditionExpression, {}, {})
+        self.items[Item["endpoint"]["S"]] = copy.deepcopy(Item)
+
+    async def update_item(self, TableName, Key, UpdateExpression, ReturnValues, ConditionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None):
+        self.calls.append("update_item")
+        names, values = ExpressionAttributeNames or {}, ExpressionAttributeValues or {}
+        item = self.items[Key["endpoint"]["S"]]
+        self.check(item, ConditionExpression, names, values)
+        for action, clause in re.findall(r"(SET|REMOVE) (.*?)(?= SET | REMOVE |$)", UpdateExpression):
+            for part in clause.split(","):
+                if action == "SET":
+                    path, value = part.split("=")
+                    path = self.resolve(path, names)
+                    target = item[path[0]]["M"] if len(path) == 2 else item
+                    target[path[-1]] = values[value.strip()]
+                else:
+                    path = self.resolve(part, names)
+                    (item[path[0]]["M"] if len(path) == 2 else item).pop(path[-1], None)
+        return {"Attributes": copy.deepcopy(item)}
+
+
+@contextlib.asynccontextmanager
+async def hold(limiter, count):
+    # count slots acquired at once - yields their endpoints
+    async with contextlib.AsyncExitStack() as exits:
+        yield [await exits.enter_async_context(limiter.acquire()) for _ in range(count)]
+
+
+@pytest.fixture(params=LAMBDA_DIRS)
+def load_limiter(request, load_lambda):
+    def load(**env):
+        return load_lambda(request.param, "concurrency_limit", SAGEMAKER_ENDPOINT_NAMES="llama-a,llama-b", **env)
+    return load
+
+@pytest.fixture
+def table():
+    return FakeDynamoDB()
+
+def get_shared_limiter(load_limiter, table, **env):
+    limiter = load_limiter(LIMITER_STORE="dynamodb", LIMITER_TABLE_NAME="limits", **env)
+    store = limiter.get_store()
+    store.get_client = lambda: table
+    return limiter, store
+
+def test_limit_and_balance(load_limiter):
+    limiter = load_limiter(LIMITER_STORE="local", LIMITER_INITIAL_LIMIT=2, LIMITER_QUEUE_TIMEOUT_MS=100)
+
+    async def run():
+        async with hold(limiter, 4) as endpoints:
+            assert sorted(endpoint.name for endpoint in endpoints) == ["llama-a", "llama-a", "llama-b", "llama-b"]
+            with pytest.raises(limiter.EndpointOverloadedError):
+                async with limiter.acquire():
+                    pass
+    asyncio.run(run())
+
+def test_queued_requests_back_off(load_limiter, monkeypatch):
+    limiter = load_limiter(LIMITER_STORE="local", LIMITER_INITIAL_LIMIT=1, LIMITER_QUEUE_TIMEOUT_MS=1000)
+    store = limiter.get_store()
+    polls = []
+    get_states = store.get_states
+
+    async def counted_get_states(keys):
+        polls.append(time.monotonic())
+        return await get_states(keys)
+    monkeypatch.setattr(store, "get_states", counted_get_states)
+
+    async def run():
+        async with hold(limiter, 3):
+            pass
+    with pytest.raises(limiter.EndpointOverloadedError):
+        asyncio.run(run())
+    # 2 acquired, then a second of waiting - at a fixed 50 ms interval it would be about 20 polls
+    assert len(polls) - 2 <= 9
+
+def test_shared_limit(load_limiter, table):
+    limiter, store = get_shared_limiter(load_limiter, table, LIMITER_INITIAL_LIMIT=2, LIMITER_QUEUE_TIMEOUT_MS=100)
+
+    async def run():
+        async with hold(limiter, 4) as endpoints:
+            assert sorted(endpoint.name for endpoint in endpoints) == ["llama-a", "llama-a", "llama-b", "llama-b"]
+            assert [len(item["leases"]["M"]) for item in table.items.values()] == [2, 2]
+            with pytest.raises(limiter.EndpointOverloadedError):
+                async with limiter.acquire():
+                    pass
+    asyncio.run(run())
+    # every lease was released
+    assert [len(item["leases"]["M"]) for item in table.items.values()] == [0, 0]
+
+def test_unreleased_leases_expire(load_limiter, table):
+    limiter, store = get_shared_limiter(load_limiter, table, LIMITER_INITIAL_LIMIT=1, LIMITER_LEASE_SECONDS=0.2, LIMITER_QUEUE_TIMEOUT_MS=50)
+
+    async def run():
+        # requests of Lambdas that timed out - never released
+        for key, state in (await store.get_states(["llama-a", "llama-b"])).items():
+            assert await store.try_acquire(key, state) is not None
+        with pytest.raises(limiter.EndpointOverloadedError):
+            async with limiter.acquire():
+                pass
+        await asyncio.sleep(0.3)
+        async with limiter.acquire() as endpoint:
+            # the expired lease was removed, and this request holds the only one
+            assert len(table.items[endpoint.key]["leases"]["M"]) == 1
+    asyncio.run(run())
+
+def test_concurrent_releases_apply_both_changes(load_limiter, table):
+    limiter, store = get_shared_limiter(load_limiter, table, LIMITER_INITIAL_LIMIT=8)
+
+    async def run():
+        states = await store.get_states(["llama-a"])
+        first = await store.try_acquire("llama-a", states["llama-a"])
+        second = await store.try_acquire("llama-a", states["llama-a"])
+        # both read the limit at version 0, and both halve it
+        await store.release("llama-a", first, 1000, True)
+        return await store.release("llama-a", second, 1000, True)
+    state = asyncio.run(run())
+    assert state["limit"] == 2
+    assert state["version"] == 2
+    assert state["inflight"] == 0
+    assert table.calls.count("get_item") == 1
+
+def test_errors_that_are_not_overload_keep_the_limit(load_limiter, table):
+    limiter, store = get_shared_limiter(load_limiter, table)
+
+    async def run():
+        with pytest.raises(ValueError):
+            async with limiter.acquire():
+                raise ValueError("invalid request")
+    asyncio.run(run())
+    assert [item["version"]["N"] for item in table.items.values()] == ["0", "0"]
+    assert [len(item["leases"]["M"]) for item in table.items.values()] == [0, 0]
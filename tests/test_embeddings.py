@@ -0,0 +1,50 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+
+import events
+
+TEXTS = ["Why is the sky blue?", "Why is the sea salty?"]
+
+
+def load_embeddings(load_lambda, stub, modelId, **env):
+    return load_lambda("bedrock-embeddings-and-llm", "embeddings", ENDPOINT_URL=stub.url, DEFAULT_MODEL_ID=modelId, **env)
+
+def test_input_type_per_call(load_lambda, stub):
+    embeddings = load_embeddings(load_lambda, stub, "cohere.embed-english-v3")
+    assert embeddings.get_input_type({"inputText": TEXTS[0]}) == "query"
+    assert embeddings.get_input_type({"inputTexts": TEXTS}) == "document"
+    assert embeddings.get_input_type({"inputText": TEXTS[0], "inputType": "document"}) == "document"
+    assert embeddings.get_input_type({"inputTexts": TEXTS, "inputType": "search_query"}) == "search_query"
+    # QnABot's own input types are not Cohere's
+    assert embeddings.get_input_type({"inputText": TEXTS[0], "inputType": "q"}) == "query"
+    body = json.loads(embeddings.get_request_body("cohere.embed-english-v3", TEXTS, "query"))
+    assert body["input_type"] == "search_query"
+    body = json.loads(embeddings.get_request_body("cohere.embed-english-v3", TEXTS))
+    assert body["input_type"] == "search_document"
+
+def test_input_type_from_environment(load_lambda, stub):
+    embeddings = load_embeddings(load_lambda, stub, "cohere.embed-english-v3", EMBEDDINGS_INPUT_TYPE="document")
+    assert embeddings.get_input_type({"inputText": TEXTS[0]}) == "document"
+    assert embeddings.get_input_type({"inputText": TEXTS[0], "inputType": "query"}) == "query"
+
+def test_titan_response_fields(load_lambda, stub):
+    embeddings = load_embeddings(load_lambda, stub, "amazon.titan-embed-text-v1")
+    single = embeddings.lambda_handler({"inputText": TEXTS[0]}, events.LambdaContext())
+    assert set(single) == {"embedding", "inputTextTokenCount"}
+    assert len(single["embedding"]) == 1536
+    batch = embeddings.lambda_handler({"inputTexts": TEXTS}, events.LambdaContext())
+    assert len(batch["embeddings"]) == len(TEXTS)
+    # one request per text
+    assert batch["inputTextTokenCount"] == single["inputTextTokenCount"] * len(TEXTS)
+
+def test_cohere_response_fields(load_lambda, stub):
+    embeddings = load_embeddings(load_lambda, stub, "cohere.embed-english-v3")
+    single = embeddings.lambda_handler({"inputText": TEXTS[0]}, events.LambdaContext())
+    assert len(single["embedding"]) == 1024
+    assert "texts" not in single
+    batch = embeddings.lambda_handler({"inputTexts": TEXTS * 60}, events.LambdaContext())
+    assert len(batch["embeddings"]) == 120
+    # 120 texts in two requests
+    assert len([r for r in stub.requests if r["service"] == "bedrock"]) == 3
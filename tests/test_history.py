@@ -0,0 +1,57 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+
+import pytest
+
+
+def make_event(turns, session=None):
+    history = [{"Human": f"question {i}"} if i % 2 == 0 else {"AI": f"answer {i}"} for i in range(turns)]
+    return {
+        "req": {"_userInfo": {"chatMessageHistory": json.dumps(history)}, "session": {"qnabotcontext": session or {}}},
+        "res": {"session": {}}
+    }
+
+def verbatim_turns(history_str):
+    return [line for line in history_str.splitlines() if not line.startswith("Summary of earlier conversation")]
+
+@pytest.fixture
+def history(load_lambda):
+    return load_lambda("bedrock-embeddings-and-llm", "history")
+
+def test_window_is_capped_while_turns_are_batched(history):
+    prompts = []
+
+    def summarize_fn(prompt):
+        prompts.append(prompt)
+        return "summary"
+    # 2 turns out of the window, below the batch of 4 - not summarized yet, and not sent verbatim
+    event = make_event(8)
+    history_str = history.get_history(event, summarize_fn, max_turns=6, max_tokens=1000, batch=4)
+    assert verbatim_turns(history_str) == [f"{'Human' if i % 2 == 0 else 'AI'}: {'question' if i % 2 == 0 else 'answer'} {i}" for i in range(2, 8)]
+    assert not prompts
+    # 4 turns out of the window - folded into the summary and cached
+    event = make_event(10)
+    history_str = history.get_history(event, summarize_fn, max_turns=6, max_tokens=1000, batch=4)
+    assert len(verbatim_turns(history_str)) == 6
+    assert history_str.startswith("Summary of earlier conversation: summary")
+    assert len(prompts) == 1
+    assert event["res"]["session"]["qnabotcontext"][history.SESSION_CONTEXT_KEY]["summary"] == "summary"
+
+def test_failed_summary_keeps_turns_for_later(history, capsys):
+    def failing_summarize_fn(prompt):
+        raise Exception("model unavailable")
+    session = {history.SESSION_CONTEXT_KEY: {"summary": "earlier summary", "last": None}}
+    event = make_event(10, session)
+    history_str = history.get_history(event, failing_summarize_fn, max_turns=6, max_tokens=1000, batch=4)
+    # the cached summary and the window of recent turns, and nothing marked as summarized
+    assert history_str.startswith("Summary of earlier conversation: earlier summary")
+    assert len(verbatim_turns(history_str)) == 6
+    assert history.SESSION_CONTEXT_KEY not in event["res"]["session"].get("qnabotcontext", {})
+    assert '"HistorySummaryFailures": 1' in capsys.readouterr().out
+    # the next turn folds in the same turns
+    prompts = []
+    event = make_event(10, session)
+    history.get_history(event, lambda prompt: prompts.append(prompt) or "new summary", max_turns=6, max_tokens=1000, batch=4)
+    assert "question 0" in prompts[0] and "earlier summary" in prompts[0]
@@ -0,0 +1,82 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import shutil
+
+import pytest
+
+from conftest import FIXTURES_DIR
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("onnxruntime")
+pytest.importorskip("tokenizers")
+
+MODEL_DIR = os.path.join(FIXTURES_DIR, "onnx-tiny")
+TEXTS = ["why is the sky blue", "sea", "why is the sea salty", "a b c", "the sky", "blue blue blue sky is warm"]
+
+
+def load_embeddings(load_lambda, model_dir=MODEL_DIR, **env):
+    return load_lambda("bedrock-embeddings-and-llm", "embeddings", EMBEDDINGS_BACKEND="onnx", EMBEDDINGS_ONNX_MODEL_DIR=model_dir, **env)
+
+def test_load(load_lambda):
+    embeddings = load_embeddings(load_lambda)
+    with embeddings.activate():
+        backend = embeddings.get_backend()
+        assert backend.model_id == "onnx:onnx-tiny"
+        assert backend.session is None
+        backend.load()
+        assert backend.session is not None
+        assert {"input_ids", "attention_mask"} <= backend.input_names
+        assert embeddings.get_backend() is backend
+        with pytest.raises(Exception):
+            embeddings.get_backend("onnx", "onnx:another-model")
+
+def test_batches_keep_the_order_of_the_texts(load_lambda):
+    embeddings = load_embeddings(load_lambda, EMBEDDINGS_ONNX_BATCH_SIZE=2)
+    with embeddings.activate():
+        backend = embeddings.get_backend()
+        batched = backend.embed(TEXTS)
+        single = [backend.embed([text])[0] for text in TEXTS]
+    assert len(batched) == len(TEXTS)
+    for vector, expected in zip(batched, single):
+        assert np.allclose(vector, expected, atol=1e-6)
+    # different texts have different vectors, so a reordering would be detected
+    assert not np.allclose(single[0], single[1])
+
+def test_vectors_are_normalized(load_lambda):
+    embeddings = load_embeddings(load_lambda)
+    with embeddings.activate():
+        vectors = embeddings.get_backend().embed(TEXTS)
+    assert np.allclose(np.linalg.norm(np.asarray(vectors), axis=1), 1.0, atol=1e-5)
+
+def test_dimensions_from_config(load_lambda):
+    embeddings = load_embeddings(load_lambda)
+    with embeddings.activate():
+        backend = embeddings.get_backend()
+        assert backend.get_dimensions() == 8
+        # read from config.json, without loading the model
+        assert backend.session is None
+
+def test_dimensions_from_inference(load_lambda, tmp_path):
+    model_dir = tmp_path / "onnx-tiny"
+    shutil.copytree(MODEL_DIR, model_dir, ignore=shutil.ignore_patterns("config.json"))
+    embeddings = load_embeddings(load_lambda, str(model_dir))
+    with embeddings.activate():
+        assert embeddings.get_backend().get_dimensions() == 8
+
+def test_settings_report_dimensions(load_lambda):
+    settings = load_lambda("bedrock-embeddings-and-llm", "settings", EMBEDDINGS_BACKEND="onnx", EMBEDDINGS_ONNX_MODEL_DIR=MODEL_DIR)
+    with settings.activate():
+        result = settings.getEmbeddingSettings("", "onnx")
+    assert result["EMBEDDINGS_DIMENSIONS"] == 8
+    assert result["EMBEDDINGS_SCORE_THRESHOLD"] == settings.EMBEDDINGS_THRESHOLDS["onnx"][0]
+
+def test_handler(load_lambda):
+    import events
+    embeddings = load_embeddings(load_lambda)
+    single = embeddings.lambda_handler({"inputText": "why is the sky blue"}, events.LambdaContext())
+    batch = embeddings.lambda_handler({"inputTexts": TEXTS}, events.LambdaContext())
+    assert len(single["embedding"]) == 8
+    assert len(batch["embeddings"]) == len(TEXTS)
+    assert np.allclose(single["embedding"], batch["embeddings"][0], atol=1e-6)
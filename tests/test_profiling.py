@@ -0,0 +1,29 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+
+import events
+
+
+def make_handler(profiling):
+    @profiling.profiled
+    def lambda_handler(event, context):
+        return {"answer": sum(range(1000))}
+    return lambda_handler
+
+def test_profile_written(load_lambda, tmp_path):
+    profiling = load_lambda("bedrock-embeddings-and-llm", "profiling", PROFILING_OUTPUT_DIR=tmp_path)
+    context = events.LambdaContext()
+    assert make_handler(profiling)({"profile": True}, context) == {"answer": 499500}
+    with open(tmp_path / f"benchmark-{context.aws_request_id}.json") as f:
+        assert json.load(f)["request_id"] == context.aws_request_id
+
+def test_write_errors_do_not_fail_the_invocation(load_lambda, tmp_path, capsys):
+    # e.g. /tmp is full - here the output directory is a file
+    blocked = tmp_path / "blocked"
+    blocked.write_text("not a directory")
+    profiling = load_lambda("bedrock-embeddings-and-llm", "profiling", PROFILING_OUTPUT_DIR=blocked)
+    assert make_handler(profiling)({"profile": True}, events.LambdaContext()) == {"answer": 499500}
+    assert "Failed to write profile" in capsys.readouterr().out
+    assert profiling.profiler is None
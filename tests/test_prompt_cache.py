@@ -0,0 +1,92 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+
+import events
+
+LONG_SYSTEM_PROMPT = "You are a helpful AI assistant. " + events.PASSAGE * 20
+
+
+def load_llm(load_lambda, stub):
+    return load_lambda("bedrock-embeddings-and-llm", "llm", ENDPOINT_URL=stub.url)
+
+def test_messages_api_models(load_lambda, stub):
+    llm = load_llm(load_lambda, stub)
+    with llm.activate():
+        import prompt_cache
+        for modelId in ["anthropic.claude-3-sonnet-20240229-v1:0", "anthropic.claude-sonnet-4-20250514-v1:0", "anthropic.claude-opus-4-20250514-v1:0"]:
+            assert prompt_cache.is_messages_api(modelId)
+            assert "messages" in llm.get_request_body(modelId, {}, "Why is the sky blue?")
+        for modelId in ["anthropic.claude-instant-v1", "anthropic.claude-v2:1"]:
+            assert not prompt_cache.is_messages_api(modelId)
+            assert "prompt" in llm.get_request_body(modelId, {}, "Why is the sky blue?")
+
+def test_claude_4_prefix_is_cached(load_lambda, stub):
+    llm = load_llm(load_lambda, stub)
+    with llm.activate():
+        body = llm.get_request_body("anthropic.claude-sonnet-4-20250514-v1:0", {"system": LONG_SYSTEM_PROMPT}, "Why is the sky blue?")
+    assert body["system"][0]["cache_control"] == {"type": "ephemeral"}
+
+def test_default_qa_settings_are_too_short_to_cache(load_lambda, stub, capsys):
+    llm = load_llm(load_lambda, stub)
+    with llm.activate():
+        import settings
+        params_qa = settings.getModelSettings("anthropic.claude-3-7-sonnet-20250219-v1:0")
+        parameters = json.loads(params_qa["LLM_QA_MODEL_PARAMS"])
+        parameters.pop("modelId")
+        body = llm.get_request_body("anthropic.claude-3-7-sonnet-20250219-v1:0", parameters, settings.ANTHROPIC_QA_PROMPT_TEMPLATE)
+    assert isinstance(body["system"], str)
+    assert all("cache_control" not in block for block in body["messages"][0]["content"])
+    assert '"PromptCacheSkipped": 1' in capsys.readouterr().out
+
+def test_cache_hits_are_recorded(load_lambda, stub, capsys):
+    llm = load_llm(load_lambda, stub)
+    event = {"prompt": "Why is the sky blue?", "parameters": {"modelId": "anthropic.claude-sonnet-4-20250514-v1:0", "system": LONG_SYSTEM_PROMPT}}
+    llm.lambda_handler(json.loads(json.dumps(event)), events.LambdaContext())
+    capsys.readouterr()
+    response = llm.lambda_handler(json.loads(json.dumps(event)), events.LambdaContext())
+    assert response["generated_text"]
+    metric_lines = [json.loads(line) for line in capsys.readouterr().out.splitlines() if '"TotalTime"' in line]
+    assert metric_lines[-1]["CacheHit"] == "true"
+    assert metric_lines[-1]["CacheReadInputTokens"] > 1024
+
+def test_lambdahook_caches_claude_4_template_head(load_lambda, stub, capsys):
+    lambdahook = load_lambda("bedrock-embeddings-and-llm", "lambdahook", ENDPOINT_URL=stub.url)
+    template = LONG_SYSTEM_PROMPT + "\n\nQuestion: {query}"
+    for modelId in ["anthropic.claude-3-7-sonnet-20250219-v1:0", "anthropic.claude-sonnet-4-20250514-v1:0", "anthropic.claude-opus-4-20250514-v1:0"]:
+        # messages API prompts are not wrapped in Human / Assistant turns, so the template head is still a prefix
+        with lambdahook.activate():
+            prompt = lambdahook.format_prompt(modelId, template.replace("{query}", "Why is the sky blue?"))
+            body = lambdahook.get_request_body(modelId, {}, prompt, lambdahook.prompt_cache.get_static_prefix(template))
+        assert body["messages"][0]["content"][0]["cache_control"] == {"type": "ephemeral"}
+        capsys.readouterr()
+        event = events.lambdahook_event(args={"Prompt": template, "Model_params": {"modelId": modelId}})
+        response = lambdahook.lambda_handler(event, events.LambdaContext())
+        assert response["res"]["message"]
+        output = capsys.readouterr().out
+        assert '"PromptCacheSkipped"' not in output
+        metric_lines = [json.loads(line) for line in output.splitlines() if '"TotalTime"' in line]
+        # the stub cache is keyed on the prefix alone, so later models read what the first one wrote
+        assert metric_lines[-1]["CacheWriteInputTokens"] + metric_lines[-1]["CacheReadInputTokens"] > 1024
+    with lambdahook.activate():
+        assert lambdahook.format_prompt("anthropic.claude-v2:1", "Why is the sky blue?") == "\n\nHuman: Why is the sky blue?\n\nAssistant:"
+
+def test_inference_profile_ids(load_lambda, stub):
+    llm = load_llm(load_lambda, stub)
+    modelId = "us.anthropic.claude-sonnet-4-20250514-v1:0"
+    with llm.activate():
+        import compaction
+        import models
+        import prompt_cache
+        import usage
+        assert models.get_provider(modelId) == "anthropic"
+        assert models.get_provider("anthropic.claude-v2:1") == "anthropic"
+        assert prompt_cache.is_messages_api(modelId)
+        assert prompt_cache.get_min_cacheable_tokens(modelId) == 1024
+        assert compaction.get_input_budget(modelId, 0) == compaction.get_input_budget("anthropic.claude-sonnet-4-20250514-v1:0", 0)
+        assert usage.get_price("us.anthropic.claude-3-haiku-20240307-v1:0") == usage.get_price("anthropic.claude-3-haiku-20240307-v1:0")
+        body = llm.get_request_body(modelId, {"system": LONG_SYSTEM_PROMPT}, "Why is the sky blue?")
+    assert body["system"][0]["cache_control"] == {"type": "ephemeral"}
+    response = llm.lambda_handler({"prompt": "Why is the sky blue?", "parameters": {"modelId": modelId}}, events.LambdaContext())
+    assert response["generated_text"]
@@ -0,0 +1,66 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+import time
+
+import pytest
+
+import events
+
+# the stub endpoint answers in the Llama 2 format when its name has "llama" in it
+ENDPOINT_NAMES = {
+    "llama-2-13b-chat-llm": "llama-2-endpoint",
+    "mistral-7b-instruct-chat-llm": "mistral-endpoint"
+}
+S3_URI = "s3://staging/llm-inputs/"
+
+
+@pytest.fixture(params=sorted(ENDPOINT_NAMES))
+def llm(request, load_lambda, stub):
+    return load_lambda(request.param, "llm", SAGEMAKER_ENDPOINT_NAME=ENDPOINT_NAMES[request.param], SAGEMAKER_ASYNC_S3_URI=S3_URI,
+                       SAGEMAKER_ASYNC_POLL_SECONDS=0.1, SAGEMAKER_ASYNC_MAX_POLL_SECONDS=0.4)
+
+def get_polls(output):
+    return [json.loads(line)["AsyncInferencePolls"] for line in output.splitlines() if '"AsyncInferencePolls"' in line]
+
+def test_output(llm, stub, capsys):
+    response = llm.lambda_handler({"prompt": "Why is the sky blue?", "parameters": {}}, events.LambdaContext())
+    assert response["generated_text"]
+    # the payload was staged under the endpoint's prefix, and the output read from the output location
+    staged = [key for key in stub.s3_objects if key.startswith("staging/llm-inputs/" + llm.SAGEMAKER_ENDPOINT_NAME + "/")]
+    assert len(staged) == 1
+    assert json.loads(stub.s3_objects[staged[0]])["inputs"]
+    assert any(key.startswith("staging/async-output/") for key in stub.s3_objects)
+    assert get_polls(capsys.readouterr().out)[-1] >= 1
+
+def test_batch_output(llm, stub):
+    response = llm.lambda_handler({"prompts": ["Why is the sky blue?", "Why is the sea salty?", "Hello"], "parameters": {}}, events.LambdaContext())
+    assert [bool(result.get("generated_text")) for result in response["results"]] == [True, True, True]
+
+def test_failure_location(llm, stub):
+    stub.async_inference_error = "ModelError: CUDA out of memory"
+    with pytest.raises(Exception, match="failed: ModelError: CUDA out of memory"):
+        llm.lambda_handler({"prompt": "Why is the sky blue?", "parameters": {}}, events.LambdaContext())
+    assert not any(key.startswith("staging/async-output/") for key in stub.s3_objects)
+
+def test_deadline(llm, stub, capsys):
+    # the output is written long after the invocation's deadline: 3 seconds less the 2 second margin
+    stub.async_inference_seconds = 30
+    start = time.monotonic()
+    with pytest.raises(TimeoutError, match="did not finish before the Lambda deadline"):
+        llm.lambda_handler({"prompt": "Why is the sky blue?", "parameters": {}}, events.LambdaContext(timeout_ms=3000))
+    elapsed = time.monotonic() - start
+    assert 0.8 < elapsed < 2
+    # polled after 0.1, 0.2 and then every 0.4 seconds - not at a fixed interval
+    assert get_polls(capsys.readouterr().out)[-1] == 4
+    # each poll reads the output and the failure locations
+    assert len([r for r in stub.requests if r["service"] == "s3" and r["status"] == 404]) == 8
+
+def test_deadline_from_context(llm):
+    with llm.activate():
+        import sagemaker_async
+        sagemaker_async.set_deadline(events.LambdaContext(timeout_ms=10000))
+        assert 7.5 < sagemaker_async.deadline - time.monotonic() <= 8
+        sagemaker_async.set_deadline(None)
+        assert sagemaker_async.deadline is None
@@ -0,0 +1,36 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+
+import pytest
+
+from conftest import FIXTURES_DIR
+
+PROPERTIES = {"EmbeddingsModelId": "amazon.titan-embed-text-v1", "LLMModelId": "anthropic.claude-instant-v1", "BenchmarkCalls": 4, "BenchmarkConcurrency": 2}
+
+
+def load_test_model(load_lambda, stub):
+    return load_lambda("bedrock-embeddings-and-llm", "testModel", ENDPOINT_URL=stub.url, EMBEDDINGS_ONNX_MODEL_DIR=os.path.join(FIXTURES_DIR, "onnx-tiny"))
+
+def bedrock_calls(stub):
+    return len([r for r in stub.requests if r["service"] == "bedrock"])
+
+def test_bedrock_embeddings_are_checked(load_lambda, stub):
+    testModel = load_test_model(load_lambda, stub)
+    with testModel.activate():
+        results = testModel.run_checks(dict(PROPERTIES, EmbeddingsBackend="bedrock"), None)
+    assert results["embeddings"]["calls"] == 4 and results["embeddings"]["errors"] == 0
+    # check, warm-up (one per worker) and benchmark calls, for both models
+    assert bedrock_calls(stub) == 2 * (1 + 2 + 4)
+
+def test_onnx_embeddings_are_checked_in_the_function(load_lambda, stub):
+    pytest.importorskip("onnxruntime")
+    pytest.importorskip("tokenizers")
+    testModel = load_test_model(load_lambda, stub)
+    with testModel.activate():
+        results = testModel.run_checks(dict(PROPERTIES, EmbeddingsBackend="onnx"), None)
+    assert results["embeddings"]["calls"] == 4 and results["embeddings"]["errors"] == 0
+    assert testModel.embeddings.get_backend("onnx").session is not None
+    # only the LLM calls Bedrock
+    assert bedrock_calls(stub) == 1 + 2 + 4
@@ -0,0 +1,59 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import pytest
+from botocore.exceptions import ClientError
+
+import events
+
+
+def get_spans(loaded, name):
+    with loaded.activate():
+        import tracing
+        return [span for span in tracing.get_exporter().spans if span.name == name]
+
+def test_bedrock_call_span(load_lambda, stub):
+    llm = load_lambda("bedrock-embeddings-and-llm", "llm", ENDPOINT_URL=stub.url, TRACING_EXPORTER="memory")
+    modelId = "anthropic.claude-3-haiku-20240307-v1:0"
+    llm.lambda_handler({"prompt": "Why is the sky blue?", "parameters": {"modelId": modelId}}, events.LambdaContext())
+    span, = get_spans(llm, "bedrock-runtime.InvokeModel")
+    assert span.error is None
+    assert span.end_time >= span.start_time
+    assert span.attributes["rpc.system"] == "aws-api"
+    assert span.attributes["rpc.method"] == "InvokeModel"
+    assert span.attributes["gen_ai.request.model"] == modelId
+    assert span.attributes["gen_ai.system"] == "anthropic"
+    assert span.attributes["http.response.status_code"] == 200
+    assert span.attributes["gen_ai.prompt.size"] > 0
+    assert span.attributes["gen_ai.usage.input_tokens"] > 0
+
+def test_failed_aws_call_span(load_lambda, stub):
+    clients = load_lambda("bedrock-embeddings-and-llm", "clients", TRACING_EXPORTER="memory")
+    with pytest.raises(ClientError):
+        clients.get_client("s3").get_object(Bucket="staging", Key="missing.json")
+    span, = get_spans(clients, "s3.GetObject")
+    assert span.attributes["aws.s3.bucket"] == "staging"
+    assert span.attributes["aws.s3.key"] == "missing.json"
+    assert span.attributes["http.response.status_code"] == 404
+    assert str(span.error) == "NoSuchKey"
+    with clients.activate():
+        import tracing
+        document = tracing.XRayExporter().get_document(span)
+    assert document["fault"] is True
+    assert document["aws"]["operation"] == "GetObject"
+
+def test_http_call_spans(load_lambda, stub):
+    llm = load_lambda("ai21-llm", "llm", ENDPOINT_URL=stub.url + "/studio/v1/{MODEL_TYPE}/complete", TRACING_EXPORTER="memory")
+    assert llm.lambda_handler({"prompt": "Why is the sky blue?", "parameters": {}}, events.LambdaContext())["generated_text"]
+    span, = get_spans(llm, "ai21.complete")
+    assert span.error is None
+    assert span.attributes["gen_ai.system"] == "ai21"
+    assert span.attributes["http.response.status_code"] == 200
+    assert span.attributes["http.response.body.size"] > 0
+    # an error response
+    llm.module.ENDPOINT_URL = stub.url + "/missing/{MODEL_TYPE}"
+    with pytest.raises(Exception, match="Error: 404"):
+        llm.lambda_handler({"prompt": "Why is the sky blue?", "parameters": {}}, events.LambdaContext())
+    span = get_spans(llm, "ai21.complete")[-1]
+    assert span.attributes["http.response.status_code"] == 404
+    assert str(span.error) == "HTTP 404"